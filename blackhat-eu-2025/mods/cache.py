@@ -0,0 +1,150 @@
+from typing import Any, Callable, Iterable, TypeVar
+
+import functools
+import threading
+import duckdb
+import ujson
+import time
+import os
+
+T = TypeVar('T')
+
+DAY = 24 * 3600
+
+# how long responses stay fresh, per endpoint
+TTLS = {
+    "ripe:ris": 7 * DAY,
+    "ripe:name": 30 * DAY,
+    "ripe:contact": 7 * DAY,
+    "ripe:prefixes": 7 * DAY,
+    "shodan": 7 * DAY,
+    "censys": 7 * DAY,
+    "greynoise": DAY,
+}
+DEFAULT_TTL = 7 * DAY
+
+class ResponseCache:
+    """
+    Cache of API responses keyed by endpoint and resource, stored in a DuckDB file,
+    or in memory for the run when there is no path. Entries expire after the TTL of
+    their endpoint, and the oldest ones are evicted once there are more than `max_entries`.
+    In offline mode, misses are never fetched.
+    """
+
+    def __init__(self, path: str, ttls: dict[str, float] = TTLS, max_entries: int = 1_000_000, offline: bool = False):
+        self.path = path
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.offline = offline
+        self.lock = threading.Lock()
+        self._conn: duckdb.DuckDBPyConnection | None = None
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def conn(self) -> duckdb.DuckDBPyConnection:
+        if self._conn is None:
+            if d := os.path.dirname(self.path):
+                os.makedirs(d, exist_ok=True)
+            self._conn = duckdb.connect(self.path or ":memory:")
+            self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                endpoint VARCHAR,
+                resource VARCHAR,
+                value VARCHAR,
+                fetched_at DOUBLE,
+                PRIMARY KEY (endpoint, resource)
+            )
+            """)
+        return self._conn
+
+    def get_many(self, endpoint: str, resources: Iterable[str]) -> tuple[dict[str, Any], list[str]]:
+        "Fresh responses of the resources, and the resources that missed"
+        resources = list(resources)
+        if not resources:
+            return {}, []
+
+        oldest = time.time() - self.ttls.get(endpoint, DEFAULT_TTL)
+        q = """
+        SELECT resource, value, fetched_at
+        FROM responses
+        WHERE endpoint = ? AND resource IN (SELECT unnest(?))
+        """
+        with self.lock:
+            rows = self.conn().execute(q, [endpoint, resources]).fetchall()
+
+        found = {r: ujson.loads(v) for r, v, t in rows if t >= oldest}
+        missing = [r for r in resources if r not in found]
+        with self.lock:
+            self.hits += len(found)
+            self.misses += len(missing)
+            self.expired += len(rows) - len(found)
+        return found, missing
+
+    def get(self, endpoint: str, resource: str) -> Any | None:
+        found, _ = self.get_many(endpoint, [resource])
+        return found.get(resource)
+
+    def put_many(self, endpoint: str, values: dict[str, Any]) -> None:
+        if not values:
+            return
+        now = time.time()
+        rows = [(endpoint, r, ujson.dumps(v), now) for r, v in values.items()]
+        with self.lock:
+            self.conn().executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", rows)
+            self._puts += len(rows)
+            if self._puts >= 1000:
+                self._evict()
+
+    def put(self, endpoint: str, resource: str, value: Any) -> None:
+        self.put_many(endpoint, {resource: value})
+
+    def _evict(self) -> None:
+        self._puts = 0
+        count, = self.conn().execute("SELECT COUNT(*) FROM responses").fetchone()
+        if (extra := count - self.max_entries) > 0:
+            self.conn().execute("""
+            DELETE FROM responses
+            WHERE (endpoint, resource) IN (
+                SELECT (endpoint, resource) FROM responses ORDER BY fetched_at LIMIT ?
+            )
+            """, [extra])
+            self.evicted += extra
+
+    def cached(self, endpoint: str, default: Any = None, key: Callable[..., str] | None = None) -> Callable[[Callable[..., T]], Callable[..., T]]:
+        """
+        Decorator caching the non-empty results of a fetch function.
+        The resource is the first argument, unless a key function is given.
+        """
+        def decorator(fetch: Callable[..., T]) -> Callable[..., T]:
+            @functools.wraps(fetch)
+            def wrapper(*args: Any, **kwargs: Any) -> T:
+                resource = key(*args, **kwargs) if key else str(args[0])
+                if (v := self.get(endpoint, resource)) is not None:
+                    return v
+                if self.offline:
+                    return default
+                if v := fetch(*args, **kwargs):
+                    self.put(endpoint, resource, v)
+                return v
+            return wrapper
+        return decorator
+
+    def summary(self) -> str:
+        return f"cache {self.hits} hits, {self.misses} misses ({self.expired} expired), {self.evicted} evicted"
+
+def new_cache() -> ResponseCache:
+    """
+    Cache of the process. Responses are only persisted when DICE_CACHE names a file:
+    a file shared by concurrent runs would be locked by the first one
+    """
+    return ResponseCache(
+        os.environ.get("DICE_CACHE", ""),
+        max_entries=int(os.environ.get("DICE_CACHE_MAX", "1000000")),
+        offline=os.environ.get("DICE_CACHE_OFFLINE", "0") == "1",
+    )
+
+# shared by the RIPEstat and CTI scanners
+CACHE = new_cache()
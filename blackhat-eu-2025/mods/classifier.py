@@ -0,0 +1,129 @@
+from dice.module import Module, ModuleHandler
+from dice.query import query_db
+
+from typing import Any, Callable
+from dataclasses import dataclass
+
+import duckdb
+import pandas as pd
+import os
+
+type FingerprintMask = Callable[[pd.DataFrame], pd.Series]
+
+LABELS_TABLE = "labels"
+# stand-in fingerprint id, used to find the column `make_label` puts it in
+FP_PLACEHOLDER = "__fingerprint__"
+# label inside the database by default, set to 0 to evaluate the masks in pandas
+PUSHDOWN = os.environ.get("DICE_CLS_PUSHDOWN", "1") != "0"
+# NOTE: the bulk inserts write dice's labels and tags tables directly, INSERT ... BY NAME
+# relies on dice's internal schema matching the `to_dict` of its models.
+# A mismatch is a database error, the repository writes the rows instead.
+BULK_ERRORS = (duckdb.Error,)
+
+@dataclass
+class Predicate:
+    """
+    Condition over the fingerprints table, both as a mask over a chunk
+    and as a SQL expression over the `f` alias.
+    """
+    mask: FingerprintMask
+    sql: str
+
+def every() -> Predicate:
+    return Predicate(lambda df: pd.Series(True, index=df.index), "TRUE")
+
+def not_null(*cols: str) -> Predicate:
+    "Fingerprints where all the columns have a value"
+    return Predicate(
+        lambda df: df[list(cols)].notna().all(axis=1),
+        " AND ".join(f'f."{c}" IS NOT NULL' for c in cols),
+    )
+
+def any_filled(*cols: str) -> Predicate:
+    "Fingerprints where at least one of the columns is neither null nor empty"
+    def mask(df: pd.DataFrame) -> pd.Series:
+        c = list(cols)
+        return (df[c].notna() & (df[c] != "")).any(axis=1)
+
+    return Predicate(
+        mask,
+        " OR ".join(f"""COALESCE(CAST(f."{c}" AS VARCHAR), '') <> ''""" for c in cols),
+    )
+
+def bulk_writable(model: Any) -> bool:
+    "Whether the columns of a dice model can be read to build a bulk insert"
+    return hasattr(model, "to_dict")
+
+def label_projection(mod: Module, label: str, fp_id: str) -> tuple[str, list]:
+    """
+    SELECT list that turns fingerprint ids into label rows.
+    The columns are taken from a label made by the module, so the rows look
+    exactly like the ones `make_label` would create.
+    """
+    tmpl = mod.make_label(FP_PLACEHOLDER, label).to_dict()
+    cols, params = [], []
+    for k, v in tmpl.items():
+        if v == FP_PLACEHOLDER:
+            cols.append(f'CAST({fp_id} AS VARCHAR) AS "{k}"')
+        elif k == "id":
+            cols.append(f'CAST(uuid() AS VARCHAR) AS "{k}"')
+        else:
+            cols.append(f'? AS "{k}"')
+            params.append(v)
+    return ", ".join(cols), params
+
+def bulk_label(mod: Module, ids: pd.Series, label: str) -> None:
+    "Label a batch of fingerprint ids with a single INSERT ... SELECT"
+    repo = mod.repo()
+    conn = repo.get_connection()
+    conn.register("label_batch", pd.DataFrame({"id": ids.astype(str).to_numpy()}))
+    try:
+        sel, params = label_projection(mod, label, "b.id")
+        conn.execute(f"INSERT INTO {LABELS_TABLE} BY NAME SELECT {sel} FROM label_batch AS b", params)
+    except BULK_ERRORS as e:
+        # let the repository write them if they do not fit
+        print(f"failed to bulk insert labels, using the repository: {e!r}")
+        repo.label(*[mod.make_label(i, label) for i in ids.astype(str)])
+    finally:
+        conn.unregister("label_batch")
+
+def label_where(mod: Module, protocol: str, label: str, where: str) -> int:
+    "Label the fingerprints matching the condition without reading them"
+    sel, params = label_projection(mod, label, "f.id")
+    q = f"""
+    INSERT INTO {LABELS_TABLE} BY NAME
+    SELECT {sel}
+    FROM fingerprints AS f
+    WHERE f.protocol = ? AND ({where})
+    """
+    res = mod.repo().get_connection().execute(q, params + [protocol]).fetchone()
+    return res[0] if res else 0
+
+def make_cls_handler(protocol: str, label: str, pred: Predicate | None = None, pushdown: bool = PUSHDOWN) -> ModuleHandler:
+    """
+    Classifier that labels every fingerprint of a protocol matching the predicate.
+    With pushdown, the labels are written by the database in a single statement.
+    Otherwise, the mask is evaluated over whole chunks and the labels are written in batches.
+    """
+    pred = pred or every()
+    def wrapper(mod: Module) -> None:
+        bulk = bulk_writable(mod.make_label(FP_PLACEHOLDER, label))
+        if not bulk:
+            print(f"{protocol}: the label model has no columns to bulk insert, using the repository")
+        if pushdown and bulk:
+            try:
+                n = label_where(mod, protocol, label, pred.sql)
+                print(f"{protocol}: labeled {n} fingerprints as {label}")
+                return
+            except BULK_ERRORS as e:
+                print(f"failed to label {protocol} in the database, reading the fingerprints: {e!r}")
+
+        def handler(df: pd.DataFrame) -> None:
+            ids = df.loc[pred.mask(df), "id"]
+            if len(ids) and bulk:
+                bulk_label(mod, ids, label)
+            elif len(ids):
+                mod.repo().label(*[mod.make_label(i, label) for i in ids.astype(str)])
+
+        mod.with_pbar(handler, query_db("fingerprints", protocol=protocol))
+    return wrapper
@@ -0,0 +1,46 @@
+from dice.repo import Repository
+import pandas as pd
+import duckdb
+
+# hosts queried on each provider and when, whether they returned anything or not
+SCANS_TABLE = "cti_scans"
+
+def create_scans_table(repo: Repository) -> None:
+    repo.get_connection().execute(f"""
+    CREATE TABLE IF NOT EXISTS {SCANS_TABLE} (
+        provider VARCHAR,
+        ip VARCHAR,
+        fetched_at DOUBLE
+    )
+    """)
+
+def query_stale_hosts(repo: Repository, provider: str, oldest: float) -> list[str]:
+    "Scanned hosts the provider was never asked about, or not since `oldest`"
+    create_scans_table(repo)
+    q = f"""
+    SELECT DISTINCT z.ip
+    FROM records_zgrab2 AS z
+    WHERE NOT EXISTS (
+        SELECT 1 FROM {SCANS_TABLE} AS s
+        WHERE s.provider = ? AND s.ip = z.ip AND s.fetched_at >= ?
+    )
+    ORDER BY z.ip
+    """
+    try:
+        res = repo.get_connection().execute(q, [provider, oldest]).fetchall()
+        return [row[0] for row in res]
+    # The table may not exist yet
+    except duckdb.CatalogException:
+        print("table records_zgrab2 not loaded yet")
+        return []
+
+def mark_scanned(repo: Repository, provider: str, hosts: list[str], at: float) -> None:
+    "Record that the provider was asked about the hosts at `at`"
+    create_scans_table(repo)
+    conn = repo.get_connection()
+    conn.register("scanned_hosts", pd.DataFrame({"ip": hosts}, dtype=str))
+    try:
+        conn.execute(f"DELETE FROM {SCANS_TABLE} WHERE provider = ? AND ip IN (SELECT ip FROM scanned_hosts)", [provider])
+        conn.execute(f"INSERT INTO {SCANS_TABLE} SELECT ?, ip, ? FROM scanned_hosts", [provider, at])
+    finally:
+        conn.unregister("scanned_hosts")
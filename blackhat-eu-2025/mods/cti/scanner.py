@@ -3,14 +3,21 @@ from dice.models import Source
 from dice.helpers import new_source
 from dice.loaders import with_records
 from dice.config import SCANNER
+from mods.cache import CACHE, DAY
+from mods.cti.query import query_stale_hosts, mark_scanned
+from mods.ripe.client import TokenBucket
 
-from typing import Callable
-from shodan import Shodan
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from functools import cache
+from typing import Callable, Generator, Iterable
+from shodan import Shodan, APIError
 from greynoise.api import GreyNoise, APIConfig
+from tqdm import tqdm
 
 import requests
-import tempfile
 import json
+import time
 import os
 
 CENSYS_API = "https://api.platform.censys.io/v3/"
@@ -18,16 +25,125 @@ CENSYS_ENDPOINTS = {
     "multiple":"global/asset/host"
 }
 
-type CTIScannerHandler = Callable[[str, list[str]], Source]
+# source of a flushed chunk of records, None if it is empty, and the hosts it answers for
+type ScannedChunk = tuple[Source | None, list[str]]
+# api key and hosts to scan
+type CTIScannerHandler = Callable[[str, list[str]], Iterable[ScannedChunk]]
 type CTIScanner = Callable[[str, list[str]], list[dict]]
 
+@dataclass
+class ProviderSpec:
+    "How a provider is queried: hosts per request, requests in flight, and requests per second"
+    batch_size: int
+    concurrency: int
+    rate: float
+
+# shodan only takes one host per request, censys and greynoise take lists
+PROVIDERS = {
+    "shodan": ProviderSpec(1, 2, 1.),
+    "censys": ProviderSpec(100, 4, 2.),
+    "greynoise": ProviderSpec(1000, 2, 2.),
+}
+
+# where scan results are spooled until they are in the repository, one spool per provider
+SPOOL_DIR = os.environ.get("DICE_CTI_SPOOL", os.path.expanduser("~/.cache/dice/cti"))
+# records per source added to the repository
+SOURCE_CHUNK = 10_000
+# hosts asked about more recently than this are not queried again
+FRESHNESS = float(os.environ.get("DICE_CTI_FRESHNESS", "7")) * DAY
+
+def provider_spec(cti: str) -> ProviderSpec:
+    "Spec of a provider, each field can be overridden with <CTI>_BATCH, <CTI>_CONCURRENCY and <CTI>_RATE"
+    spec = PROVIDERS.get(cti, ProviderSpec(100, 1, 1.))
+    env = lambda k, v: os.environ.get(f"{cti.upper()}_{k}", v)
+    return ProviderSpec(
+        int(env("BATCH", spec.batch_size)),
+        int(env("CONCURRENCY", spec.concurrency)),
+        float(env("RATE", spec.rate)),
+    )
+
+class Spool:
+    """
+    Append-only JSONL file with the results of a scan, one line per completed batch.
+    A batch is only completed once its line is fully written, so an interrupted
+    scan resumes from the hosts that are not in the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def completed(self) -> set[int]:
+        "Batches already in the spool. A line cut by a crash is dropped"
+        done: set[int] = set()
+        if not os.path.exists(self.path):
+            return done
+
+        end = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["batch"])
+                except (ValueError, KeyError):
+                    break
+                end += len(line)
+        with open(self.path, "r+b") as f:
+            f.truncate(end)
+        return done
+
+    def write(self, batch: int, hosts: list[str], results: list[dict]) -> None:
+        if d := os.path.dirname(self.path):
+            os.makedirs(d, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"batch": batch, "hosts": hosts, "results": results}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self, chunk_size: int = SOURCE_CHUNK, hosts: set[str] | None = None) -> Generator[tuple[list[dict], list[str]], None, None]:
+        """
+        Results of every batch with the hosts they answer, in chunks of about `chunk_size` records.
+        Given `hosts`, the batches without any of them are skipped.
+        """
+        if not os.path.exists(self.path):
+            return
+        chunk: list[dict] = []
+        asked: list[str] = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                batch = json.loads(line)
+                if hosts is not None and hosts.isdisjoint(batch.get("hosts", [])):
+                    continue
+                chunk.extend(batch["results"])
+                asked.extend(batch.get("hosts", []))
+                if len(chunk) >= chunk_size:
+                    yield chunk, asked
+                    chunk, asked = [], []
+        if chunk or asked:
+            yield chunk, asked
+
+    def hosts(self) -> list[str]:
+        "Hosts of every completed batch, whether the provider knew them or not"
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding="utf-8") as f:
+            return [h for line in f for h in json.loads(line).get("hosts", [])]
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def spool_path(name: str) -> str:
+    "Spool of the scans of a provider. Resumed scans find it even when the stale hosts changed since"
+    return os.path.join(SPOOL_DIR, f"{name}.jsonl")
+
 def greynoise_lookup(api: GreyNoise, *hosts: str, quick: bool = False) -> list[dict]:
-    try:
-        response = api.quick(list(hosts)) if quick else api.quick(list(hosts))
-        return response
-    except Exception as e:
-        print(f'failed to query GreyNoise: {e}')
-        return []
+    cached, missing = CACHE.get_many("greynoise", hosts)
+    if not missing or CACHE.offline:
+        return list(cached.values())
+
+    # errors reach the scan, so the batch is retried instead of spooled empty
+    response = api.quick(missing) if quick else api.quick(missing)
+    CACHE.put_many("greynoise", {r["ip"]: r for r in response if r.get("ip")})
+    return [*cached.values(), *response]
 
 def fetch_greynoise(api: GreyNoise, *hosts: str) -> list[dict]:
     def filter_malicious(response: dict) -> bool:
@@ -36,71 +152,179 @@ def fetch_greynoise(api: GreyNoise, *hosts: str) -> list[dict]:
     res = greynoise_lookup(api, *hosts, quick=True)
     return list(filter(filter_malicious, res))
 
-def fetch_shodan(api: Shodan, host: str) -> dict:
-    try:
-        # NOTE: the api suggests they accept bulk requests
-        # for multiple hosts. Doesn't work tho, it only accepts
-        # one. Is very bad.
-        response = api.host(host)
-        return response
-    except Exception as e:
-        print(f'failed to query shodan for host {host}: {e}')
-        return {}
-
-def fetch_censys(api_key: str, *hosts: str) -> dict:
+# the error that is an answer
+SHODAN_NO_INFO = "No information available"
+# errors of the key, every host would fail the same: they stop the scan
+SHODAN_FATAL = ["invalid api key", "insufficient query credits", "access denied", "requires an upgrade"]
+# errors worth asking the host again, with exponential backoff. Any other error skips the host
+SHODAN_TRANSIENT = ["rate limit", "unable to connect", "timed out", "timeout", "try again", "internal error", "bad gateway", "service unavailable"]
+SHODAN_RETRIES = int(os.environ.get("SHODAN_RETRIES", "4"))
+SHODAN_BACKOFF = float(os.environ.get("SHODAN_BACKOFF", "1"))
+
+def shodan_error(e: APIError) -> str:
+    "Kind of a Shodan error: no info, fatal, transient, or host"
+    msg = str(e).lower()
+    if SHODAN_NO_INFO.lower() in msg:
+        return "no info"
+    if any(m in msg for m in SHODAN_FATAL):
+        return "fatal"
+    if any(m in msg for m in SHODAN_TRANSIENT):
+        return "transient"
+    return "host"
+
+@CACHE.cached("shodan", default={}, key=lambda _, host, *__, **___: host)
+def fetch_shodan(api: Shodan, host: str, retries: int = SHODAN_RETRIES, backoff: float = SHODAN_BACKOFF) -> dict:
+    """
+    Shodan record of a host, empty if Shodan knows nothing about it.
+    Transient errors are retried, a host whose error persists fails its batch so it is asked again on resume.
+    Errors of the host itself skip it, errors of the key stop the scan.
+    """
+    for attempt in range(retries + 1):
+        try:
+            # NOTE: the api suggests they accept bulk requests
+            # for multiple hosts. Doesn't work tho, it only accepts
+            # one. Is very bad.
+            return api.host(host)
+        except APIError as e:
+            match shodan_error(e):
+                case "no info":
+                    return {}
+                case "transient" if attempt < retries:
+                    time.sleep(backoff * 2 ** attempt)
+                case "host":
+                    print(f"shodan: skipping {host}: {e}")
+                    return {}
+                case _:
+                    raise
+    return {}
+
+def censys_ip(record: dict) -> str | None:
+    "Address of a Censys host record"
+    return record.get("ip") or (record.get("resource") or {}).get("ip")
+
+def fetch_censys(api_key: str, *hosts: str) -> list[dict]:
+    "Censys records of the hosts, each host is cached on its own so batches share the cache"
+    cached, missing = CACHE.get_many("censys", hosts)
+    if not missing or CACHE.offline:
+        return list(cached.values())
+
     headers = {
         "accept": "application/vnd.censys.api.v3.host.v1+json",
         "content-type": "application/json",
         "authorization": api_key,
     }
-    payload = {"host_ids": hosts}
+    payload = {"host_ids": missing}
+
+    response = requests.post("/".join([CENSYS_API, CENSYS_ENDPOINTS["multiple"]]), json=payload, headers=headers)
+    response.raise_for_status()
+    data = response.json()["data"]
 
-    try:
-        response = requests.post("/".join([CENSYS_API, CENSYS_ENDPOINTS["multiple"]]), json=payload, headers=headers)
-        response.raise_for_status()
-        return response.json()["data"]
-    except Exception as e:
-        print(f"failed to fetch hosts: {e}")
-        return {}
+    # a single host comes back as an object, many as a list
+    records = data if isinstance(data, list) else [data] if data else []
+    CACHE.put_many("censys", {ip: r for r in records if (ip := censys_ip(r))})
+    return [*cached.values(), *records]
+
+@cache
+def shodan_client(api_key: str) -> Shodan:
+    "One client per key, shared by every batch"
+    return Shodan(api_key)
+
+@cache
+def greynoise_client(api_key: str) -> GreyNoise:
+    return GreyNoise(APIConfig(api_key=api_key, integration_name="sdk-sample"))
 
 def shodan_scanner(api_key: str, hosts: list[str]) -> list[dict]:
-    client = Shodan(api_key)
+    client = shodan_client(api_key)
     return [r for h in hosts if (r:= fetch_shodan(client, h))]
 
 def censys_scanner(api_key: str, hosts: list[str]) -> list[dict]:
-    return [r for h in hosts if (r:= fetch_censys(api_key, h))]
+    return fetch_censys(api_key, *hosts)
 
 def greynoise_scanner(api_key: str, hosts: list[str]) -> list[dict]:
-    api_config = APIConfig(api_key=api_key, integration_name="sdk-sample")
-    client = GreyNoise(api_config)
-    return fetch_greynoise(client, *hosts)
-
-def batch_scan(api_key: str, hosts: list[str], scanner: CTIScanner, batch_size: int = 100) -> list[dict]:
-    # NOTE: not in use
-    
-    batches = [hosts[i:i+batch_size] for i in range(0, len(hosts), batch_size)]
-    with tempfile.TemporaryFile(mode="w+", encoding="utf-8") as fp:
-        for b in batches:
-            if r:=scanner(api_key, b):
-                for ddict in r:
-                    fp.write(json.dumps(ddict)+"\n")
-        fp.seek(0)
-        return [json.loads(line) for line in fp if line.strip()]
-
-def wrap_scanner(name: str,  scanner: CTIScanner) -> CTIScannerHandler:
-    def wrapper(api_key: str, hosts: list[str]) -> Source:
-        res = scanner(api_key, hosts)
-        src = new_source(name, "-", "-", loader=with_records(res))
-        return src
+    return fetch_greynoise(greynoise_client(api_key), *hosts)
+
+def batch_scan(api_key: str, hosts: list[str], scanner: CTIScanner, spec: ProviderSpec, spool: Spool) -> Spool:
+    """
+    Scan the hosts in batches of the provider size, with up to `spec.concurrency`
+    requests in flight at `spec.rate` requests per second.
+    Results are spooled as batches complete, hosts already in the spool are skipped.
+    A provider error stops the scan and is raised: the failed batch is not spooled,
+    so it is asked again when the scan resumes, the completed ones stay in the spool.
+    """
+    done = spool.completed()
+    spooled = set(spool.hosts())
+    pending = [h for h in hosts if h not in spooled]
+    if len(pending) < len(hosts):
+        print(f"resuming scan: {len(hosts) - len(pending)}/{len(hosts)} hosts done")
+    batches = [pending[i:i+spec.batch_size] for i in range(0, len(pending), spec.batch_size)]
+    # batches keep numbering after the ones in the spool
+    first = max(done, default=-1) + 1
+
+    limiter = TokenBucket(spec.rate, spec.concurrency)
+    def run(i: int) -> tuple[int, list[dict]]:
+        limiter.acquire()
+        return i, scanner(api_key, batches[i])
+
+    with ThreadPoolExecutor(spec.concurrency) as pool, tqdm(total=len(batches), desc="batches") as pbar:
+        futures = [pool.submit(run, i) for i in range(len(batches))]
+        try:
+            for fut in as_completed(futures):
+                i, res = fut.result()
+                spool.write(first + i, batches[i], res)
+                pbar.update(1)
+        except BaseException:
+            for fut in futures:
+                fut.cancel()
+            raise
+    return spool
+
+def wrap_scanner(name: str, scanner: CTIScanner, spec: ProviderSpec | None = None) -> CTIScannerHandler:
+    """
+    Stream the results of a batched scan as sources of about `SOURCE_CHUNK` records, with the hosts they answer.
+    The spool is only cleared once every source was taken, an interrupted run leaves it to the next one.
+    """
+    spec = spec or provider_spec(name)
+    def wrapper(api_key: str, hosts: list[str]) -> Generator[ScannedChunk, None, None]:
+        spool = Spool(spool_path(name))
+        error: Exception | None = None
+        try:
+            batch_scan(api_key, hosts, scanner, spec, spool)
+        except Exception as e:
+            error = e
+        # the completed batches are kept even when the scan fails, the hosts left are stale again on the next run.
+        # Batches whose hosts are not stale anymore were added by an interrupted run
+        for recs, asked in spool.read(SOURCE_CHUNK, set(hosts)):
+            yield new_source(name, "-", "-", loader=with_records(recs)) if recs else None, asked
+        spool.clear()
+        if error is not None:
+            raise error
     return wrapper
 
-def with_cti_scn(api_key: str, scn: CTIScannerHandler) -> ModuleHandler:
+def with_cti_scn(cti: str, api_key: str, scn: CTIScannerHandler, freshness: float = FRESHNESS) -> ModuleHandler:
+    """
+    Enrich the scanned hosts the provider was not asked about within the freshness window.
+    New records are appended to the provider source. The hosts of each source are marked
+    as scanned right after it is added, so a resumed scan does not add them again.
+    """
     def handler(mod: Module) -> None:
         repo = mod.repo()
-        recs = repo.get_records("zgrab2")
+        start = time.time()
+        hosts = query_stale_hosts(repo, cti, start - freshness)
+        print(f"{cti}: {len(hosts)} hosts to enrich")
+        if not hosts:
+            return
 
-        src = scn(api_key, recs.ip.unique().tolist())
-        repo.add_sources(src)
+        # only the hosts of completed batches were asked about
+        scanned = 0
+        try:
+            for src, asked in scn(api_key, hosts):
+                if src is not None:
+                    repo.add_source(src)
+                mark_scanned(repo, cti, asked, start)
+                scanned += len(asked)
+        finally:
+            print(f"{cti}: {scanned}/{len(hosts)} hosts enriched")
+            print(CACHE.summary())
 
     return handler
 
@@ -116,7 +340,7 @@ def get_scanner(cti: str) -> CTIScanner:
             raise Exception(f"unknown CTI {cti}")
 
 def make_cti_scn_handler(cti: str, api_key: str) -> ModuleHandler:
-    return with_cti_scn(api_key, wrap_scanner(cti, get_scanner(cti)))
+    return with_cti_scn(cti, api_key, wrap_scanner(cti, get_scanner(cti)))
 
 def make_scanners() -> list[Module]:
     return [
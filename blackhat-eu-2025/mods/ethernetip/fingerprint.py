@@ -1,41 +1,72 @@
 from dice.module import Module, ModuleHandler, new_module
 from dice.helpers import get_record_field 
-from dice.query import query_records
 from dice.config import FINGERPRINTER
+from mods.fingerprint import make_pool_fp_handler, WORKERS
+
+from collections import Counter
 
 import base64
 import struct
 import pandas as pd
+import numpy as np
 
-def is_vendor_obsolete(data):
-    return data[["DNet", "CNet", "ENet"]].lt(0).all()
+def is_vendor_obsolete(vendors: pd.DataFrame) -> pd.Series:
+    return vendors[["DNet", "CNet", "ENet"]].lt(0).all(axis=1)
 
 # vendors: https://marketplace.odva.org/vid.dat
 # if the number is negative, we should return a "deprecated" state
-def get_vendor_network_status(vendors: pd.DataFrame, vendor_id: int) -> tuple[str, str]:
-    r = vendors[vendors["vendor_id"] == vendor_id]
-    if not len(r):
-        return (f"Unknown ({vendor_id})", "unknown")
-    
-    vrow = r.iloc[0]
-    vname = vrow["Vendor Name"]
-
-    if vrow["Vendor Name"] == "Reserved":
-        return (vname, "reserved")
-    
-    if vrow["ENet"] > 0:
-        return (vname,"active")
-    
-    if is_vendor_obsolete(vrow):
-        return (vname, "obsolete")
-    return (vname, "inactive")
+def get_vendor_network_status(vendors: pd.DataFrame) -> list[str]:
+    "Network status of every vendor in the table"
+    status = np.select(
+        [vendors["Vendor Name"] == "Reserved", vendors["ENet"] > 0, is_vendor_obsolete(vendors)],
+        ["reserved", "active", "obsolete"],
+        "inactive",
+    )
+    return status.tolist()
+
+class EIPCatalogue:
+    """
+    ODVA vendor and device lookup tables, indexed by id.
+    Built once per run so identity items do not filter the DataFrames every time.
+    """
+
+    def __init__(self, vendors: dict[int, tuple[str, str]], devices: dict[int, str]):
+        self.vendors = vendors
+        self.devices = devices
+        self.lookups = 0
+        self.misses = 0
+
+    def vendor(self, vendor_id: int) -> tuple[str, str]:
+        "Return the vendor name and network status"
+        v = self.vendors.get(vendor_id)
+        self._count(v is None)
+        return v if v is not None else (f"Unknown ({vendor_id})", "unknown")
+
+    def device(self, device_id: int) -> str:
+        "Return the device type name"
+        d = self.devices.get(device_id)
+        self._count(d is None)
+        return d if d is not None else f"Unknown ({device_id})"
+
+    def _count(self, miss: bool) -> None:
+        self.lookups += 1
+        self.misses += miss
+
+    def summary(self) -> str:
+        return f"{self.lookups} vendor/device lookups ({self.misses} unknown)"
 
 # devices: https://marketplace.odva.org/technologies/1-ethernet-ip/products#?vendors=all&productTypes=all&deviceTypes=all&docYears=all&categories=all&services=none&page=1&lang=en&view=search&productDisplay=all
-def get_device(devices: pd.DataFrame, device_id: int) -> str:
-    d = devices[devices["device_id"] == device_id]
-    if not len(d):
-        return f"Unknown ({device_id})"
-    return d.iloc[0]["Name"]
+def build_catalogue(vendors: pd.DataFrame, devices: pd.DataFrame) -> EIPCatalogue:
+    # keep the first row of duplicated ids, as the masks did
+    vendors = vendors.drop_duplicates("vendor_id")
+    devices = devices.drop_duplicates("device_id")
+
+    vtable = dict(zip(
+        vendors["vendor_id"].astype(int),
+        zip(vendors["Vendor Name"], get_vendor_network_status(vendors)),
+    ))
+    dtable = dict(zip(devices["device_id"].astype(int), devices["Name"]))
+    return EIPCatalogue(vtable, dtable)
 
 STATUS_FLAGS = {
     0x0001: "Owned",
@@ -79,7 +110,7 @@ def get_product_details(vendor: str, product: str) -> tuple[str,str,str]:
     return (product, product, "")
 
 
-def parse_list_identity_item(item_data: bytes, vendors: pd.DataFrame, devices: pd.DataFrame) -> dict:
+def parse_list_identity_item(item_data: bytes, catalogue: EIPCatalogue) -> dict:
     """
     Parse a single ListIdentity Item (Identity object).
     """
@@ -92,7 +123,7 @@ def parse_list_identity_item(item_data: bytes, vendors: pd.DataFrame, devices: p
     vendor_id, device_type, product_code = struct.unpack_from("<HHH", item_data, 18)
     major, minor = struct.unpack_from("BB", item_data, 24)
     status, serial = struct.unpack_from("<HI", item_data, 26)
-    vname, vstatus = get_vendor_network_status(vendors, vendor_id)
+    vname, vstatus = catalogue.vendor(vendor_id)
 
     prod_name_len = item_data[32]
     pname_b = item_data[33:33 + prod_name_len]
@@ -107,7 +138,7 @@ def parse_list_identity_item(item_data: bytes, vendors: pd.DataFrame, devices: p
         "vendor_name": vname,
         "vendor_status": vstatus,
         "device_type": device_type,
-        "device_type_name": get_device(devices, device_type),
+        "device_type_name": catalogue.device(device_type),
         "product_code": product_code,
         "product_full_name": pname,
         "product_series": ps,
@@ -124,7 +155,7 @@ def parse_list_identity_item(item_data: bytes, vendors: pd.DataFrame, devices: p
 
     return item
 
-def parse_list_identity(data: str, vendors: pd.DataFrame, devices: pd.DataFrame) -> dict:
+def parse_list_identity(data: str, catalogue: EIPCatalogue) -> dict:
     """
     Parse a full ListIdentity response (encapsulation + identity items).
     """
@@ -153,30 +184,193 @@ def parse_list_identity(data: str, vendors: pd.DataFrame, devices: pd.DataFrame)
         offset += item_length
 
         if item_type == 0x0C:  # Identity item
-            items.append(parse_list_identity_item(item_data, vendors, devices))
+            items.append(parse_list_identity_item(item_data, catalogue))
         else:
             items.append({"item_type": item_type, "raw": base64.b64encode(item_data).decode("utf-8")})
     lid["items"] = items
     return lid
 
-def fingerprint(row: pd.Series, vendors: pd.DataFrame, devices: pd.DataFrame):
+def fingerprint(row: pd.Series, catalogue: EIPCatalogue):
     if pd.notna((idt := get_record_field(row, "ListIdentityRaw_Response"))):
-        return parse_list_identity(idt, vendors, devices)
+        return parse_list_identity(idt, catalogue)
 
-def make_ethernetip_fp_handler_from_db() -> ModuleHandler:
+# Fixed-offset part of a ListIdentity response carrying a single identity item:
+# encapsulation header (24), item count (2), item header (4) and the identity
+# item up to the product name length (33)
+LIST_IDENTITY_DTYPE = np.dtype([
+    ("command", "<u2"),
+    ("length", "<u2"),
+    ("session", "<u4"),
+    ("status", "<u4"),
+    ("sender_context", "V8"),
+    ("options", "<u4"),
+    ("item_count", "<u2"),
+    ("item_type", "<u2"),
+    ("item_length", "<u2"),
+    ("protocol_version", "<u2"),
+    ("sin_family", ">u2"),
+    ("sin_port", ">u2"),
+    ("sin_addr", ">u4"),
+    ("sin_zero", "V8"),
+    ("vendor_id", "<u2"),
+    ("device_type", "<u2"),
+    ("product_code", "<u2"),
+    ("major", "u1"),
+    ("minor", "u1"),
+    ("id_status", "<u2"),
+    ("serial", "<u4"),
+    ("name_length", "u1"),
+])
+IDENTITY_OFFSET = 30
+
+def decode_list_identity(col: pd.Series) -> pd.DataFrame:
+    """
+    Decode a whole column of hex ListIdentity responses.
+    The fixed-offset fields of every packet are read at once from a single buffer.
+    Packets that do not fit the single identity item layout are not decoded;
+    the reason is left in the `reject` column instead.
+    """
+    n = len(col)
+    size = LIST_IDENTITY_DTYPE.itemsize
+    reject = np.full(n, None, dtype=object)
+    packets = [b""] * n
+    for i, h in enumerate(col.tolist()):
+        if not isinstance(h, str):
+            reject[i] = "missing"
+            continue
+        try:
+            packets[i] = bytes.fromhex(h)
+        except ValueError:
+            reject[i] = "invalid hex"
+
+    lengths = np.fromiter(map(len, packets), dtype=np.int64, count=n)
+    buf = b"".join(p[:size].ljust(size, b"\0") for p in packets)
+    fixed = np.frombuffer(buf, dtype=LIST_IDENTITY_DTYPE, count=n)
+
+    item_end = np.minimum(IDENTITY_OFFSET + fixed["item_length"].astype(np.int64), lengths)
+    name_end = size + fixed["name_length"].astype(np.int64)
+    checks = [
+        (lengths < 24, "short header"),
+        (lengths == 24, "no items"),
+        (fixed["item_count"] != 1, "multiple items"),
+        (fixed["item_type"] != 0x0C, "not an identity item"),
+        (item_end < size, "short identity item"),
+    ]
+    for failed, reason in checks:
+        reject = np.where(pd.isna(reject) & failed, reason, reject)
+
+    ok = np.flatnonzero(pd.isna(reject))
+    names = pd.Series(None, index=col.index, dtype=object)
+    names.iloc[ok] = [
+        packets[i][size:min(name_end[i], item_end[i])].decode(errors="ignore")
+        for i in ok
+    ]
+    state = pd.Series(pd.NA, index=col.index, dtype="Int64")
+    has_state = ok[name_end[ok] < item_end[ok]]
+    state.iloc[has_state] = [packets[i][name_end[i]] for i in has_state]
+
+    addr = fixed["sin_addr"].astype(np.uint32)
+    octets = [pd.Series((addr >> s) & 0xFF).astype(str) for s in (24, 16, 8, 0)]
+    major = pd.Series(fixed["major"]).astype(str)
+    minor = pd.Series(fixed["minor"]).astype(str)
+
+    return pd.DataFrame({
+        "encap_command": fixed["command"],
+        "encap_session": fixed["session"],
+        "encap_status": fixed["status"],
+        "encap_options": fixed["options"],
+        "protocol_version": fixed["protocol_version"],
+        "ip": octets[0].str.cat(octets[1:], sep=".").to_numpy(),
+        "port": fixed["sin_port"],
+        "vendor_id": fixed["vendor_id"],
+        "device_type": fixed["device_type"],
+        "product_code": fixed["product_code"],
+        "revision": major.str.cat(minor, sep=".").to_numpy(),
+        "status": fixed["id_status"],
+        "serial": fixed["serial"],
+        "product_name": names,
+        "state": state,
+        "reject": reject,
+    }, index=col.index)
+
+def identity_fingerprints(ids: pd.DataFrame, catalogue: EIPCatalogue) -> list[dict]:
+    "Turn decoded ListIdentity rows back into the fingerprints of `parse_list_identity`"
+    fps = []
+    for r in ids.to_dict("records"):
+        vname, vstatus = catalogue.vendor(r["vendor_id"])
+        ps, pn, pv = get_product_details(vname, r["product_name"])
+        item = {
+            "protocol_version": r["protocol_version"],
+            "ip": r["ip"],
+            "port": r["port"],
+            "vendor_id": r["vendor_id"],
+            "vendor_name": vname,
+            "vendor_status": vstatus,
+            "device_type": r["device_type"],
+            "device_type_name": catalogue.device(r["device_type"]),
+            "product_code": r["product_code"],
+            "product_full_name": r["product_name"],
+            "product_series": ps,
+            "product_name": pn,
+            "product_version": pv,
+            "revision": r["revision"],
+            "status": r["status"],
+            "serial": r["serial"],
+            "status_flags": decode_status(r["status"]),
+        }
+        if pd.notna(r["state"]):
+            item["state"] = r["state"]
+
+        fps.append({
+            "command": r["encap_command"],
+            "session": r["encap_session"],
+            "status": r["encap_status"],
+            "options": r["encap_options"],
+            "items": [item],
+        })
+    return fps
+
+def get_record_column(df: pd.DataFrame, field: str) -> pd.Series:
+    "Column holding a record field, whatever the normalization prefix is"
+    for c in df.columns:
+        if c == field or c.endswith(f".{field}") or c.endswith(f"_{field}"):
+            return df[c]
+    return pd.Series([get_record_field(r, field) for _, r in df.iterrows()], index=df.index, dtype=object)
+
+def fingerprint_chunk(df: pd.DataFrame, catalogue: EIPCatalogue) -> list[tuple[int, dict | None]]:
+    ids = decode_list_identity(get_record_column(df, "ListIdentityRaw_Response"))
+    ok = ids["reject"].isna().to_numpy()
+    fps: list[tuple[int, dict | None]] = list(zip(
+        np.flatnonzero(ok).tolist(),
+        identity_fingerprints(ids[ok], catalogue),
+    ))
+
+    # odd layouts (e.g., several items) go through the per-packet parser,
+    # the packets it cannot parse either are counted by the reason they were rejected
+    malformed: Counter[str] = Counter()
+    for i in np.flatnonzero(~ok & (ids["reject"] != "missing").to_numpy()).tolist():
+        try:
+            if fp := fingerprint(df.iloc[i], catalogue):
+                fps.append((i, fp))
+        except (ValueError, IndexError, struct.error):
+            malformed[ids["reject"].iat[i]] += 1
+            fps.append((i, None))
+    if malformed:
+        reasons = ", ".join(f"{n} {reason}" for reason, n in malformed.most_common())
+        print(f"ethernetip: {malformed.total()} malformed ListIdentity responses ({reasons})")
+    return fps
+
+def make_ethernetip_fp_handler_from_db(workers: int = WORKERS) -> ModuleHandler:
     def wrapper(mod: Module) -> None:
         repo = mod.repo()
         vendors = repo.get_records(source="eip_vendors", prefix=None)
         devices = repo.get_records(source="eip_devices", prefix=None)
-        def handler(df: pd.DataFrame):
-            fps = []
-            for _,r in df.iterrows():
-                if fp := fingerprint(r, vendors, devices):
-                    fps.append(mod.make_fingerprint(r, fp, "ethernetip"))
-            repo.fingerprint(*fps)
-
-        q = query_records("zgrab2", protocol="ethernetip")
-        mod.with_pbar(handler, q)
+        catalogue = build_catalogue(vendors, devices)
+
+        make_pool_fp_handler(fingerprint_chunk, "ethernetip", workers, (catalogue,))(mod)
+        # lookups made by the pool workers are not counted here
+        if catalogue.lookups:
+            print(f"ethernetip catalogue: {catalogue.summary()}")
     return wrapper
 
 def make_fingerprinter() -> Module:
@@ -0,0 +1,80 @@
+from dice.module import Module, ModuleHandler, make_fp_handler
+from dice.query import query_records
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from collections import deque
+from functools import partial
+from typing import Any, Callable
+
+import pandas as pd
+import os
+
+# A chunk fingerprinter returns the position of every row it fingerprinted in the chunk.
+# A None fingerprint marks a malformed row.
+type ChunkFingerprinter = Callable[..., list[tuple[int, dict | None]]]
+type RowFingerprinter = Callable[..., dict | None]
+
+# processes decoding fingerprint chunks. 0 or 1 keeps everything in the main process
+WORKERS = int(os.environ.get("DICE_FP_WORKERS", "0"))
+
+# read-only lookup data for the chunk fingerprinters, set once per worker
+_context: tuple = ()
+
+def _init_worker(*context: Any) -> None:
+    global _context
+    _context = context
+
+def _run_chunk(fn: ChunkFingerprinter, df: pd.DataFrame) -> list[tuple[int, dict | None]]:
+    return fn(df, *_context)
+
+def rowwise(fingerprint: RowFingerprinter, df: pd.DataFrame, *context: Any) -> list[tuple[int, dict | None]]:
+    "Run a row fingerprint function over a chunk"
+    return [(i, fp) for i, (_, r) in enumerate(df.iterrows()) if (fp := fingerprint(r, *context))]
+
+def make_pool_fp_handler(fn: ChunkFingerprinter, protocol: str, workers: int = WORKERS, context: tuple = ()) -> ModuleHandler:
+    """
+    Fingerprinter that decodes the zgrab2 chunks of a protocol in a pool of processes.
+    The context is sent once to every worker. Results are written by the main process
+    in the same order the chunks were queried.
+    """
+    def wrapper(mod: Module) -> None:
+        repo = mod.repo()
+        malformed = 0
+        pending: deque[tuple[pd.DataFrame, Future]] = deque()
+
+        def write(df: pd.DataFrame, fps: list[tuple[int, dict | None]]) -> None:
+            nonlocal malformed
+            recs = []
+            for i, fp in fps:
+                if fp is None:
+                    malformed += 1
+                    continue
+                recs.append(mod.make_fingerprint(df.iloc[i], fp, protocol))
+            repo.fingerprint(*recs)
+
+        q = query_records("zgrab2", protocol=protocol)
+        if workers <= 1:
+            mod.with_pbar(lambda df: write(df, fn(df, *context)), q)
+        else:
+            with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=context) as pool:
+                def handler(df: pd.DataFrame) -> None:
+                    pending.append((df, pool.submit(_run_chunk, fn, df)))
+                    # bound the chunks in flight, the oldest one is always written first
+                    while len(pending) > 2 * workers:
+                        df, fut = pending.popleft()
+                        write(df, fut.result())
+
+                mod.with_pbar(handler, q)
+                while pending:
+                    df, fut = pending.popleft()
+                    write(df, fut.result())
+
+        if malformed:
+            print(f"{protocol}: {malformed} malformed records skipped")
+    return wrapper
+
+def make_parallel_fp_handler(fingerprint: RowFingerprinter, protocol: str, workers: int = WORKERS) -> ModuleHandler:
+    "Same as `make_fp_handler`, using a pool of processes when there are workers"
+    if workers <= 1:
+        return make_fp_handler(fingerprint, protocol)
+    return make_pool_fp_handler(partial(rowwise, fingerprint), protocol, workers)
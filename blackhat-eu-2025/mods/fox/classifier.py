@@ -1,7 +1,6 @@
 from dice.module import Module, new_module
 from dice.config import CLASSIFIER
-from dice.query import query_db
-import pandas as pd
+from mods.classifier import make_cls_handler
 
 def fox_cls_init(mod: Module) -> None:
     mod.register_label(
@@ -9,16 +8,7 @@ def fox_cls_init(mod: Module) -> None:
         "allows unauthenticatied clients to communicate"
     )
 
-def fox_cls_handler(mod: Module) -> None:
-    repo = mod.repo()
-    def handler(df: pd.DataFrame):
-        labs = []
-        for fp in df.itertuples(index=False):
-            labs.append(mod.make_label(str(fp.id), "anonymous-connection"))
-        repo.label(*labs)
-    
-    q = query_db("fingerprints", protocol="fox")
-    mod.with_pbar(handler, q)
+fox_cls_handler = make_cls_handler("fox", "anonymous-connection")
 
 def make_classifier() -> Module:
-    return new_module(CLASSIFIER, "fox", fox_cls_handler, fox_cls_init)
\ No newline at end of file
+    return new_module(CLASSIFIER, "fox", fox_cls_handler, fox_cls_init)
@@ -1,6 +1,7 @@
-from dice.module import make_fp_handler, Module, new_module
+from dice.module import Module, new_module
 from dice.helpers import get_record_field, record_to_dict 
 from dice.config import FINGERPRINTER
+from mods.fingerprint import make_parallel_fp_handler
 
 def fingerprint(row) -> dict | None:
     is_fox = get_record_field(row, "is_fox", False)
@@ -8,7 +9,7 @@ def fingerprint(row) -> dict | None:
     if is_fox and version:
         return record_to_dict(row)
 
-fox_fp_handler = make_fp_handler(fingerprint, "fox")
+fox_fp_handler = make_parallel_fp_handler(fingerprint, "fox")
 
 def make_fingerprinter() -> Module:
     return new_module(FINGERPRINTER, "fox", fox_fp_handler)
\ No newline at end of file
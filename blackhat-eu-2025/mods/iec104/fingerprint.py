@@ -1,6 +1,7 @@
-from dice.module import make_fp_handler, Module, new_module
+from dice.module import Module, new_module
 from dice.helpers import get_record_field 
 from dice.config import FINGERPRINTER
+from mods.fingerprint import make_parallel_fp_handler
 import pandas as pd
 
 def fingerprint(row: pd.Series) -> dict | None:
@@ -14,7 +15,7 @@ def fingerprint(row: pd.Series) -> dict | None:
             tfr=tfr is None
         )
 
-iec104_fp_handler = make_fp_handler(fingerprint, "iec104")
+iec104_fp_handler = make_parallel_fp_handler(fingerprint, "iec104")
 
 def make_fingerprinter() -> Module:
     return new_module(FINGERPRINTER, "iec104", iec104_fp_handler)
\ No newline at end of file
@@ -0,0 +1,47 @@
+from dice.repo import Repository
+
+import os
+
+# one row per IOA of every interrogation ASDU, ASDUs without IOAs keep a row with a NULL address
+IOAS_TABLE = "iec104_ioas"
+# common addresses scanners interrogate
+SCANNED_CAS = [int(ca) for ca in os.environ.get("DICE_IEC104_CAS", "1,2,10,65535").split(",") if ca]
+
+ASDUS_SCHEMA = '[{"TypeID":"BIGINT","CA":"BIGINT","IOAs":[{"Address":"BIGINT","Data":"JSON"}]}]'
+
+def unnest_iec104_ioas(repo: Repository, rebuild: bool = False) -> str:
+    """
+    Unnest the ASDUs and IOAs of the IEC 104 fingerprints into a columnar table, once per connection.
+    The table is temporary, it goes away with the connection and never outlives the fingerprints it was built from.
+    """
+    conn = repo.get_connection()
+    built = conn.execute(
+        "SELECT COUNT(*) FROM duckdb_tables() WHERE temporary AND table_name = ?", [IOAS_TABLE]
+    ).fetchone()
+    if built and built[0] and not rebuild:
+        return IOAS_TABLE
+
+    conn.execute(f"""
+    CREATE OR REPLACE TEMP TABLE {IOAS_TABLE} AS
+    WITH parsed AS (
+        SELECT id AS fingerprint, from_json(CAST(data_asdus AS JSON), '{ASDUS_SCHEMA}') AS asdus
+        FROM fingerprints
+        WHERE protocol = 'iec104' AND data_asdus IS NOT NULL
+    ),
+    asdus AS (
+        SELECT fingerprint, unnest(range(len(asdus))) AS asdu, unnest(asdus) AS a
+        FROM parsed
+    )
+    SELECT
+        fingerprint,
+        asdu,
+        a.TypeID AS type_id,
+        a.CA AS ca,
+        ioa.Address AS address,
+        CAST(ioa.Data AS VARCHAR) AS value
+    FROM (
+        SELECT *, unnest(CASE WHEN len(coalesce(a.IOAs, [])) = 0 THEN [NULL] ELSE a.IOAs END) AS ioa
+        FROM asdus
+    )
+    """)
+    return IOAS_TABLE
@@ -1,7 +1,6 @@
 from dice.module import Module, new_module
 from dice.config import CLASSIFIER
-from dice.query import query_db
-import pandas as pd
+from mods.classifier import make_cls_handler, any_filled
 
 def modbus_cls_init(mod: Module) -> None:
     mod.register_label(
@@ -9,18 +8,11 @@ def modbus_cls_init(mod: Module) -> None:
         "allows unauthenticatied clients to communicate"
     )
 
-def modbus_cls_handler(mod: Module) -> None:
-    cols = ["data_vendor", "data_product_code", "data_revision"]
-    def handler(df: pd.DataFrame) -> None:
-        labs = []
-        mask = df[cols].notna() & (df[cols] != "")
-        mask = mask.any(axis=1)
-
-        for fp in df[mask].itertuples(index=False):
-            labs.append(mod.make_label(str(fp.id), "anonymous-connection"))
-        mod.repo().add_labels(*labs)
-
-    mod.with_pbar(handler, query_db("fingerprints", protocol="modbus"))
+modbus_cls_handler = make_cls_handler(
+    "modbus",
+    "anonymous-connection",
+    any_filled("data_vendor", "data_product_code", "data_revision"),
+)
 
 def make_classifier() -> Module:
-    return new_module(CLASSIFIER, "modbus", modbus_cls_handler, modbus_cls_init)
\ No newline at end of file
+    return new_module(CLASSIFIER, "modbus", modbus_cls_handler, modbus_cls_init)
@@ -1,6 +1,7 @@
-from dice.module import make_fp_handler, Module, new_module
+from dice.module import Module, new_module
 from dice.helpers import get_record_field 
 from dice.config import FINGERPRINTER
+from mods.fingerprint import make_parallel_fp_handler
 import pandas as pd
 import numpy as np
 
@@ -21,7 +22,7 @@ def fingerprint(row: pd.Series) -> dict | None:
     }
     return ret
 
-modbus_fp_handler = make_fp_handler(fingerprint, "modbus")
+modbus_fp_handler = make_parallel_fp_handler(fingerprint, "modbus")
 
 def make_fingerprinter() -> Module:
     return new_module(FINGERPRINTER, "modbus", modbus_fp_handler)
\ No newline at end of file
@@ -1,100 +1,240 @@
 from dice.module import Module
 from dice.query import query_prefix_hosts, query_records
 from dice.repo import save
+from mods.tagger import tag_query
 
 from sklearn.linear_model import LinearRegression
 from sklearn.mixture import GaussianMixture
+from dataclasses import dataclass
 from tqdm import tqdm
 
-import ipaddress
+import duckdb
 import pandas as pd
 import numpy as np
+import time
+import os
+
+DENSE_THRESHOLD = 0.95
+# prefixes sampled to fit the model, the rest are scored in chunks. 0 fits on every prefix in memory
+SAMPLE = int(os.environ.get("DICE_CONDENSATION_SAMPLE", "0"))
+SEED = int(os.environ.get("DICE_CONDENSATION_SEED", "0"))
+# also fit on every prefix after a sampled fit, to report how much they agree
+AGREEMENT = os.environ.get("DICE_CONDENSATION_AGREEMENT", "0") == "1"
+# scores of the sampled fit
+SCORES_TABLE = "condensation_scores"
+
+# statistics of every prefix length, computed in a single grouped aggregation
+DESCRIBE_QUERY = """
+SELECT
+    slash,
+    COUNT(*) AS count_prefixes,
+
+    -- size stats
+    AVG(size) AS size_mean,
+    quantile_cont(size, 0.5) AS size_p50,
+    quantile_cont(size, 0.90) AS size_p90,
+    quantile_cont(size, 0.99) AS size_p99,
+    MIN(size) AS size_min,
+    MAX(size) AS size_max,
+    SUM(size) AS size_total_hosts,
+
+    -- density stats
+    AVG(density) AS density_mean,
+    quantile_cont(density, 0.5) AS density_p50,
+    quantile_cont(density, 0.90) AS density_p90,
+
+    -- condensation (GMM probability)
+    AVG(p_dense) AS p_dense_mean,
+    quantile_cont(p_dense, 0.90) AS p_dense_p90
+FROM {table}
+GROUP BY slash, prefixlen
+ORDER BY prefixlen
+"""
 
 def describe_condensation(df: pd.DataFrame) -> pd.DataFrame:
     """
     Summarize condensation info grouped by prefix length (/n).
     Shows descriptive statistics for size, density, and p_dense.
     """
-    grouped = []
-
-    for slash, g in df.groupby("slash"):
-        sizes = g["size"]
-        densities = g["density"]
-        p_dense = g["p_dense"]
-
-        grouped.append({
-            "slash": slash,
-            "count_prefixes": len(g),
-
-            # size stats
-            "size_mean": sizes.mean(),
-            "size_p50": sizes.median(),
-            "size_p90": sizes.quantile(0.90),
-            "size_p99": sizes.quantile(0.99),
-            "size_min": sizes.min(),
-            "size_max": sizes.max(),
-            "size_total_hosts": sizes.sum(),
-
-            # density stats
-            "density_mean": densities.mean(),
-            "density_p50": densities.median(),
-            "density_p90": densities.quantile(0.90),
-
-            # condensation (GMM probability)
-            "p_dense_mean": p_dense.mean(),
-            "p_dense_p90": p_dense.quantile(0.90),
-        })
-
-    summary = pd.DataFrame(grouped)
-    return summary.sort_values("slash")
-
-def model_condensation(df: pd.DataFrame) -> None:
-    df["slash"] = df["prefix"].apply(lambda p: f"/{ipaddress.ip_network(p).prefixlen}")
-    df["size"] = [2 ** (32 - ipaddress.ip_network(p).prefixlen) for p in df["prefix"]]
+    conn = duckdb.connect()
+    conn.register("condensation", df[["slash", "prefixlen", "size", "density", "p_dense"]])
+    try:
+        return conn.execute(DESCRIBE_QUERY.format(table="condensation")).df()
+    finally:
+        conn.close()
+
+def prefix_lengths(prefixes: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    "Length of the prefixes and the number of bits of their family, addresses without length are full-length prefixes"
+    prefixes = prefixes.astype(str)
+    bits = np.where(prefixes.str.contains(":", regex=False), 128, 32)
+    lens = pd.to_numeric(prefixes.str.partition("/")[2], errors="coerce")
+    return np.where(lens.isna(), bits, lens).astype(np.int64), bits
+
+@dataclass
+class CondensationModel:
+    "Baseline density of each prefix size, and the mixture telling dense prefixes apart"
+    base: LinearRegression
+    gmm: GaussianMixture
+    dense_component: int
+
+def prepare_condensation(df: pd.DataFrame) -> None:
+    lens, bits = prefix_lengths(df["prefix"])
+    df["prefixlen"] = lens
+    df["slash"] = "/" + df["prefixlen"].astype(str)
+    df["size"] = np.exp2((bits - lens).astype(np.float64))
     df["density"] = df["count"] / df["size"]
 
+def fit_condensation(df: pd.DataFrame, seed: int = 0) -> tuple[CondensationModel, dict[str, float]]:
+    "Fits the model on prepared prefixes, returns the time taken by each stage"
+    timings: dict[str, float] = {}
+
     # --- Step 1: baseline regression (log–log)
+    start = time.perf_counter()
     X = np.asarray(np.log10(df["size"])).reshape(-1, 1)
     y = np.asarray(np.log10(df["density"].clip(lower=1e-9)))
     base_model = LinearRegression().fit(X, y)
-    df["expected_density"] = 10 ** base_model.predict(X)
+    timings["regression"] = time.perf_counter() - start
 
     # --- Step 2: residuals
-    df["log_excess"] = np.log10(df["density"].clip(lower=1e-9) / df["expected_density"])
+    log_excess = y - base_model.predict(X)
 
     # --- Step 3: Gaussian mixture
-    Xg = np.asarray(df["log_excess"]).reshape(-1, 1)
-    gmm = GaussianMixture(n_components=2, random_state=0).fit(Xg)
-    probs = gmm.predict_proba(Xg)
+    start = time.perf_counter()
+    gmm = GaussianMixture(n_components=2, random_state=seed).fit(log_excess.reshape(-1, 1))
+    timings["gmm"] = time.perf_counter() - start
+
+    return CondensationModel(base_model, gmm, int(np.argmax(gmm.means_))), timings
 
-    dense_component = np.argmax(gmm.means_)
-    df["p_dense"] = probs[:, dense_component]
+def score_condensation(model: CondensationModel, df: pd.DataFrame) -> None:
+    "Adds the expected density, the excess over it and the probability of being dense to prepared prefixes"
+    X = np.asarray(np.log10(df["size"])).reshape(-1, 1)
+    df["expected_density"] = 10 ** model.base.predict(X)
+    df["log_excess"] = np.log10(df["density"].clip(lower=1e-9) / df["expected_density"])
+    probs = model.gmm.predict_proba(np.asarray(df["log_excess"]).reshape(-1, 1))
+    df["p_dense"] = probs[:, model.dense_component]
+
+def print_timings(timings: dict[str, float], n: int) -> None:
+    print("condensation fit: " + ", ".join(f"{k} {v:.3f}s" for k, v in timings.items()) + f" ({n} prefixes)")
+
+def model_condensation(df: pd.DataFrame, seed: int = 0) -> dict[str, float]:
+    "Fits the condensation model on the prefixes in place, returns the time taken by each stage"
+    start = time.perf_counter()
+    prepare_condensation(df)
+    prepared = time.perf_counter() - start
+
+    model, timings = fit_condensation(df, seed)
+
+    start = time.perf_counter()
+    score_condensation(model, df)
+    timings = {"prepare": prepared, **timings, "score": time.perf_counter() - start}
+
+    print_timings(timings, len(df))
+    return timings
+
+def condensation_agreement(conn: duckdb.DuckDBPyConnection, seed: int) -> float:
+    "Fraction of prefixes the sampled fit and a fit on every prefix agree on being dense"
+    scores = conn.execute(f"SELECT size, density, p_dense FROM {SCORES_TABLE}").df()
+    sampled = scores["p_dense"] > DENSE_THRESHOLD
+
+    model, _ = fit_condensation(scores, seed)
+    score_condensation(model, scores)
+    full = scores["p_dense"] > DENSE_THRESHOLD
+
+    agreement = float((sampled == full).mean()) if len(scores) else 1.
+    print(f"condensation agreement with the full fit: {agreement:.4f} (dense: {sampled.sum()} sampled, {full.sum()} full)")
+    return agreement
+
+def sample_prefixes(conn: duckdb.DuckDBPyConnection, sample: int, seed: int) -> pd.DataFrame:
+    "Reservoir sample of the prefixes, drawn single-threaded since only then the same seed draws the same sample"
+    threads, = conn.execute("SELECT current_setting('threads')").fetchone()
+    conn.execute("SET threads = 1")
+    try:
+        q = f"SELECT * FROM ({query_prefix_hosts()}) AS p USING SAMPLE reservoir({int(sample)} ROWS) REPEATABLE ({int(seed)})"
+        return conn.execute(q).df()
+    finally:
+        conn.execute(f"SET threads = {int(threads)}")
+
+def stream_condensation(mod: Module, sample: int, seed: int = SEED, agreement: bool = AGREEMENT) -> pd.DataFrame:
+    """
+    Fits the model on a reservoir sample of the prefixes and scores all of them in chunks,
+    so memory stays bounded by the sample and the chunk sizes. The same seed draws the same sample.
+    Scores are written to a temporary scores table, the summary and the dense prefixes are read from it.
+    """
+    repo = mod.repo()
+    conn = repo.get_connection()
+
+    start = time.perf_counter()
+    fit_df = sample_prefixes(conn, sample, seed)
+    prepare_condensation(fit_df)
+    prepared = time.perf_counter() - start
+
+    model, timings = fit_condensation(fit_df, seed)
+    print_timings({"sample": prepared, **timings}, len(fit_df))
+
+    # written from its own cursor, the chunks are still being read from the repository connection.
+    # The table is temporary to the cursor, so everything reading it goes through the cursor too
+    cur = conn.cursor()
+    try:
+        cur.execute(f"""
+        CREATE OR REPLACE TEMP TABLE {SCORES_TABLE} (
+            prefix VARCHAR, count BIGINT, slash VARCHAR, prefixlen BIGINT,
+            size DOUBLE, density DOUBLE, p_dense DOUBLE
+        )
+        """)
+        cols = ["prefix", "count", "slash", "prefixlen", "size", "density", "p_dense"]
+        t, gen = repo.queryb(query_prefix_hosts(), normalize=False)
+        with tqdm(total=t, desc="condensation") as pbar:
+            for b in gen:
+                prepare_condensation(b)
+                score_condensation(model, b)
+                cur.register("scored_batch", b[cols])
+                cur.execute(f"INSERT INTO {SCORES_TABLE} SELECT * FROM scored_batch")
+                cur.unregister("scored_batch")
+                pbar.update(len(b.index))
+
+        if agreement:
+            condensation_agreement(cur, seed)
+
+        save(conn, "condensation_summary", cur.execute(DESCRIBE_QUERY.format(table=SCORES_TABLE)).df())
+        return cur.execute(f"SELECT prefix, p_dense FROM {SCORES_TABLE} WHERE p_dense > ?", [DENSE_THRESHOLD]).df()
+    finally:
+        cur.execute(f"DROP TABLE IF EXISTS {SCORES_TABLE}")
+        cur.close()
+
+def tag_dense(mod: Module, dense: pd.DataFrame) -> int:
+    "Tag the hosts of the dense prefixes with a single join"
+    conn = mod.repo().get_connection()
+    conn.register("dense_batch", dense[["prefix", "p_dense"]])
+    try:
+        conn.execute("CREATE OR REPLACE TEMP TABLE dense_prefixes AS SELECT * FROM dense_batch")
+    finally:
+        conn.unregister("dense_batch")
+
+    q = f"""
+    SELECT h.ip AS host, printf('probability: %.3f', d.p_dense) AS details
+    FROM ({query_records("hosts")}) AS h
+    JOIN dense_prefixes AS d ON h.prefix = d.prefix
+    """
+    try:
+        return tag_query(mod, "dense", q)
+    finally:
+        conn.execute("DROP TABLE IF EXISTS dense_prefixes")
 
 def tag_condensed(mod: Module) -> None:
     "Uses a model to determine prefix density and condensation"
     repo = mod.repo()
-    prefixes = repo.get_connection().execute(query_prefix_hosts()).df()
-    model_condensation(prefixes)
-    desc = describe_condensation(prefixes)
-    save(repo.get_connection(), "condensation_summary", desc)
-
-    # Filter rows instead of just prefixes
-    dense_df = prefixes[prefixes["p_dense"] > 0.95]
-
-    with tqdm(total=len(dense_df), desc="condensation") as pbar:
-        for _, row in dense_df.iterrows():
-            tags = []
-            hosts = repo.query(query_records("hosts", prefix=row["prefix"]))
-            for h in hosts:
-                # row["p_dense"] is now available
-                # TODO: Need to add the module
-                tags.append(mod.make_tag(
-                    h["ip"],
-                    "dense",
-                    details=f'probability: {row["p_dense"]:.3f}'
-                ))
-            mod.repo().tag(*tags)
-            pbar.update(1)
+    if SAMPLE > 0:
+        dense_df = stream_condensation(mod, SAMPLE)
+    else:
+        prefixes = repo.get_connection().execute(query_prefix_hosts()).df()
+        model_condensation(prefixes, SEED)
+        desc = describe_condensation(prefixes)
+        save(repo.get_connection(), "condensation_summary", desc)
+
+        # Filter rows instead of just prefixes
+        dense_df = prefixes[prefixes["p_dense"] > DENSE_THRESHOLD]
+    n = tag_dense(mod, dense_df)
+    print(f"condensation: tagged {n} hosts in {len(dense_df)} dense prefixes")
 
 def condensation_init(mod: Module) -> None:
     mod.register_tag("dense", "Condensation model to estimate whether a prefix is abnormally populated based on how dense other prefixes of similar size are")
\ No newline at end of file
@@ -1,132 +1,207 @@
 from dice.module import Module
-from tdigest import TDigest
+from dataclasses import dataclass
 
 import dice.query as dq
+import pandas as pd
+import json
+import os
+
+from mods.noise.factory import NoiseEvaluator, NoiseEvaluatorFactory, bulk_evaluated, run_evaluators
+from mods.noise.honeypot import HoneypotSignature, SignatureIndex, get_honeypot_signatures, make_signature_factory
+from mods.noise.helpers import percentile_expr
+from mods.iec104.query import SCANNED_CAS, unnest_iec104_ioas
+from mods.tagger import tag_query, tag_fingerprints
+
+type Bounds = tuple[int | None, int | None]
+
+@dataclass
+class AletheiaRule:
+    "TCP window and scaling factor ranges of a hosting fingerprint. Bounds are inclusive, None leaves them open"
+    details: str
+    window: Bounds = (None, None)
+    wscale: Bounds = (None, None)
+
+ALETHEIA_RULES = [
+    AletheiaRule("0 window", window=(None, 0)),
+    AletheiaRule("python", window=(6370, 6379), wscale=(64, 64)),
+    AletheiaRule("cloud", window=(502, 509), wscale=(128, 256)),
+    AletheiaRule("cloud", window=(64_240, 65_152), wscale=(128, 256)),
+]
+
+# extra rule files, separated like PATH
+ALETHEIA_RULES_FILES = os.environ.get("DICE_ALETHEIA_RULES", "")
+
+# hosts with more open ports than this percentile of all hosts are telescopes
+TELESCOPE_PERCENTILE = float(os.environ.get("DICE_TELESCOPE_PERCENTILE", "75"))
+
+@dataclass
+class IdentitySpec:
+    """
+    Identity fields of the fingerprints of a protocol, as SQL expressions over the `f` alias.
+    Services of different hosts sharing all of them form a cluster.
+    """
+    protocol: str
+    fields: dict[str, str]
+    details: str
+    min_hosts: int = 2
+
+# the identity lives in the first CIP item of the ListIdentity response
+ENIP_IDENTITY = IdentitySpec("ethernetip", {
+    "serial": "json_extract_string(CAST(f.data_items AS JSON), '$[0].serial')",
+    "vendor_id": "json_extract_string(CAST(f.data_items AS JSON), '$[0].vendor_id')",
+    "product_code": "json_extract_string(CAST(f.data_items AS JSON), '$[0].product_code')",
+}, "reused serial")
+
+# NOTE: there is no Modbus identity, the MEI basic device identification objects
+# (vendor, product code, revision) are the same on every device of a product
+
+def query_identity_clusters(spec: IdentitySpec) -> str:
+    "Fingerprints sharing their identity with other hosts, with the number of hosts in the cluster"
+    fields = ", ".join(f"{expr} AS {name}" for name, expr in spec.fields.items())
+    names = ", ".join(spec.fields)
+    filled = " AND ".join(f"{name} IS NOT NULL" for name in spec.fields)
+    return f"""
+    WITH identities AS (
+        SELECT f.id, f.host, {fields}
+        FROM fingerprints AS f
+        WHERE f.protocol = '{spec.protocol}'
+    ),
+    clusters AS (
+        SELECT id, COUNT(DISTINCT host) OVER (PARTITION BY {names}) AS hosts
+        FROM identities
+        WHERE {filled}
+    )
+    SELECT id, printf('{spec.details}: shared by %d hosts', hosts) AS details
+    FROM clusters
+    WHERE hosts >= {int(spec.min_hosts)}
+    """
 
-from mods.noise.factory import NoiseEvaluator, NoiseEvaluatorFactory, NoiseHandlerFactory
-
-def model_host_ports(ports) -> TDigest: 
-    digest = TDigest()
-    for r in ports:
-        digest.update(r["count"])
-    return digest
-
-def default_ev_odd(_) -> None: return
+def identity_odd(mod: Module, spec: IdentitySpec) -> NoiseEvaluator:
+    "Tags every fingerprint whose identity is shared with other hosts, in a single write"
+    n = tag_fingerprints(mod, "odd", query_identity_clusters(spec))
+    print(f"{spec.protocol}: tagged {n} services sharing their identity")
+    return bulk_evaluated
 
 def enip_odd(mod: Module) -> NoiseEvaluator:
-    # TODO: this is only once to fix serials
-    q_serial = """
-        SELECT f.serial, COUNT(f.serial) AS count
-        FROM fingerprints as f
-        WHERE f.protocol == "enip"
-            AND count > 1
-        GROUP BY f.serial;
-    """
-    for fp in mod.query(q_serial):
-        mod.tag_fp(fp, "odd", "reused serial")
-    return default_ev_odd
+    return identity_odd(mod, ENIP_IDENTITY)
 
-def iec_odd(mod: Module) -> NoiseEvaluator:
+def iec_odd(mod: Module, scanned: list[int] = SCANNED_CAS) -> NoiseEvaluator:
     """
     Flags 2 behaviors:
-    - contains type 100 for CAs 1,2, and 10 (the ones scan for normally)
+    - contains type 100 for the scanned CAs (1, 2, and 10 normally)
     - same IOA responds multiple times with the same value
     """
-    # TODO: this should be an argument. Others may scan differently
-    scanned = [1,2,10,65535]
-    f100 = lambda asdu: asdu["TypeID"] == 100 and asdu["CA"] in scanned
-    f36 = lambda asdu: asdu["TypeID"] == 36
-
-    def ev(fp) -> None:
-        ioas = {}
-        if asdus := fp.get("interrogation", []):
-            if len(list(filter(f100, asdus))) >= int(len(scanned)*.75):
-                mod.tag_fp(fp, "odd", "too many filled addresses")
-                return
-
-            for asdu in list(filter(f36, asdus)):
-                for ioa in asdu.get("IOAs", []):
-                    addr=ioa["Address"]
-                    if addr not in ioas:
-                        ioa[addr] = []
-                    
-                    v = ioa["Data"]
-                    if v not in ioa[addr]:
-                        ioa[addr].append(v)
-                        continue
-
-                    mod.tag_fp(fp, "odd", f'IOA responds multiple times with the same value+timestamp: {addr} "{v}"')
-                    return
-    return ev
+    ioas = unnest_iec104_ioas(mod.repo())
+    q = f"""
+    WITH filled AS (
+        SELECT fingerprint
+        FROM {ioas}
+        GROUP BY fingerprint
+        HAVING COUNT(DISTINCT asdu) FILTER (WHERE type_id = 100 AND list_contains(?, ca)) >= ?
+    ),
+    repeated AS (
+        SELECT fingerprint, address, value
+        FROM {ioas}
+        WHERE type_id = 36 AND address IS NOT NULL
+        GROUP BY fingerprint, address, value
+        HAVING COUNT(*) > 1
+    )
+    SELECT fingerprint AS id, 'too many filled addresses' AS details
+    FROM filled
+    UNION ALL
+    SELECT fingerprint AS id, printf('IOA responds multiple times with the same value+timestamp: %d "%s"', min(address), arg_min(value, address)) AS details
+    FROM repeated
+    WHERE fingerprint NOT IN (SELECT fingerprint FROM filled)
+    GROUP BY fingerprint
+    """
+    # 3 quarters of the scanned CAs rounded down as before, at least one
+    n = tag_fingerprints(mod, "odd", q, [scanned, max(1, int(len(scanned) * .75))])
+    print(f"iec104: tagged {n} odd services")
+    return bulk_evaluated
 
 def make_odd_service_factory(mod: Module) -> NoiseEvaluatorFactory:
-    factory = NoiseEvaluatorFactory(mod)
+    factory = NoiseEvaluatorFactory(mod, "odd")
     return factory \
-        .add("enip", enip_odd) \
+        .add("ethernetip", enip_odd) \
         .add("iec104", iec_odd)
 
-def make_honeypot_factory(mod: Module) -> NoiseHandlerFactory:
-    factory = NoiseHandlerFactory(mod)
-    return factory \
-        .add("cowrie", cowrie_hp) \
-        .add("conpot", conpot_hp)
+def make_honeypot_factory(mod: Module, index: SignatureIndex) -> NoiseEvaluatorFactory:
+    "Evaluators of the protocols with honeypot signatures (conpot, ...)"
+    return make_signature_factory(mod, index)
 
-def aletheia_tag(mod: Module) -> None:
-    '''hosting fingerprinting TCP window-based and scaling factor'''
-    # ZMap records: window size and scaling factor
-    q_not = dq.query_db("records_zmap",
-        window__lte=0,
-    )
+def to_bounds(v) -> Bounds:
+    "A single value is an exact match, a pair are the bounds"
+    if v is None:
+        return (None, None)
+    if isinstance(v, (int, float)):
+        return (int(v), int(v))
+    lo, hi = v
+    return (lo, hi)
 
-    q_python = dq.query_db(
-        "records_zmap",
-        window__bt=[6370,6379],
-        tcpopt_wscale=64,
-    )
-
-    q_cloud = dq.query_db(
-        "records_zmap",
-        window__bt=[502,509],
-        tcpopt_wscale__bt=[128,256], 
-    )
+def load_aletheia_rules(path: str) -> list[AletheiaRule]:
+    """
+    Rules from a JSON list of objects like
+    {"details": "cloud", "window": [502, 509], "wscale": [128, 256]}
+    """
+    with open(path) as f:
+        rules = json.load(f)
+    return [AletheiaRule(r["details"], to_bounds(r.get("window")), to_bounds(r.get("wscale"))) for r in rules]
 
-    q_cloud_2 = dq.query_db(
-        "records_zmap",
-        window__bt=[64_240,65_152],
-        tcpopt_wscale__bt=[128,256], 
-    )
+def get_aletheia_rules(files: str = ALETHEIA_RULES_FILES) -> list[AletheiaRule]:
+    rules = list(ALETHEIA_RULES)
+    for path in filter(None, files.split(os.pathsep)):
+        rules.extend(load_aletheia_rules(path))
+    return rules
 
-    for q, d in [(q_not, "0 window"), (q_python, "python"), (q_cloud, "cloud"), (q_cloud_2, "cloud")]:
-        hosts = mod.query(q)
-        for h in hosts:
-            mod.tag(h["saddr"], "aletheia", details=d, port=h["dport"])
+def aletheia_tag(mod: Module, rules: list[AletheiaRule] | None = None) -> None:
+    '''hosting fingerprinting TCP window-based and scaling factor'''
+    rules = rules if rules is not None else get_aletheia_rules()
+    conn = mod.repo().get_connection()
+    conn.register("aletheia_rules", pd.DataFrame({
+        "details": [r.details for r in rules],
+        "window_lo": pd.array([r.window[0] for r in rules], dtype="Int64"),
+        "window_hi": pd.array([r.window[1] for r in rules], dtype="Int64"),
+        "wscale_lo": pd.array([r.wscale[0] for r in rules], dtype="Int64"),
+        "wscale_hi": pd.array([r.wscale[1] for r in rules], dtype="Int64"),
+    }))
+
+    # ZMap records: window size and scaling factor, every rule matched in a single scan
+    q = """
+    SELECT z.saddr AS host, z.dport AS port, r.details
+    FROM records_zmap AS z
+    JOIN aletheia_rules AS r
+        ON (r.window_lo IS NULL OR z."window" >= r.window_lo)
+        AND (r.window_hi IS NULL OR z."window" <= r.window_hi)
+        AND (r.wscale_lo IS NULL OR z.tcpopt_wscale >= r.wscale_lo)
+        AND (r.wscale_hi IS NULL OR z.tcpopt_wscale <= r.wscale_hi)
+    """
+    try:
+        n = tag_query(mod, "aletheia", q, cols=["details", "port"])
+        print(f"aletheia: tagged {n} services")
+    finally:
+        conn.unregister("aletheia_rules")
 
-def telescope_tag(mod: Module) -> None:
+def telescope_tag(mod: Module, pct: float = TELESCOPE_PERCENTILE) -> None:
     'Telescopes do not host any service, but appear to have open ports to receive unsolicited traffic'
-    repo = mod.repo()
-    ports = repo.query(dq.query_zmap_ports())
-
-    model = model_host_ports(ports)
-    threshold =  model.percentile(75)
-    for h in repo.query(dq.query_zmap_ports(count__gt=threshold)):
-        mod.tag(h["ip"], "telescope")
+    q = f"""
+    WITH ports AS ({dq.query_zmap_ports()}),
+    threshold AS (SELECT {percentile_expr("count", pct)} AS value FROM ports)
+    SELECT p.ip AS host
+    FROM ports AS p, threshold AS t
+    WHERE p.count > t.value
+    """
+    n = tag_query(mod, "telescope", q, cols=[])
+    print(f"telescope: tagged {n} hosts above the {pct:g}th percentile of open ports")
 
 def odd_tag(mod: Module) -> None:
     'Test for displacement, weird services'
-    factory = make_odd_service_factory(mod)
-
-    for p in factory.supported():
-        ev = factory.get(p)
-        if not ev:
-            raise Exception(f"evaluator supported but not found: {p}")
-        
-        for fp in mod.query(dq.query_db("fingerprints", protocol=p)):
-            ev(fp)
-
-def honeypot_tag(mod: Module) -> None:
-    factory = make_honeypot_factory(mod)
-    for ev in factory.build_all():
-        ev()
+    run_evaluators(mod, make_odd_service_factory(mod))
+
+def honeypot_tag(mod: Module, signatures: list[HoneypotSignature] | None = None) -> None:
+    'Default identities and banners of known honeypots, every signature matched in a single scan'
+    index = SignatureIndex(signatures if signatures is not None else get_honeypot_signatures())
+    run_evaluators(mod, make_honeypot_factory(mod, index))
+    print(index.summary())
 
 def tag_displaced(mod: Module) -> None:
     '''
@@ -1,16 +1,28 @@
 from dice.module import Module
+from mods.tagger import count_tags
 
 from typing import Callable, Any, Generic, TypeVar
+from dataclasses import dataclass
+from tqdm import tqdm
+
+import pandas as pd
+import time
 
 type EvaluatorWrapper = Callable[[Module], NoiseEvaluator]
+# evaluates one fingerprint, or a whole chunk of fingerprints of a protocol when registered with `add_chunk`
 type NoiseEvaluator = Callable[[Any], None]
 type NoiseHandler = Callable[[Module], None]
 
 T = TypeVar('T')
 
+def bulk_evaluated(_: Any) -> None:
+    "Evaluator of protocols its builder already evaluated over all the fingerprints at once"
+    return
+
 class NoiseGenericFactory(Generic[T]):
-    def __init__(self, mod: Module):
+    def __init__(self, mod: Module, name: str = ""):
         self.mod = mod
+        self.name = name
         self._cache: dict[str, T] = {}
         self._builders: dict[str, Callable] = {}
         self._default: T | None = None
@@ -37,15 +49,34 @@ class NoiseGenericFactory(Generic[T]):
         return list(self._builders.keys())
 
 class NoiseEvaluatorFactory(NoiseGenericFactory[NoiseEvaluator]):
-    def add(self, name: str, ev: EvaluatorWrapper | NoiseEvaluator) -> 'NoiseEvaluatorFactory':
-        match ev:
-            case EvaluatorWrapper.__value__:
-                self._builders[name] = lambda _: ev(self.mod)
-            case NoiseEvaluator.__value__:
-                self._builders[name] = lambda _: ev
+    def __init__(self, mod: Module, name: str = ""):
+        super().__init__(mod, name)
+        self._chunked: set[str] = set()
+
+    def add(self, name: str, ev: EvaluatorWrapper) -> 'NoiseEvaluatorFactory':
+        "Register the builder of the fingerprint evaluator of a protocol"
+        # NOTE: callables cannot be told apart by their signature at runtime,
+        # plain evaluators are registered with `add_evaluator`
+        self._builders[name] = lambda mod: ev(mod)
+        self._chunked.discard(name)
+        self._cache.pop(name, None)
+        return self
+
+    def add_evaluator(self, name: str, ev: NoiseEvaluator) -> 'NoiseEvaluatorFactory':
+        self._builders[name] = lambda _: ev
+        self._chunked.discard(name)
         self._cache.pop(name, None)
         return self
 
+    def add_chunk(self, name: str, ev: EvaluatorWrapper) -> 'NoiseEvaluatorFactory':
+        "Register the builder of an evaluator taking whole chunks of fingerprints as a DataFrame"
+        self.add(name, ev)
+        self._chunked.add(name)
+        return self
+
+    def is_chunked(self, name: str) -> bool:
+        return name in self._chunked
+
 class NoiseHandlerFactory(NoiseGenericFactory[NoiseHandler]):
     def add(self, name: str, h: NoiseHandler) -> 'NoiseHandlerFactory':
         self._builders[name] = lambda _: h(self.mod)
@@ -59,4 +90,76 @@ class NoiseHandlerFactory(NoiseGenericFactory[NoiseHandler]):
         r = []
         for n in self.get_builders():
             r.append(self.build(n))
-        return r
\ No newline at end of file
+        return r
+
+@dataclass
+class EvaluatorRun:
+    factory: str
+    protocol: str
+    evaluate: NoiseEvaluator
+    chunked: bool
+    build_time: float = 0.
+    eval_time: float = 0.
+    rows: int = 0
+    tags: int = 0
+
+    def summary(self) -> str:
+        return (
+            f"{self.factory or 'noise'} {self.protocol}: build {self.build_time:.3f}s, "
+            f"eval {self.eval_time:.3f}s, {self.rows} rows, {self.tags} tags"
+        )
+
+def run_evaluators(mod: Module, *factories: NoiseEvaluatorFactory) -> list[EvaluatorRun]:
+    """
+    Run the evaluators of every factory over a single scan of the fingerprints.
+    Each chunk is split by protocol and handed to every evaluator of that protocol,
+    row by row or as a whole DataFrame for chunk evaluators.
+    Evaluators done by their builder are not given any rows.
+    Reports the time and the tags of each evaluator.
+
+    NOTE: the odd service and tarpit evaluators are all done by their builder,
+    only the honeypot signatures still scan the fingerprints, as chunks.
+    Row evaluators are kept for the evaluators registered with `add` and `add_evaluator`.
+    """
+    repo = mod.repo()
+    runs: list[EvaluatorRun] = []
+    for factory in factories:
+        for p in factory.supported():
+            start, before = time.perf_counter(), count_tags(mod)
+            ev = factory.get(p)
+            if not ev:
+                raise Exception(f"evaluator supported but not found: {p}")
+            run = EvaluatorRun(factory.name, p, ev, factory.is_chunked(p))
+            run.build_time = time.perf_counter() - start
+            run.tags = count_tags(mod) - before
+            runs.append(run)
+
+    pending: dict[str, list[EvaluatorRun]] = {}
+    for run in runs:
+        if run.evaluate is not bulk_evaluated:
+            pending.setdefault(run.protocol, []).append(run)
+
+    if pending:
+        protocols = ", ".join("'" + p.replace("'", "''") + "'" for p in pending)
+        q = f"SELECT * FROM fingerprints WHERE protocol IN ({protocols})"
+        t, gen = repo.queryb(q)
+        with tqdm(total=t, desc="evaluators") as pbar:
+            for b in gen:
+                for p, df in b.groupby("protocol", sort=False):
+                    rows = None
+                    for run in pending.get(str(p), []):
+                        start, before = time.perf_counter(), count_tags(mod)
+                        if run.chunked:
+                            run.evaluate(df)
+                        else:
+                            rows = rows if rows is not None else df.to_dict("records")
+                            for fp in rows:
+                                run.evaluate(fp)
+                        run.eval_time += time.perf_counter() - start
+                        run.tags += count_tags(mod) - before
+                        run.rows += len(df.index)
+                pbar.update(len(b.index))
+
+    for run in runs:
+        print(run.summary())
+    return runs
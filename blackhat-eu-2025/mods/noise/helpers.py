@@ -0,0 +1,16 @@
+from dice.repo import Repository
+
+import os
+
+# approximate quantiles are cheaper on large tables, exact ones match the previous digests closer
+APPROX_QUANTILE = os.environ.get("DICE_APPROX_QUANTILE", "0") == "1"
+
+def percentile_expr(col: str, pct: float, approx: bool = APPROX_QUANTILE) -> str:
+    "Aggregate computing the percentile (0-100) of a column"
+    agg = "approx_quantile" if approx else "quantile_cont"
+    return f"{agg}({col}, {float(pct) / 100})"
+
+def query_percentile(repo: Repository, q: str, col: str, pct: float, approx: bool = APPROX_QUANTILE) -> float | None:
+    "Percentile (0-100) of a column of a query, computed by the database. None without rows"
+    res = repo.get_connection().execute(f"SELECT {percentile_expr(col, pct, approx)} FROM ({q}) AS t").fetchone()
+    return float(res[0]) if res and res[0] is not None else None
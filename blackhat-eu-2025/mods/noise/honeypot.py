@@ -0,0 +1,215 @@
+from dice.module import Module
+from dataclasses import dataclass, field
+from collections import Counter
+from typing import Any
+
+from mods.noise.factory import NoiseEvaluator, NoiseEvaluatorFactory
+
+import pandas as pd
+import json
+import re
+import os
+
+# default signatures, shipped next to this module
+HONEYPOT_SIGNATURES = os.path.join(os.path.dirname(__file__), "honeypots.json")
+# extra signature files, separated like PATH
+HONEYPOT_SIGNATURES_FILES = os.environ.get("DICE_HONEYPOT_SIGNATURES", "")
+
+@dataclass
+class HoneypotSignature:
+    """
+    Default identity or banner of a honeypot, over the data fields of the fingerprints of a protocol.
+    Fields are paths into the data columns, e.g. `items.0.serial`. A `*` step collects every
+    element of a list and matches it as a set.
+    """
+    name: str
+    protocol: str
+    details: str
+    # exact values of identity fields
+    match: dict[str, Any] = field(default_factory=dict)
+    # banner field and the regex matching it
+    banner: str = ""
+    regex: str = ""
+
+    def __post_init__(self) -> None:
+        if self.regex:
+            check_banner_regex(self.name, self.protocol, self.regex)
+
+def _has_group_reference(regex: str) -> bool:
+    "Whether the regex refers to one of its groups, as a backreference or a conditional"
+    i, in_class = 0, False
+    while i < len(regex):
+        c = regex[i]
+        if c == "\\":
+            # inside a class, or \0, digits are octal escapes
+            nxt = regex[i+1:i+2]
+            if not in_class and nxt.isdigit() and nxt != "0":
+                return True
+            i += 2
+            continue
+        if in_class:
+            in_class = c != "]"
+        elif c == "[":
+            in_class = True
+            # a leading ] is part of the class
+            if regex[i+1:i+2] == "]":
+                i += 1
+            elif regex[i+1:i+3] == "^]":
+                i += 2
+        elif regex.startswith("(?P=", i) or regex.startswith("(?(", i):
+            return True
+        i += 1
+    return False
+
+def check_banner_regex(name: str, protocol: str, regex: str) -> None:
+    """
+    Banners of a field are matched with a single regex, each one wrapped in a named group.
+    Their own named groups would clash or shadow the signature group, and backreferences
+    would point at the wrong group once they are combined, so neither is allowed.
+    """
+    try:
+        compiled = re.compile(regex)
+    except re.error as e:
+        raise ValueError(f"honeypot signature {name} ({protocol}): invalid regex {regex!r}: {e}") from e
+    if compiled.groupindex:
+        groups = ", ".join(compiled.groupindex)
+        raise ValueError(f"honeypot signature {name} ({protocol}): regex {regex!r} has named groups ({groups}), use (?:...) instead")
+    if _has_group_reference(regex):
+        raise ValueError(f"honeypot signature {name} ({protocol}): regex {regex!r} refers to its own groups, backreferences cannot be combined")
+
+def normalize(v: Any) -> Any:
+    "Hashable form of a value, so identities compare the same coming from JSON or from the database"
+    v = _decode(v)
+    if v is None or (isinstance(v, float) and v != v):
+        return None
+    if isinstance(v, (list, tuple, set, frozenset)):
+        return frozenset(normalize(i) for i in v)
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+def _decode(v: Any) -> Any:
+    "Python value of JSON strings and numpy values"
+    if hasattr(v, "tolist"):
+        return v.tolist()
+    if isinstance(v, str) and v[:1] in ("[", "{"):
+        try:
+            return json.loads(v)
+        except ValueError:
+            return v
+    return v
+
+def _walk(v: Any, steps: list[str]) -> Any:
+    for i, step in enumerate(steps):
+        v = _decode(v)
+        if step == "*":
+            if not isinstance(v, list):
+                return None
+            return [_walk(item, steps[i+1:]) for item in v]
+        if isinstance(v, list):
+            v = v[int(step)] if step.isdigit() and int(step) < len(v) else None
+        elif isinstance(v, dict):
+            v = v.get(step)
+        else:
+            return None
+    return v
+
+def field_value(fp: dict[str, Any], path: str) -> Any:
+    "Normalized value of a field path of a fingerprint row, None when it is missing"
+    col, *steps = path.split(".")
+    return normalize(_walk(fp.get(f"data_{col}"), steps))
+
+class SignatureIndex:
+    """
+    Signatures compiled for a single pass over the fingerprints.
+    Identities are hash lookups on the tuple of their fields, grouped by the fields they use.
+    The banners of a field are matched with one combined regex, the group that matched
+    tells the signature apart.
+    """
+
+    def __init__(self, signatures: list[HoneypotSignature]):
+        self.identities: dict[str, dict[tuple[str, ...], dict[tuple, HoneypotSignature]]] = {}
+        self.banners: dict[str, dict[str, tuple[re.Pattern, dict[str, HoneypotSignature]]]] = {}
+        self.hits: Counter[str] = Counter()
+
+        patterns: dict[str, dict[str, list[HoneypotSignature]]] = {}
+        for s in signatures:
+            if s.match:
+                fields = tuple(sorted(s.match))
+                key = tuple(normalize(s.match[f]) for f in fields)
+                self.identities.setdefault(s.protocol, {}).setdefault(fields, {})[key] = s
+            if s.banner and s.regex:
+                patterns.setdefault(s.protocol, {}).setdefault(s.banner, []).append(s)
+
+        for protocol, fields in patterns.items():
+            for f, sigs in fields.items():
+                groups = {f"s{i}": s for i, s in enumerate(sigs)}
+                combined = re.compile("|".join(f"(?P<{g}>{s.regex})" for g, s in groups.items()))
+                self.banners.setdefault(protocol, {})[f] = (combined, groups)
+
+    def protocols(self) -> list[str]:
+        return sorted(set(self.identities) | set(self.banners))
+
+    def match(self, protocol: str, fp: dict[str, Any]) -> list[HoneypotSignature]:
+        "Signatures a fingerprint row of a protocol matches"
+        found = []
+        for fields, table in self.identities.get(protocol, {}).items():
+            if (s := table.get(tuple(field_value(fp, f) for f in fields))) is not None:
+                found.append(s)
+        for f, (combined, groups) in self.banners.get(protocol, {}).items():
+            banner = field_value(fp, f)
+            if isinstance(banner, str) and (m := combined.search(banner)) and m.lastgroup:
+                found.append(groups[m.lastgroup])
+        return found
+
+    def columns(self, protocol: str) -> list[str]:
+        "Data columns the signatures of a protocol read"
+        fields = [f for fs in self.identities.get(protocol, {}) for f in fs] + list(self.banners.get(protocol, {}))
+        return sorted({f"data_{f.split('.')[0]}" for f in fields})
+
+    def evaluator(self, mod: Module, protocol: str) -> NoiseEvaluator:
+        "Chunk evaluator tagging the fingerprints of a protocol that match a signature"
+        # the chunks hold the data columns of every protocol, only the ones matched are turned into rows
+        cols = ["id", "host", "protocol", "port", *self.columns(protocol)]
+        def ev(df: pd.DataFrame) -> None:
+            for fp in df[[c for c in cols if c in df]].to_dict("records"):
+                for s in self.match(protocol, fp):
+                    self.hits[s.name] += 1
+                    mod.tag_fp(fp, "honeypot", s.details)
+        return ev
+
+    def summary(self) -> str:
+        hits = ", ".join(f"{n} {c}" for n, c in self.hits.most_common()) or "none"
+        return f"honeypot signatures matched: {hits}"
+
+def load_honeypot_signatures(path: str) -> list[HoneypotSignature]:
+    """
+    Signatures from a JSON list of objects like
+    {"name": "conpot", "protocol": "modbus", "details": "...", "match": {"vendor": "Siemens"}}
+    or, for banners, {"name": "cowrie", "protocol": "ssh", "details": "...", "banner": "banner", "regex": "^SSH-2.0-..."}
+    """
+    with open(path) as f:
+        signatures = json.load(f)
+    try:
+        return [HoneypotSignature(
+            s["name"],
+            s["protocol"],
+            s.get("details", s["name"]),
+            s.get("match", {}),
+            s.get("banner", ""),
+            s.get("regex", ""),
+        ) for s in signatures]
+    except ValueError as e:
+        raise ValueError(f"{path}: {e}") from e
+
+def get_honeypot_signatures(files: str = HONEYPOT_SIGNATURES_FILES) -> list[HoneypotSignature]:
+    signatures = load_honeypot_signatures(HONEYPOT_SIGNATURES)
+    for path in filter(None, files.split(os.pathsep)):
+        signatures.extend(load_honeypot_signatures(path))
+    return signatures
+
+def make_signature_factory(mod: Module, index: SignatureIndex) -> NoiseEvaluatorFactory:
+    factory = NoiseEvaluatorFactory(mod, "honeypot")
+    for p in index.protocols():
+        factory.add_chunk(p, lambda mod, p=p: index.evaluator(mod, p))
+    return factory
@@ -1,73 +1,85 @@
-import dice.query as dq
-
 from dice.module import Module
-from tdigest import TDigest
+from dice.repo import Repository
+
+from mods.noise.factory import NoiseEvaluator, NoiseEvaluatorFactory, bulk_evaluated, run_evaluators
+from mods.noise.helpers import percentile_expr
+from mods.iec104.query import unnest_iec104_ioas
+from mods.tagger import tag_fingerprints
+
+import os
 
-from mods.noise.factory import NoiseEvaluator, NoiseEvaluatorFactory
+# services above this percentile of the amount of data they send are tarpits
+TARPIT_PERCENTILE = float(os.environ.get("DICE_TARPIT_PERCENTILE", "95"))
 
 def is_timeout(fp) -> bool:
     return fp["status"] == "io-timeout" and fp["data"]
 
 def iec_tarpit(mod: Module) -> NoiseEvaluator:
-    'Calculate the distribution of IOAs and return when crosses the 95prc'
+    'Calculate the distribution of IOAs and flag the services crossing the 95prc'
+    ioas = unnest_iec104_ioas(mod.repo())
 
-    # TODO: update this query. Get only those with
-    # at least one ioa
-    q = """
-    SELECT ioas, COUNT(ioas) AS count
-    FROM fingerprints
-    WHERE protocol == "iec104";
+    # If the number of IOAs is very large, then flag this
+    q = f"""
+    WITH counts AS (
+        SELECT fingerprint, COUNT(address) AS count
+        FROM {ioas}
+        GROUP BY fingerprint
+    ),
+    threshold AS (SELECT {percentile_expr("count", TARPIT_PERCENTILE)} AS value FROM counts)
+    SELECT c.fingerprint AS id, 'too many IOAs' AS details
+    FROM counts AS c, threshold AS t
+    WHERE c.count > t.value
     """
-    digest = TDigest()
-    for r in mod.repo().query(q):
-        digest.update(r["count"])
+    n = tag_fingerprints(mod, "tarpit", q)
+    print(f"iec104: tagged {n} tarpits")
+    return bulk_evaluated
 
-    threshold = digest.percentile(95)
-    def ev(fp) -> None:
-        # If it timed out and the number of IOAs with type 36 (M_ME_TF_1), a measured value with timestamp
-        # is very large, then flag this
-        if len(fp["interrogation"]) > threshold:
-            mod.tag_fp(fp, "tarpit", "too many IOAs")
-    return ev
+# fields of the MEI response that are not objects, the modbus fingerprinter spreads both into the data columns
+MEI_FIELDS = ["conformity_level", "more_follows", "next_object_id", "object_count", "unit_id"]
+# 5 is the minimum required objects in the
+# mei response
+MIN_REQUIRED = 5
+
+def data_columns(repo: Repository) -> list[str]:
+    cols = repo.get_connection().execute("SELECT column_name FROM (DESCRIBE fingerprints)").fetchall()
+    return [c for c, in cols if c.startswith("data_")]
+
+def object_count_expr(cols: list[str], alias: str = "f") -> str:
+    "Number of objects of a modbus fingerprint, as its non NULL data columns holding MEI objects"
+    objects = [c for c in cols if c.removeprefix("data_") not in MEI_FIELDS]
+    return " + ".join(f'CAST({alias}."{c}" IS NOT NULL AS INTEGER)' for c in objects) or "0"
 
 def modbus_tarpit(mod: Module) -> NoiseEvaluator:
-    'Too many objects in the mei response'
-    
-    # TODO: at least one object and more follows
-    q = """
-    SELECT objects, COUNT(objects) AS count
-    FROM fingerprints
-    WHERE protocol == "modbus"
-    AND more_follows == True;
+    'Too many objects in the mei response, and more follow'
+    cols = data_columns(mod.repo())
+    if "data_more_follows" not in cols:
+        print("modbus: no MEI response says more objects follow")
+        return bulk_evaluated
+
+    # every other protocol leaves the object columns NULL in the modbus fingerprints.
+    # The percentile is the one of the responses where more objects follow
+    q = f"""
+    WITH counts AS (
+        SELECT f.id, {object_count_expr(cols)} AS count
+        FROM fingerprints AS f
+        WHERE f.protocol = 'modbus' AND TRY_CAST(f.data_more_follows AS BOOLEAN)
+    ),
+    threshold AS (SELECT greatest({percentile_expr("count", TARPIT_PERCENTILE)}, {MIN_REQUIRED}) AS value FROM counts)
+    SELECT c.id, 'too many objects. More follows' AS details
+    FROM counts AS c, threshold AS t
+    WHERE c.count > t.value
     """
+    n = tag_fingerprints(mod, "tarpit", q)
+    print(f"modbus: tagged {n} tarpits")
+    return bulk_evaluated
 
-    digest = TDigest()
-    for r in mod.repo().query(q):
-        digest.update(r["count"])
-    threshold = digest.percentile(95)
-    # 5 is the minimum required objects in the
-    # mei response
-    MIN_REQUIRED = 5
-    if threshold < MIN_REQUIRED: threshold = MIN_REQUIRED
-    def ev(fp) -> None:
-        if len(fp["objects"]) > threshold:
-            mod.tag_fp(fp, "tarpit", "too many objects. More follows")
-    return ev
-        
 def make_tarpit_factory(mod: Module) -> NoiseEvaluatorFactory:
-    factory = NoiseEvaluatorFactory(mod)
+    factory = NoiseEvaluatorFactory(mod, "tarpit")
     return factory.add("iec104", iec_tarpit).add("modbus", modbus_tarpit)
 
 def tarpit_tag(mod: Module) -> None:
-    factory = make_tarpit_factory(mod)
     # TODO: need to add status into the fps
-    for p in factory.supported():
-        ev = factory.get(p)
-        if not ev:
-            raise Exception(f"evaluator supported but not found: {p}")
-        
-        for fp in mod.query(dq.query_db("fingerprints", protocol=p)):
-            ev(fp)
+    run_evaluators(mod, make_tarpit_factory(mod))
 
 def tag_hostile(mod: Module) -> None: 
     'Test for tarpits and things sending us bad stuff'
@@ -1,20 +1,158 @@
-from dice.module import ModuleHandler, Module, new_module
+from dice.module import ModuleHandler, Module, Repository, new_module
 from dice.config import TAGGER
-from typing import Callable
+from typing import Any, Callable, Generator
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from mods.tagger import BufferedModule, TagBuffer, buffered, tag_buffer
 from mods.noise.condensation import tag_condensed, condensation_init
 from mods.noise.volatility import tag_volatile, volatility_init
 from mods.noise.hostility import hostility_init, tag_hostile
-from mods.noise.displacement import tag_displaced, displacement_init
+from mods.noise.displacement import tag_displaced, displacement_init, honeypot_tag, aletheia_tag, telescope_tag, odd_tag
+from tqdm import tqdm
+
+import time
+import os
 
 type NoiseTag = Callable[[Module], None]
 
+# threads running the displacement taggers at once. The default, 1, runs them one after the other:
+# the threads are not faster on a single CPU, more cores were not measured
+WORKERS = int(os.environ.get("DICE_NOISE_WORKERS", "1"))
+
+# displacement taggers only read the database, besides their tags.
+# Condensation and volatility create tables of their own, they stay separate modules.
+DISPLACEMENT_TAGGERS: dict[str, NoiseTag] = {
+    "honeypot": honeypot_tag,
+    "aletheia": aletheia_tag,
+    "telescope": telescope_tag,
+    "odd": odd_tag,
+}
+
+class ConcurrentRepo:
+    """
+    Repository of a tagger running in a thread. SQL runs on a cursor of its own,
+    any other call holds the buffer lock, the repository is not thread-safe.
+    Streams only hold the lock while a chunk is fetched.
+    """
+
+    def __init__(self, repo: Repository, buffer: TagBuffer):
+        self._repo = repo
+        self._buffer = buffer
+        self._cursor = None
+
+    def get_connection(self):
+        if self._cursor is None:
+            with self._buffer.lock:
+                self._cursor = self._repo.get_connection().cursor()
+        return self._cursor
+
+    def queryb(self, *args: Any, **kwargs: Any) -> tuple[int, Generator]:
+        with self._buffer.lock:
+            t, gen = self._repo.queryb(*args, **kwargs)
+
+        def chunks() -> Generator:
+            try:
+                while True:
+                    with self._buffer.lock:
+                        b = next(gen, None)
+                    if b is None:
+                        return
+                    yield b
+            finally:
+                with self._buffer.lock:
+                    gen.close()
+        return t, chunks()
+
+    def close(self) -> None:
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._repo, name)
+        if not callable(attr):
+            return attr
+        return lambda *args, **kwargs: self._buffer.call(attr, *args, **kwargs)
+
+class ConcurrentModule(BufferedModule):
+    "Module handed to a tagger thread, its tags go through the shared buffer"
+
+    def __init__(self, mod: Module, buffer: TagBuffer):
+        super().__init__(mod, buffer)
+        self._repo = ConcurrentRepo(mod.repo(), buffer)
+
+    def repo(self) -> ConcurrentRepo:
+        return self._repo
+
+    def query(self, q: str) -> list:
+        with self.buffer.lock:
+            return list(self._mod.query(q))
+
+    def with_pbar(self, handler: Callable[[Any], None], q: str) -> None:
+        t, gen = self._repo.queryb(q)
+        with tqdm(total=t) as pbar:
+            for b in gen:
+                handler(b)
+                pbar.update(len(b.index))
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._mod, name)
+        if not callable(attr):
+            return attr
+        return lambda *args, **kwargs: self.buffer.call(attr, *args, **kwargs)
+
+def run_taggers(mod: Module, taggers: dict[str, NoiseTag], workers: int = WORKERS) -> float:
+    """
+    Runs taggers that only read the database at once, each one in a thread reading from its own cursor.
+    Tags are written through a single buffer. Returns the wall-clock time.
+    """
+    times: dict[str, float] = {}
+    errors: list[BaseException] = []
+    start = time.perf_counter()
+
+    # the tags of a buffered module already go through a buffer, share it
+    with tag_buffer(mod) or TagBuffer(mod) as buffer:
+        def run(name: str, tagger: NoiseTag) -> None:
+            t = time.perf_counter()
+            tmod = ConcurrentModule(mod, buffer)
+            try:
+                tagger(tmod)
+            finally:
+                tmod.repo().close()
+                times[name] = time.perf_counter() - t
+
+        with ThreadPoolExecutor(max(1, workers)) as pool:
+            futures = {pool.submit(run, n, t): n for n, t in taggers.items()}
+            for fut in as_completed(futures):
+                try:
+                    fut.result()
+                except Exception as e:
+                    print(f"tagger {futures[fut]} failed: {e}")
+                    errors.append(e)
+
+    wall = time.perf_counter() - start
+    for n, t in sorted(times.items(), key=lambda i: -i[1]):
+        print(f"  {n}: {t:.3f}s")
+    print(f"taggers: {wall:.3f}s wall-clock ({workers} workers)")
+
+    if errors:
+        raise errors[0]
+    return wall
+
+def tag_displaced_concurrently(mod: Module) -> None:
+    'Displacement taggers, at once'
+    run_taggers(mod, DISPLACEMENT_TAGGERS)
+
+def get_displacement_tag() -> NoiseTag:
+    "Displacement taggers one after the other, unless DICE_NOISE_WORKERS asks for threads"
+    return tag_displaced_concurrently if WORKERS > 1 else tag_displaced
+
 def get_noise_tag(noise: str) -> NoiseTag:
     match noise:
         case "condensation":
             return tag_condensed
         case "displacement":
-            return tag_displaced
+            return get_displacement_tag()
         case "hostility":
             return tag_hostile
         case "volatility":
@@ -23,13 +161,13 @@ def get_noise_tag(noise: str) -> NoiseTag:
             raise Exception(f"unknown noise source: {noise}")
 
 def make_noise_tag_handler(noise: str) -> ModuleHandler:
-    handler = get_noise_tag(noise)
+    handler = buffered(get_noise_tag(noise))
     return lambda mod: handler(mod)
 
 def make_tags() -> list[Module]:
     return [
-        new_module(TAGGER, "condensation", tag_condensed, condensation_init),
-        new_module(TAGGER, "displacement", tag_displaced, displacement_init),
-        new_module(TAGGER, "hostility", tag_hostile, hostility_init),
-        new_module(TAGGER, "volatile", tag_volatile, volatility_init),
-    ]
\ No newline at end of file
+        new_module(TAGGER, "condensation", buffered(tag_condensed), condensation_init),
+        new_module(TAGGER, "displacement", buffered(get_displacement_tag()), displacement_init),
+        new_module(TAGGER, "hostility", buffered(tag_hostile), hostility_init),
+        new_module(TAGGER, "volatile", buffered(tag_volatile), volatility_init),
+    ]
@@ -1,10 +1,16 @@
-from dice.module import Module
+from dice.module import Module, Repository
 from typing import Any, Generator
 from difflib import ndiff
+from itertools import chain
+
+from mods.tagger import bulk_tag, tag_query
 
 import pandas as pd
 import numpy as np
 
+# services seen more than once, with whether they changed or went (un)available between scans
+VOLATILE_TABLE = "volatile_services"
+
 def fmt_diff(*values: Any) -> str:
     """
     Returns a git-style diff of multiple values.
@@ -40,7 +46,8 @@ def is_equal(*vals: Any) -> bool:
             if not np.array_equal(np.asarray(first), np.asarray(other)):
                 return False
         else:
-            if first != other:
+            # missing values read from chunks are NaN, which never equals itself
+            if first != other and not (pd.isna(first) and pd.isna(other)):
                 return False
     return True
 
@@ -88,19 +95,80 @@ def pull_next(rows) -> Generator[tuple[dict, list[Any]], None, None]:
     if res:
         yield summary, res
 
-def mtd_tag(mod: Module) -> None:
+def fingerprint_columns(repo: Repository) -> list[str]:
     q = """
-    SELECT f.*
+    SELECT column_name
+    FROM information_schema.columns
+    WHERE table_name = 'fingerprints'
+    ORDER BY ordinal_position
+    """
+    return [r[0] for r in repo.get_connection().execute(q).fetchall()]
+
+def query_volatile_services(cols: list[str]) -> str:
+    """
+    Services scanned more than once whose data changed or that were not always available.
+    A data column changed when it has more than one distinct hash, NULLs included.
+    Scans are ordered by insertion, so the first row of a service is its first scan.
+    """
+    data = [c for c in cols if c.startswith("data_")]
+    if "data" in cols:
+        available = 'f."data" IS NOT NULL'
+    else:
+        available = "NOT (" + " AND ".join(f'f."{c}" IS NULL' for c in data) + ")" if data else "TRUE"
+    changed = " OR ".join(f'COUNT(DISTINCT hash(f."{c}")) > 1' for c in data) or "FALSE"
+
+    return f"""
+    SELECT
+        f.host, f.protocol, f.port,
+        COUNT(*) AS scans,
+        COUNT(*) FILTER (WHERE {available}) AS available,
+        arg_min({available}, f.rowid) AS first_available,
+        {changed} AS changed
     FROM fingerprints AS f
-    ORDER BY f.host, f.protocol, f.port;
+    GROUP BY f.host, f.protocol, f.port
+    HAVING COUNT(*) > 1
     """
-    rows = mod.repo().query(q)
-    for summary, fps in pull_next(rows):
-        if idet := eval_intermitent(fps):
-            mod.tag(summary["host"], "mtd-intermitent", idet, summary["protocol"], summary["port"])
 
-        if d := eval_diff(pd.DataFrame.from_records(fps)):
-            mod.tag(summary["host"], "mtd-different", d, summary["protocol"], summary["port"])
+def mtd_tag(mod: Module) -> None:
+    repo = mod.repo()
+    conn = repo.get_connection()
+    conn.execute(f"""
+    CREATE OR REPLACE TABLE {VOLATILE_TABLE} AS
+    SELECT * FROM ({query_volatile_services(fingerprint_columns(repo))})
+    WHERE changed OR (available > 0 AND available < scans)
+    """)
+
+    # a table rather than a temporary one, the changed services are read back through the repository
+    try:
+        # io-timeout, connection-timeout, or unknown-error?
+        q = f"""
+        SELECT host, protocol, port,
+            CASE WHEN first_available
+                THEN 'became unavailable after the first scan'
+                ELSE 'eventually became available'
+            END AS details
+        FROM {VOLATILE_TABLE}
+        WHERE available > 0 AND available < scans
+        """
+        n = tag_query(mod, "mtd-intermitent", q, cols=["details", "protocol", "port"])
+
+        # only the services that changed are read back to describe the changes
+        q = f"""
+        SELECT f.*
+        FROM fingerprints AS f
+        JOIN {VOLATILE_TABLE} AS v ON f.host = v.host AND f.protocol = v.protocol AND f.port = v.port
+        WHERE v.changed
+        ORDER BY f.host, f.protocol, f.port, f.rowid
+        """
+        _, gen = repo.queryb(q, normalize=False)
+        tags = []
+        for summary, fps in pull_next(chain.from_iterable(b.to_dict("records") for b in gen)):
+            if d := eval_diff(pd.DataFrame.from_records(fps)):
+                tags.append({**summary, "details": d})
+        bulk_tag(mod, pd.DataFrame(tags), "mtd-different")
+        print(f"volatility: {n} intermittent and {len(tags)} changed services")
+    finally:
+        conn.execute(f"DROP TABLE IF EXISTS {VOLATILE_TABLE}")
 
 def tag_volatile(mod: Module) -> None: 
     'Requires multiple scans to compare results'
@@ -0,0 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from typing import Any, Callable, Iterable, TypeVar
+
+import numpy as np
+import threading
+import requests
+import time
+import os
+
+API = os.environ.get("RIPESTAT_API", "https://stat.ripe.net/data")
+ENDPOINTS = {
+    "ris": "network-info/data.json",
+    "contact": "abuse-contact-finder/data.json",
+    "name": "as-names/data.json",
+    "prefixes": "maxmind-geo-lite-announced-by-as/data.json",
+}
+
+# status codes worth trying again
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+def retry_after(value: str | None) -> float:
+    "Seconds a Retry-After header asks to wait, given in seconds or as an HTTP date. 0 if missing or invalid"
+    if not value:
+        return 0.
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0.
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0., (when - datetime.now(timezone.utc)).total_seconds())
+
+class TokenBucket:
+    "Thread-safe token bucket, `rate` tokens per second up to `burst`"
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class RipeStatClient:
+    """
+    RIPEstat client sharing a pooled session between a number of threads.
+    Requests are rate limited with a token bucket and retried with exponential
+    backoff on 429 and 5xx responses.
+    """
+
+    def __init__(self, api: str = API, workers: int = 8, rate: float = 8., retries: int = 4, backoff: float = .5, timeout: float = 30.):
+        self.api = api
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = TokenBucket(rate, workers)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.lock = threading.Lock()
+        self.latencies: list[float] = []
+        self.retried = 0
+        self.failed = 0
+
+    def get(self, endpoint: str, params: dict[str, Any]) -> dict:
+        "Returns the JSON response of an endpoint, raises once retries run out"
+        url = "/".join([self.api, ENDPOINTS[endpoint]])
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            start = time.perf_counter()
+            try:
+                res = self.session.get(url, params=params, timeout=self.timeout)
+                retry = res.status_code in RETRY_STATUS
+                if not retry:
+                    res.raise_for_status()
+                    return res.json()
+                err: Exception = requests.HTTPError(f"{res.status_code} for {url}", response=res)
+                wait = retry_after(res.headers.get("Retry-After"))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                err, wait = e, 0.
+            except Exception:
+                with self.lock:
+                    self.failed += 1
+                raise
+            finally:
+                with self.lock:
+                    self.latencies.append(time.perf_counter() - start)
+
+            if attempt == self.retries:
+                break
+            with self.lock:
+                self.retried += 1
+            time.sleep(max(wait, self.backoff * 2 ** attempt))
+
+        with self.lock:
+            self.failed += 1
+        raise err
+
+    def map(self, fn: Callable[[T], R], items: Iterable[T]) -> list[R]:
+        "Apply fn to the items from the client threads, keeping their order"
+        items = list(items)
+        if len(items) < 2 or self.workers < 2:
+            return [fn(i) for i in items]
+        with ThreadPoolExecutor(self.workers) as pool:
+            return list(pool.map(fn, items))
+
+    def metrics(self) -> dict[str, float]:
+        with self.lock:
+            lat = np.array(self.latencies) if self.latencies else np.zeros(1)
+            return {
+                "requests": len(self.latencies),
+                "retried": self.retried,
+                "failed": self.failed,
+                "latency_p50": float(np.percentile(lat, 50)),
+                "latency_p95": float(np.percentile(lat, 95)),
+                "latency_max": float(lat.max()),
+            }
+
+    def summary(self) -> str:
+        m = self.metrics()
+        return (
+            f'{m["requests"]} requests ({m["retried"]} retried, {m["failed"]} failed), '
+            f'latency p50 {m["latency_p50"]:.3f}s p95 {m["latency_p95"]:.3f}s max {m["latency_max"]:.3f}s'
+        )
+
+def new_client() -> RipeStatClient:
+    return RipeStatClient(
+        workers=int(os.environ.get("RIPESTAT_WORKERS", "8")),
+        rate=float(os.environ.get("RIPESTAT_RATE", "8")),
+    )
@@ -1,17 +1,15 @@
 from dice.module import Module, ModuleHandler
-from mods.ripe.helpers import PrefixTree, build_resource_tree
-
-from typing import Any
+from mods.ripe.helpers import build_prefix_index
 
 import pandas as pd
 
-def fingerprint(mod: Module, row: pd.Series, tree: PrefixTree) -> Any:
-    if (fp := tree.get(row["ip"])) is not None:
-        mod.fingerprint(row, fp, "ripe")
-
 def make_asn_fp_handler(resources: pd.DataFrame) -> ModuleHandler:
-    tree = build_resource_tree(resources)
+    index = build_prefix_index(resources["prefix"].tolist())
+    meta = resources.to_dict("records")
     def handler(mod: Module) -> None:
         recs = mod.repo().get_records(normalize=False, source="zgrab2")
-        recs.apply(lambda r: fingerprint(mod, r, tree), axis=1)
+        pos = index.lookup(recs["ip"].to_numpy())
+        hit = pos >= 0
+        for (_, r), p in zip(recs[hit].iterrows(), pos[hit].tolist()):
+            mod.fingerprint(r, meta[p], "ripe")
     return handler
\ No newline at end of file
@@ -1,27 +1,228 @@
 import pandas as pd
+import numpy as np
 import pytricia
+import ipaddress
+import tempfile
+import shutil
+import json
+import os
 
 class PrefixTree:
     """A fast prefix tree using PyTricia."""
 
     def __init__(self):
-        # PyTricia tree for IPv4 and IPv6
-        self.tree = pytricia.PyTricia(32)  # use 128 for IPv6 if needed
+        # PyTricia trees for IPv4 and IPv6
+        self.v4 = pytricia.PyTricia(32)
+        self.v6 = pytricia.PyTricia(128)
+
+    def _tree(self, key: str) -> pytricia.PyTricia:
+        return self.v6 if ":" in key else self.v4
 
     def add(self, prefix: str, value):
-        """Add a prefix with an associated value."""
-        self.tree[prefix] = value
+        """Add a prefix with an associated value, raises a ValueError if it is not a valid prefix."""
+        # PyTricia clamps lengths out of range and fails with a SystemError on some malformed addresses
+        ipaddress.ip_network(prefix, strict=False)
+        self._tree(prefix)[prefix] = value
 
     def get(self, addr: str):
         """Return the value for the longest prefix match, or None if not found."""
         try:
-            return self.tree.get(addr)
-        except KeyError:
+            return self._tree(addr).get(addr)
+        except (KeyError, ValueError):
             return None
 
     def has(self, addr: str) -> bool:
         """Return True if the IP is within any known prefix."""
-        return addr in self.tree
+        # `in` fails with a SystemError on some malformed addresses, get_key raises a ValueError
+        try:
+            return self._tree(addr).get_key(addr) is not None
+        except ValueError:
+            return False
+
+def ip_to_uint32(addrs) -> tuple[np.ndarray, np.ndarray]:
+    "IPv4 addresses as integers, and whether each of them is valid"
+    octets = pd.Series(addrs, dtype=object).astype(str).str.split(".", expand=True)
+    extra = octets.iloc[:, 4:].notna().any(axis=1).to_numpy()
+    octets = octets.reindex(columns=range(4)).apply(pd.to_numeric, errors="coerce")
+    valid = (octets.notna() & octets.ge(0) & octets.le(255)).all(axis=1).to_numpy() & ~extra
+    vals = octets.fillna(0).to_numpy(dtype=np.uint32)
+    ints = (vals[:, 0] << 24) | (vals[:, 1] << 16) | (vals[:, 2] << 8) | vals[:, 3]
+    return np.where(valid, ints, 0).astype(np.uint32), valid
+
+def ip_to_bytes(addrs) -> tuple[np.ndarray, np.ndarray]:
+    "IPv6 addresses as 16-byte big-endian strings, which sort like the numbers, and whether each of them is valid"
+    packed, valid = [], []
+    for a in addrs:
+        try:
+            packed.append(ipaddress.IPv6Address(a).packed)
+            valid.append(True)
+        except ValueError:
+            packed.append(b"")
+            valid.append(False)
+    return np.array(packed, dtype="S16"), np.array(valid, dtype=bool)
+
+# file names of a persisted index: ranges of each family and the owner of each range
+INDEX_ARRAYS = ["v4_starts", "v4_ends", "v4_owners", "v6_starts", "v6_ends", "v6_owners"]
+
+class PrefixIndex:
+    """
+    Longest-prefix match over whole arrays of IPv4 and IPv6 addresses.
+    Nested prefixes are flattened into sorted, disjoint ranges, each owned by
+    the most specific prefix covering it, so a lookup is a binary search.
+    IPv4 ranges are uint32, IPv6 ranges are 16-byte big-endian strings.
+    Optional metadata columns are aligned with the owners.
+    """
+
+    def __init__(self, arrays: dict[str, np.ndarray], meta: dict[str, np.ndarray] | None = None):
+        self.arrays = arrays
+        self.meta = meta or {}
+
+    @staticmethod
+    def _search(starts: np.ndarray, ends: np.ndarray, owners: np.ndarray, keys: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        if not len(starts):
+            return np.full(len(keys), -1, dtype=np.int64)
+        pos = np.searchsorted(starts, keys, side="right") - 1
+        seg = np.clip(pos, 0, None)
+        hit = valid & (pos >= 0) & (keys <= ends[seg])
+        return np.where(hit, owners[seg], -1)
+
+    def lookup(self, addrs) -> np.ndarray:
+        """
+        Position of the longest matching prefix of every address, or -1.
+        Takes address strings of both families, or IPv4 integers.
+        """
+        a = self.arrays
+        addrs = np.asarray(addrs)
+        if addrs.dtype.kind in "iu":
+            keys = addrs.astype(np.uint32)
+            return self._search(a["v4_starts"], a["v4_ends"], a["v4_owners"], keys, np.ones(len(keys), dtype=bool))
+
+        res = np.full(len(addrs), -1, dtype=np.int64)
+        v6 = pd.Series(addrs, dtype=object).astype(str).str.contains(":", regex=False).to_numpy()
+        if (~v6).any():
+            keys, valid = ip_to_uint32(addrs[~v6])
+            res[~v6] = self._search(a["v4_starts"], a["v4_ends"], a["v4_owners"], keys, valid)
+        if v6.any():
+            keys, valid = ip_to_bytes(addrs[v6])
+            res[v6] = self._search(a["v6_starts"], a["v6_ends"], a["v6_owners"], keys, valid)
+        return res
+
+    def save(self, path: str, digest: str) -> None:
+        """
+        Persist the index as plain arrays. The index is written to a temporary directory
+        and moved into place, so an interrupted save never leaves a partial index behind.
+        """
+        path = os.path.abspath(path)
+        parent, name = os.path.split(path)
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=f".{name}.tmp-", dir=parent)
+        try:
+            for n, arr in [*self.arrays.items(), *[(f"meta_{k}", v) for k, v in self.meta.items()]]:
+                np.save(os.path.join(tmp, f"{n}.npy"), arr, allow_pickle=False)
+            with open(os.path.join(tmp, "index.json"), "w") as f:
+                json.dump({"digest": digest, "meta": list(self.meta.keys())}, f)
+
+            # directories are only replaced when empty, move the previous index aside first
+            old = None
+            if os.path.exists(path):
+                old = tempfile.mkdtemp(prefix=f".{name}.old-", dir=parent)
+                os.replace(path, os.path.join(old, name))
+            os.replace(tmp, path)
+            if old:
+                shutil.rmtree(old, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    @classmethod
+    def load(cls, path: str, digest: str) -> 'PrefixIndex | None':
+        "Memory-map a persisted index, None if missing or built from other data"
+        try:
+            with open(os.path.join(path, "index.json")) as f:
+                info = json.load(f)
+            if info["digest"] != digest:
+                return None
+            arrays = {n: np.load(os.path.join(path, f"{n}.npy"), mmap_mode="r") for n in INDEX_ARRAYS}
+            meta = {k: np.load(os.path.join(path, f"meta_{k}.npy"), mmap_mode="r") for k in info["meta"]}
+            return cls(arrays, meta)
+        except (OSError, ValueError, KeyError):
+            return None
+
+def flatten_ranges(starts: list[int], ends: list[int], limit: int) -> tuple[list[int], list[int], list[int]]:
+    """
+    Split nested ranges into disjoint segments owned by the innermost range.
+    Ranges must either nest or not overlap, as prefixes do.
+    """
+    segments: tuple[list[int], list[int], list[int]] = ([], [], [])
+    def emit(start: int, end: int, owner: int) -> None:
+        segments[0].append(start)
+        segments[1].append(end)
+        segments[2].append(owner)
+
+    # containing ranges come before the ones they contain, later duplicates win
+    order = sorted(range(len(starts)), key=lambda i: (starts[i], -ends[i]))
+    stack: list[int] = []
+    pos = 0
+    for i in order + [-1]:
+        upto = starts[i] if i >= 0 else limit
+        # close the open ranges ending before this one
+        while stack and ends[stack[-1]] < upto:
+            p = stack.pop()
+            if pos <= ends[p]:
+                emit(pos, ends[p], p)
+                pos = ends[p] + 1
+        if stack and pos < upto:
+            emit(pos, upto - 1, stack[-1])
+        pos = max(pos, upto)
+        stack.append(i)
+    return segments
+
+def build_prefix_index(prefixes, meta: dict[str, list] | None = None) -> PrefixIndex:
+    "Index of the prefixes, matches point to their position in the list"
+    nets: dict[int, list[tuple[int, ipaddress.IPv4Network | ipaddress.IPv6Network]]] = {4: [], 6: []}
+    for i, p in enumerate(prefixes):
+        n = ipaddress.ip_network(p, strict=False)
+        nets[n.version].append((i, n))
+
+    arrays = {}
+    for version, bits, dtype in [(4, 32, np.uint32), (6, 128, np.dtype("S16"))]:
+        starts, ends, segs = flatten_ranges(
+            [int(n.network_address) for _, n in nets[version]],
+            [int(n.broadcast_address) for _, n in nets[version]],
+            2 ** bits,
+        )
+        if version == 6:
+            starts = [s.to_bytes(16, "big") for s in starts]
+            ends = [e.to_bytes(16, "big") for e in ends]
+
+        owners = np.array([i for i, _ in nets[version]], dtype=np.int64)
+        arrays[f"v{version}_starts"] = np.array(starts, dtype=dtype)
+        arrays[f"v{version}_ends"] = np.array(ends, dtype=dtype)
+        arrays[f"v{version}_owners"] = owners[np.array(segs, dtype=np.int64)]
+
+    # plain strings, so the metadata can be memory-mapped as well
+    meta = {k: np.array(pd.Series(v, dtype=object).fillna("").astype(str).tolist(), dtype=str) for k, v in (meta or {}).items()}
+    return PrefixIndex(arrays, meta)
+
+def read_pfx2as(path: str) -> pd.DataFrame:
+    """
+    Prefix and origin ASN of every route in a prefix-to-AS dump.
+    Takes CAIDA pfx2as files (`address length asn`) and RIB-derived
+    tables (`prefix asn`), plain or compressed. Multi-origin routes keep their first ASN.
+    """
+    df = pd.read_csv(path, sep=r"\s+", header=None, dtype=str, comment="#")
+    if len(df.columns) >= 3:
+        prefix = df[0] + "/" + df[1]
+        asn = df[2]
+    else:
+        prefix, asn = df[0], df[1]
+
+    asn = asn.str.strip("{}").str.split(r"[_,]", regex=True).str[0].str.removeprefix("AS")
+    return pd.DataFrame({"prefix": prefix, "asn": asn}).dropna()
+
+def build_pfx2as_index(path: str) -> PrefixIndex:
+    routes = read_pfx2as(path)
+    return build_prefix_index(routes["prefix"].tolist(), {"prefix": routes["prefix"].tolist(), "asn": routes["asn"].tolist()})
 
 def build_prefix_tree(prefixes: list[str]) -> PrefixTree:
     tree = PrefixTree()
@@ -29,14 +230,6 @@ def build_prefix_tree(prefixes: list[str]) -> PrefixTree:
         tree.add(p, p)
     return tree
 
-def build_resource_tree(flat: pd.DataFrame) -> PrefixTree:
-    tree = PrefixTree()
-    records = flat.to_dict("records")
-    for rec in records:
-        prefix = rec["prefix"]
-        tree.add(prefix, rec)
-    return tree
-
 def flatten_resources(resources: pd.DataFrame) -> pd.DataFrame:
     # Remove prefix list column but keep other data
     meta_cols = resources.columns.drop("prefixes")
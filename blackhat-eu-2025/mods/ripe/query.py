@@ -16,4 +16,19 @@ def query_prefixes(repo: Repository) -> list[str]:
     # The table may not exist yet
     except duckdb.CatalogException:
         print("table records_resources not loaded yet")
-        return []
\ No newline at end of file
+        return []
+
+def query_table_digest(repo: Repository, table: str) -> str | None:
+    "Cheap fingerprint of the contents of a table, None if it does not exist"
+    q = f"SELECT COUNT(*), SUM(hash(t)) FROM {table} AS t"
+    try:
+        count, h = repo.get_connection().execute(q).fetchone()
+        return f"{count}:{h}"
+    except duckdb.CatalogException:
+        return None
+
+def query_db_path(repo: Repository) -> str:
+    "Path of the database file, empty when in memory"
+    q = "SELECT path FROM duckdb_databases() WHERE database_name = current_database()"
+    res = repo.get_connection().execute(q).fetchone()
+    return res[0] if res and res[0] else ""
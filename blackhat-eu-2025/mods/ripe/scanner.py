@@ -6,72 +6,137 @@ from dice.loaders import with_records
 from dice.query import query_db, query_records
 from dice.config import SCANNER
 from tqdm import tqdm
+from typing import Callable, Generator
 import ujson
 
 from mods.ripe.models import AutonomousSystem, Resource
-from mods.ripe.query import query_prefixes
+from mods.ripe.client import RipeStatClient, new_client
+from mods.cache import CACHE
+from mods.ripe.query import query_prefixes, query_table_digest, query_db_path
 from mods.ripe.fingerprint import make_asn_fp_handler
-from mods.ripe.helpers import build_prefix_tree, build_resource_tree, flatten_resources
+from mods.ripe.helpers import PrefixIndex, PrefixTree, build_pfx2as_index, build_prefix_index, flatten_resources
 
 import pandas as pd
 
-import ipaddress
-import requests
+import numpy as np
+import os
 import ast
 
-API = "https://stat.ripe.net/data"
-ENDPOINTS = {
-    "ris": "network-info/data.json",
-    "contact": "abuse-contact-finder/data.json",
-    "name": "as-names/data.json",
-    "prefixes": "maxmind-geo-lite-announced-by-as/data.json",
-}
+# shared by every RIPEstat call of the scanners
+CLIENT = new_client()
 
-def get_ris(addr: str) -> dict | None:
+# hosts added to the repository at once by the hosts scanner
+HOSTS_BATCH = 50_000
+
+# where prefix indexes are persisted, next to the database by default
+INDEX_DIR = os.environ.get("DICE_PREFIX_INDEX", "")
+
+# local prefix-to-AS dump (CAIDA pfx2as or RIB-derived table) resolving
+# prefixes offline, RIPEstat is only asked for the addresses it does not cover
+PFX2AS = os.environ.get("RIPE_PFX2AS", "")
+
+def load_index(repo: Repository, name: str, build: Callable[[], PrefixIndex]) -> PrefixIndex:
+    """
+    Reopens a persisted prefix index, or builds and persists it.
+    Indexes are invalidated when records_resources changes.
+    """
+    digest = query_table_digest(repo, "records_resources")
+    base = INDEX_DIR or (f"{db}.index" if (db := query_db_path(repo)) else "")
+    path = os.path.join(base, name) if base else ""
+
+    if digest and path and (index := PrefixIndex.load(path, digest)):
+        print(f"loaded {name} index from {path}")
+        return index
+
+    print(f"building {name} index")
+    index = build()
+    if digest and path:
+        index.save(path, digest)
+    return index
+
+def load_routes(path: str = PFX2AS) -> PrefixIndex | None:
+    """
+    Prefix index of a routing table dump, persisted next to it.
+    The index is rebuilt when the dump changes.
+    """
+    if not path:
+        return None
+
+    st = os.stat(path)
+    digest = f"{st.st_size}-{st.st_mtime_ns}"
+    if index := PrefixIndex.load(f"{path}.index", digest):
+        print(f"loaded routes index from {path}.index")
+        return index
+
+    print(f"building routes index from {path}")
+    index = build_pfx2as_index(path)
+    try:
+        index.save(f"{path}.index", digest)
+    except OSError as e:
+        print(f"failed to persist routes index: {e}")
+    return index
+
+def build_resource_index(repo: Repository) -> PrefixIndex:
+    print("fetching records: ASN resources")
+    resources = repo.get_records(normalize=True, source="resources")
+    resources["prefixes"] = resources["prefixes"].apply(ujson.loads)
+
+    print("flattening resource prefixes")
+    flat = flatten_resources(resources).dropna(subset=["prefix"])
+    meta = {c: flat[c].tolist() for c in ["prefix", "asn", "country"] if c in flat}
+    return build_prefix_index(flat["prefix"].tolist(), meta)
+
+def build_known_prefix_index(repo: Repository) -> PrefixIndex:
+    return build_prefix_index([p for p in query_prefixes(repo) if p])
+
+@CACHE.cached("ripe:ris")
+def get_ris(addr: str, client: RipeStatClient = CLIENT) -> dict | None:
     p = {"resource": addr}
     try:
-        data = requests.get("/".join([API, ENDPOINTS["ris"]]), params=p).json()
+        data = client.get("ris", p)
         return data["data"]
     except Exception as e:
         print(f"failed to fetch ip {addr} info: {e}")
 
-def fetch_ris(addr: str) -> dict | None:
+def fetch_ris(addr: str, client: RipeStatClient = CLIENT) -> dict | None:
     'returns basic AS info from an address'
-    if net_info := get_ris(addr):
+    if net_info := get_ris(addr, client):
         return {"prefix": net_info.get("prefix", None), "asn": asn[0] if (asn := net_info.get("asns", [None])) else None}
 
-def get_asn_name(asn: str) -> str:
+@CACHE.cached("ripe:name", default="")
+def get_asn_name(asn: str, client: RipeStatClient = CLIENT) -> str:
     p = {"resource": asn}
     try:
-        res = requests.get("/".join([API, ENDPOINTS["name"]]), params=p).json()
+        res = client.get("name", p)
         return res["data"]["names"][asn]
     except Exception as e:
         print(f"failed to get ans info: {e}")
         return ""
 
-def get_asn_contacts(asn: str) -> list[str]:
+@CACHE.cached("ripe:contact", default=[])
+def get_asn_contacts(asn: str, client: RipeStatClient = CLIENT) -> list[str]:
     p = {"resource": asn}
     try:
-        res = requests.get("/".join([API, ENDPOINTS["contact"]]), params=p).json()
+        res = client.get("contact", p)
         return res["data"].get("abuse_contacts", [])
     except Exception as e:
         print(f"failed to get abuse contacts: {e}")
         return []
 
-def get_asn_resources(asn: str) -> list[Resource]:
+@CACHE.cached("ripe:prefixes", default=[])
+def get_asn_located_resources(asn: str, client: RipeStatClient = CLIENT) -> list[dict]:
     p = {"data_overload_limit": "ignore", "resource": asn}
     try:
-        res = requests.get("/".join([API, ENDPOINTS["prefixes"]]), params=p).json()
+        res = client.get("prefixes", p)
+        return res["data"].get("located_resources") or []
     except Exception as e:
         print(f"failed to get resources ({asn}): {e}")
         return []
-    
+
+def get_asn_resources(asn: str, client: RipeStatClient = CLIENT) -> list[Resource]:
     resources = []
-    for pf in res["data"].get("located_resources"):
+    for pf in get_asn_located_resources(asn, client):
         res = pf.get("resource")
-        if isinstance(ipaddress.ip_network(res), ipaddress.IPv6Network):
-            continue # dont care about IPv6
-
         res = [make_resource(asn, res, loc) for loc in pf.get("locations")]
         resources.extend(res)
     return resources
@@ -92,34 +157,55 @@ def make_resource(asn: str, resource: str, loc: dict) -> Resource:
 def new_asn(num: str, name: str, contacts: list[str]) -> AutonomousSystem:
     return AutonomousSystem(str(uuid4()), num, name, contacts)
 
-def make_asn(asn: str) -> AutonomousSystem:
+def make_asn(asn: str, client: RipeStatClient = CLIENT) -> AutonomousSystem:
     return new_asn(
         asn, 
-        name=get_asn_name(asn),
-        contacts=get_asn_contacts(asn),
+        name=get_asn_name(asn, client),
+        contacts=get_asn_contacts(asn, client),
     )
 
-def fetch_prefixes(repo: Repository, *addrs: str) -> Source:
-    tree = build_prefix_tree(query_prefixes(repo))
+def resolve_routes(routes: PrefixIndex, addrs: np.ndarray, tree: PrefixTree) -> tuple[list[dict], np.ndarray]:
+    "Prefixes and origins of the addresses found in the routes not already in `tree`, and the addresses not found"
+    pos = routes.lookup(addrs)
+    hit = pos >= 0
+    found = np.unique(pos[hit])
     recs = []
-    for addr in addrs:
-        if tree.has(addr):
-            continue
-        ris = fetch_ris(addr)
-        if ris and (px := ris.get("prefix")):
+    for px, asn in zip(routes.meta["prefix"][found].tolist(), routes.meta["asn"][found].tolist()):
+        if tree.get(px) != px:
             tree.add(px, px)
-            recs.append(ris)
+            recs.append({"prefix": px, "asn": asn or None})
+    return recs, addrs[~hit]
+
+def fetch_prefixes(repo: Repository, *addrs: str, index: PrefixIndex | None = None, tree: PrefixTree | None = None, routes: PrefixIndex | None = None, client: RipeStatClient = CLIENT) -> Source:
+    """
+    Fetch the prefixes of the addresses not covered by known prefixes, or the ones fetched in `tree`.
+    Addresses found in the `routes` index are resolved locally, the rest from RIPEstat.
+    """
+    index = index or load_index(repo, "prefixes", lambda: build_known_prefix_index(repo))
+    tree = tree or PrefixTree()
+    pending = np.array(addrs, dtype=object)
+    pending = pending[index.lookup(pending) < 0]
+    recs = []
+
+    if routes is not None and len(pending):
+        recs, pending = resolve_routes(routes, pending, tree)
+
+    # fetch in waves as large as the client concurrency, so addresses
+    # covered by a prefix of a previous wave are skipped
+    for i in range(0, len(pending), client.workers):
+        wave = [a for a in pending[i:i+client.workers] if not tree.has(a)]
+        for ris in client.map(lambda a: fetch_ris(a, client), wave):
+            if ris and (px := ris.get("prefix")) and tree.get(px) != px:
+                tree.add(px, px)
+                recs.append(ris)
     
     src = new_source("prefixes", "-", "-", loader=with_records(recs))
     return src
 
-def fetch_asn(*asn: str) -> list[Source]:
-    asns = []
+def fetch_asn(*asn: str, client: RipeStatClient = CLIENT) -> list[Source]:
+    asns = [m.to_dict() for m in client.map(lambda n: make_asn(n, client), asn)]
     resources = []
-    for n in asn:
-        as_model = make_asn(n)
-        asns.append(as_model.to_dict())
-        res = get_asn_resources(n)
+    for res in client.map(lambda n: get_asn_resources(n, client), asn):
         resources.extend(res)
 
     asn_src = new_source("asn", "-","-", loader=with_records(asns))
@@ -135,7 +221,7 @@ def make_asn_scn_handler() -> ModuleHandler:
 
         # pre-fetch prefixes and their asn
         repo = mod.repo()
-        pf_src = fetch_prefixes(repo, hosts["ip"].unique().tolist())
+        pf_src = fetch_prefixes(repo, *hosts["ip"].unique().tolist(), routes=load_routes())
 
         # fetch ASNs info and add it to the db
         asns = []
@@ -151,39 +237,52 @@ def make_asn_scn_handler() -> ModuleHandler:
         h(mod)
     return handler
 
-# TODO: this should be a generator so we dont explode memory
-def scan(mod: Module) -> list[Source]:
-    hosts = mod.query(query_records("hosts"))
-    addrs = set([h["ip"] for h in hosts])
-    prefixes = fetch_prefixes(mod.repo(), *addrs)
+def scan(mod: Module) -> Generator[Source, None, None]:
+    "Streams the ASN and resource sources of the hosts, one batch of hosts at a time"
+    repo = mod.repo()
+    index = load_index(repo, "prefixes", lambda: build_known_prefix_index(repo))
+    routes = load_routes()
+    tree = PrefixTree()
+    seen: set[str] = set()
 
-    # fetch ASNs info and add it to the db
-    asns = []
-    for df in prefixes.load():
-        asns.extend(df["asn"].tolist())
-    return fetch_asn(*set(asns))
+    t, gen = repo.queryb(query_records("hosts"), normalize=False)
+    with tqdm(total=t, desc="prefixes") as pbar:
+        for b in gen:
+            prefixes = fetch_prefixes(repo, *b["ip"].unique().tolist(), index=index, tree=tree, routes=routes)
+
+            # fetch the info of ASNs not seen in previous batches
+            asns = set()
+            for df in prefixes.load():
+                if "asn" in df:
+                    asns.update(df["asn"].dropna().tolist())
+            if asns := asns - seen:
+                seen.update(asns)
+                yield from fetch_asn(*asns)
+            pbar.update(len(b.index))
 
 def make_asn_scn() -> ModuleHandler:
     def handler(mod: Module) -> None:
-        srcs = scan(mod)
-        mod.repo().add_sources(*srcs)
+        for src in scan(mod):
+            mod.repo().add_source(src)
+        print(f"RIPEstat: {CLIENT.summary()}, {CACHE.summary()}")
     return handler
 
 def make_scanner() -> Module:
     return new_module(SCANNER, "ripe", make_asn_scn())
 
-def scan_hosts(mod: Module) -> None:
-    repo = mod.repo()
-
-    print("fetching records: ASN resources")
-    resources = repo.get_records(normalize=True, source="resources")
-    resources["prefixes"] = resources["prefixes"].apply(ujson.loads)
-
-    print("flattening resource prefixes")
-    flat = flatten_resources(resources)
+def add_hosts(repo: Repository, hosts: list[Host]) -> int:
+    """
+    Adds a batch of hosts as a source of its own, returns the number of hosts.
+    The repository appends sources, the hosts records hold the hosts of every batch.
+    """
+    src = new_source("hosts", "-", "-", loader=with_model(hosts))
+    repo.add_source(src)
+    return len(hosts)
 
-    print("building resource tree")
-    tree = build_resource_tree(flat)
+def scan_hosts(mod: Module, batch_size: int = HOSTS_BATCH) -> None:
+    repo = mod.repo()
+    index = load_index(repo, "resources", lambda: build_resource_index(repo))
+    prefixes, asns = index.meta["prefix"], index.meta["asn"]
 
     print("adding hosts")
     q = """
@@ -192,16 +291,26 @@ def scan_hosts(mod: Module) -> None:
     """
     t, gen = repo.queryb(q, normalize=False)
     hosts: list[Host] = []
+    added = 0
     with tqdm(total=t, desc="hosts") as pbar:
         for b in gen:
-            for addr in b["ip"].tolist():
-                info = tree.get(addr)
-                if info:
-                    host: Host = new_host(addr, prefix=info["prefix"], asn=info["asn"])
-                    hosts.append(host)
+            addrs = b["ip"].to_numpy()
+            pos = index.lookup(addrs)
+            hit = pos >= 0
+            hosts.extend(
+                new_host(addr, prefix=prefix, asn=asn)
+                for addr, prefix, asn in zip(addrs[hit], prefixes[pos[hit]].tolist(), asns[pos[hit]].tolist())
+            )
+
+            # keep memory flat, whatever the number of addresses
+            if len(hosts) >= batch_size:
+                added += add_hosts(repo, hosts)
+                hosts = []
             pbar.update(len(b.index))
-    src = new_source("hosts", "-", "-", loader=with_model(hosts))
-    mod.repo().add_source(src)
+
+    if hosts:
+        added += add_hosts(repo, hosts)
+    print(f"added {added} hosts")
 
 def make_hosts_scn() -> ModuleHandler:
     def handler(mod: Module) -> None:
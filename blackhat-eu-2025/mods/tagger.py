@@ -0,0 +1,236 @@
+from dice.module import Module, Repository
+from mods.classifier import BULK_ERRORS, bulk_writable
+
+from typing import Any, Callable
+
+import functools
+import threading
+import duckdb
+import pandas as pd
+import time
+import os
+
+TAGS_TABLE = "tags"
+# stand-in values, used to find the columns `make_tag` puts them in
+HOST_PLACEHOLDER = "__host__"
+DETAILS_PLACEHOLDER = "__details__"
+PROTOCOL_PLACEHOLDER = "__protocol__"
+PORT_PLACEHOLDER = 1_000_003 # outside the port range
+
+# optional tag columns, with their placeholder
+TAG_COLUMNS = {
+    "details": DETAILS_PLACEHOLDER,
+    "protocol": PROTOCOL_PLACEHOLDER,
+    "port": PORT_PLACEHOLDER,
+}
+
+# buffered tags written at once by a tag buffer, and seconds before buffered tags are written anyway
+TAG_BATCH = int(os.environ.get("DICE_TAG_BATCH", "10000"))
+TAG_MAX_AGE = float(os.environ.get("DICE_TAG_MAX_AGE", "30"))
+
+class TagBuffer:
+    """
+    Buffer of the per-row tags of one or more taggers, possibly running in several threads.
+    Tags are written in batches through the module, once `batch_size` of them are buffered
+    or `max_age` seconds after the last write. Identical tags, (host, tag, protocol, port, details),
+    are written once per batch: a host matching two rules with different details keeps both tags.
+    Set-based tags are not buffered, `tag_query` inserts them and only adds them to the counts.
+    Any other repository write is serialized with the same lock.
+    """
+
+    def __init__(self, mod: Module, batch_size: int = TAG_BATCH, max_age: float = TAG_MAX_AGE):
+        self.mod = mod
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self._records: dict[tuple[str, tuple[str, ...]], list[dict[str, Any]]] = {}
+        self._flushed_at = time.monotonic()
+        self.buffered = 0
+        self.flushed = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.batches = 0
+
+    def add(self, host: str, tag: str, details: str | None = None, protocol: str | None = None, port: int | None = None) -> None:
+        "Buffers a single tag, like `Module.tag`"
+        row = {"host": host, "details": details, "protocol": protocol, "port": port}
+        row = {k: v for k, v in row.items() if v is not None}
+        with self.lock:
+            self._records.setdefault((tag, tuple(c for c in TAG_COLUMNS if c in row)), []).append(row)
+            self.buffered += 1
+            self._maybe_flush()
+
+    def add_fp(self, fp: dict[str, Any], tag: str, details: str | None = None) -> None:
+        "Buffers the tag of the service of a fingerprint, like `Module.tag_fp`"
+        self.add(fp["host"], tag, details, fp["protocol"], fp["port"])
+
+    def add_inserted(self, n: int) -> None:
+        "Counts tags written by a single statement, next to the buffered ones"
+        with self.lock:
+            self.inserted += n
+
+    def call(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        with self.lock:
+            return fn(*args, **kwargs)
+
+    def _maybe_flush(self) -> None:
+        if self.buffered >= self.batch_size or time.monotonic() - self._flushed_at >= self.max_age:
+            self._flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        for (tag, _), records in self._records.items():
+            df = pd.DataFrame(records).drop_duplicates(ignore_index=True)
+            self.duplicates += len(records) - len(df.index)
+            self.flushed += bulk_tag(self.mod, df, tag)
+            self.batches += 1
+        self._records = {}
+        self.buffered = 0
+        self._flushed_at = time.monotonic()
+
+    def summary(self) -> str:
+        return (
+            f"tags: {self.flushed} written in {self.batches} batches, {self.buffered} buffered, "
+            f"{self.duplicates} duplicates dropped, {self.inserted} inserted at once"
+        )
+
+    def __enter__(self) -> 'TagBuffer':
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.flush()
+
+class BufferedModule:
+    """
+    Module whose per-row tags go through a tag buffer instead of one repository write each.
+    Counts the tags it was given, the buffer may be shared by modules in other threads.
+    """
+
+    def __init__(self, mod: Module, buffer: TagBuffer):
+        self._mod = mod
+        self.buffer = buffer
+        self.tags = 0
+
+    def repo(self) -> Repository:
+        return self._mod.repo()
+
+    def tag(self, host: str, tag: str, details: str | None = None, protocol: str | None = None, port: int | None = None) -> None:
+        self.buffer.add(host, tag, details, protocol, port)
+        self.tags += 1
+
+    def tag_fp(self, fp: dict[str, Any], tag: str, details: str | None = None) -> None:
+        self.buffer.add_fp(fp, tag, details)
+        self.tags += 1
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._mod, name)
+
+def tag_buffer(mod: Module) -> TagBuffer | None:
+    "Buffer the tags of the module go through, if any"
+    return getattr(mod, "buffer", None)
+
+def buffered(tagger: Callable[[Module], None]) -> Callable[[Module], None]:
+    "Runs a tagger with its tags going through a buffer, unless they already do"
+    @functools.wraps(tagger)
+    def wrapper(mod: Module) -> None:
+        if tag_buffer(mod) is not None:
+            return tagger(mod)
+        with TagBuffer(mod) as buffer:
+            tagger(BufferedModule(mod, buffer))
+        print(buffer.summary())
+    return wrapper
+
+def tag_records(mod: Module, df: pd.DataFrame, tag: str) -> list:
+    "Tags of the rows of a frame with a `host` column and any of the optional tag columns"
+    cols = [c for c in TAG_COLUMNS if c in df]
+    return [mod.make_tag(r["host"], tag, **{c: r[c] for c in cols}) for r in df.to_dict("records")]
+
+def tag_projection(mod: Module, tag: str, cols: list[str], alias: str = "t") -> tuple[str, list]:
+    """
+    SELECT list that turns rows with a `host` column, and some of the optional
+    tag columns, into tag rows. The columns are taken from a tag made by the module,
+    so the rows look exactly like the ones `make_tag` would create.
+    """
+    kwargs = {c: TAG_COLUMNS[c] for c in cols if c in TAG_COLUMNS}
+    tmpl = mod.make_tag(HOST_PLACEHOLDER, tag, **kwargs).to_dict()
+    source = {HOST_PLACEHOLDER: "host", **{v: k for k, v in kwargs.items()}}
+
+    sel, params = [], []
+    for k, v in tmpl.items():
+        if isinstance(v, (str, int)) and v in source:
+            sel.append(f'{alias}."{source[v]}" AS "{k}"')
+        elif k == "id":
+            sel.append(f'CAST(uuid() AS VARCHAR) AS "{k}"')
+        else:
+            sel.append(f'? AS "{k}"')
+            params.append(v)
+    return ", ".join(sel), params
+
+def tag_query(mod: Module, tag: str, q: str, params: list | None = None, cols: list[str] | None = None) -> int:
+    """
+    Tag the distinct rows of a query with a single INSERT ... SELECT, even when the module buffers its tags.
+    The query returns a `host` column and the optional tag columns in `cols`.
+    """
+    cols = cols if cols is not None else ["details"]
+    conn = mod.repo().get_connection()
+    distinct = ", ".join(f'"{c}"' for c in ["host", *cols])
+    n = None
+    if bulk_writable(mod.make_tag(HOST_PLACEHOLDER, tag)):
+        try:
+            sel, sel_params = tag_projection(mod, tag, cols)
+            res = conn.execute(
+                f"INSERT INTO {TAGS_TABLE} BY NAME SELECT {sel} FROM (SELECT DISTINCT {distinct} FROM ({q})) AS t",
+                sel_params + (params or []),
+            ).fetchone()
+            n = res[0] if res else 0
+        except BULK_ERRORS as e:
+            # the tags table is dice's, let the repository write them if they do not fit
+            print(f"failed to bulk insert {tag} tags, using the repository: {e!r}")
+    else:
+        print(f"the tag model has no columns to bulk insert, writing {tag} tags through the repository")
+    if n is None:
+        df = conn.execute(f"SELECT DISTINCT {distinct} FROM ({q})", params or []).df()
+        mod.repo().tag(*tag_records(mod, df, tag))
+        n = len(df)
+
+    if (buffer := tag_buffer(mod)) is not None:
+        buffer.add_inserted(n)
+        mod.tags += n
+    return n
+
+def bulk_tag(mod: Module, df: pd.DataFrame, tag: str) -> int:
+    "Tag a batch of rows with a `host` column and any of the optional tag columns"
+    if df.empty:
+        return 0
+    conn = mod.repo().get_connection()
+    cols = [c for c in TAG_COLUMNS if c in df]
+    conn.register("tag_batch", df[["host", *cols]])
+    try:
+        return tag_query(mod, tag, "SELECT * FROM tag_batch", cols=cols)
+    finally:
+        conn.unregister("tag_batch")
+
+def tag_fingerprints(mod: Module, tag: str, q: str, params: list | None = None) -> int:
+    "Tag the services of the fingerprints a query returns, as `id` and `details` columns"
+    fq = f"""
+    SELECT f.host, f.protocol, f.port, t.details
+    FROM fingerprints AS f
+    JOIN ({q}) AS t ON f.id = t.id
+    """
+    return tag_query(mod, tag, fq, params, cols=["details", "protocol", "port"])
+
+def count_tags(mod: Module) -> int:
+    """
+    Number of tags of the module. A buffered module counts the tags it was given,
+    otherwise they are counted in the tags table, 0 if there is none yet
+    """
+    if tag_buffer(mod) is not None:
+        return mod.tags
+    try:
+        res = mod.repo().get_connection().execute(f"SELECT COUNT(*) FROM {TAGS_TABLE}").fetchone()
+        return res[0] if res else 0
+    except duckdb.Error:
+        return 0
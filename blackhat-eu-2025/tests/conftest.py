@@ -0,0 +1,97 @@
+"Stand-ins for the dice module and repository over an in-memory DuckDB"
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, Generator
+
+import pandas as pd
+import duckdb
+import pytest
+import uuid
+
+@dataclass
+class Label:
+    id: str
+    fingerprint_id: str
+    label_id: str
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+@dataclass
+class Tag:
+    id: str
+    host: str
+    tag_id: str
+    details: str
+    protocol: str
+    port: int
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+class FakeRepo:
+    def __init__(self, conn: duckdb.DuckDBPyConnection):
+        self.conn = conn
+
+    def get_connection(self) -> duckdb.DuckDBPyConnection:
+        return self.conn
+
+    def queryb(self, q: str, normalize: bool = True) -> tuple[int, Generator[pd.DataFrame, None, None]]:
+        total, = self.conn.execute(f"SELECT COUNT(*) FROM ({q})").fetchone()
+        def gen() -> Generator[pd.DataFrame, None, None]:
+            res = self.conn.cursor().execute(q)
+            while len(b := res.fetch_df_chunk(16)):
+                yield b
+        return total, gen()
+
+    def label(self, *labels: Label) -> None:
+        if labels:
+            self.conn.executemany("INSERT INTO labels VALUES (?, ?, ?)", [list(l.to_dict().values()) for l in labels])
+
+    def tag(self, *tags: Tag) -> None:
+        if tags:
+            self.conn.executemany("INSERT INTO tags VALUES (?, ?, ?, ?, ?, ?)", [list(t.to_dict().values()) for t in tags])
+
+class FakeModule:
+    def __init__(self, conn: duckdb.DuckDBPyConnection):
+        self._repo = FakeRepo(conn)
+
+    def repo(self) -> FakeRepo:
+        return self._repo
+
+    def make_label(self, fingerprint_id: str, label: str) -> Label:
+        return Label(str(uuid.uuid4()), fingerprint_id, label)
+
+    def make_tag(self, host: str, tag: str, details: str = "", protocol: str = "", port: int = 0) -> Tag:
+        return Tag(str(uuid.uuid4()), host, tag, details, protocol, port)
+
+    def tag(self, host: str, tag: str, details: str = "", protocol: str = "", port: int = 0) -> None:
+        self._repo.tag(self.make_tag(host, tag, details, protocol, port))
+
+    def tag_fp(self, fp: dict[str, Any], tag: str, details: str = "") -> None:
+        self.tag(fp["host"], tag, details, fp["protocol"], fp["port"])
+
+    def with_pbar(self, handler: Callable[[pd.DataFrame], None], q: str) -> None:
+        _, gen = self._repo.queryb(q)
+        for df in gen:
+            handler(df)
+
+    def query(self, q: str) -> list[dict]:
+        return self._repo.conn.execute(q).df().to_dict("records")
+
+    def register_label(self, *_: Any) -> None:
+        return
+
+    def register_tag(self, *_: Any) -> None:
+        return
+
+@pytest.fixture
+def conn() -> Generator[duckdb.DuckDBPyConnection, None, None]:
+    c = duckdb.connect()
+    c.execute("CREATE TABLE labels (id VARCHAR, fingerprint_id VARCHAR, label_id VARCHAR)")
+    c.execute("CREATE TABLE tags (id VARCHAR, host VARCHAR, tag_id VARCHAR, details VARCHAR, protocol VARCHAR, port INTEGER)")
+    yield c
+    c.close()
+
+@pytest.fixture
+def mod(conn: duckdb.DuckDBPyConnection) -> FakeModule:
+    return FakeModule(conn)
@@ -0,0 +1,83 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from mods import cache
+from mods.cache import DAY, ResponseCache, new_cache
+
+@pytest.fixture
+def clock(monkeypatch):
+    "Clock of the cache, moved by hand"
+    now = [1_000_000.]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    return now
+
+def test_entries_expire_after_their_ttl(clock):
+    c = ResponseCache("", ttls={"short": 10, "long": DAY})
+    c.put_many("short", {"a": 1, "b": [2]})
+    c.put("long", "a", {"v": 3})
+    assert c.get_many("short", ["a", "b", "c"]) == ({"a": 1, "b": [2]}, ["c"])
+
+    clock[0] += 11
+    assert c.get_many("short", ["a", "b"]) == ({}, ["a", "b"])
+    assert c.get("long", "a") == {"v": 3}
+    # putting again refreshes the entry
+    c.put("short", "a", 4)
+    assert c.get("short", "a") == 4
+    assert (c.hits, c.misses, c.expired) == (4, 3, 2)
+
+def test_oldest_entries_are_evicted(clock):
+    c = ResponseCache("", max_entries=600)
+    for i in range(999):
+        clock[0] += 1
+        c.put("ep", str(i), i)
+    # eviction runs every 1000 puts
+    assert c.evicted == 0
+    clock[0] += 1
+    c.put("ep", "999", 999)
+    assert c.evicted == 400
+    found, missing = c.get_many("ep", map(str, range(1000)))
+    assert missing == [str(i) for i in range(400)]
+    assert len(found) == 600
+
+def test_offline_never_fetches():
+    c = ResponseCache("", offline=True)
+    calls = []
+    @c.cached("ep", default="none")
+    def fetch(resource: str) -> str:
+        calls.append(resource)
+        return resource.upper()
+
+    c.put("ep", "a", "cached")
+    assert fetch("a") == "cached"
+    assert fetch("b") == "none"
+    assert calls == []
+
+    c.offline = False
+    assert fetch("b") == "B"
+    assert fetch("b") == "B"
+    assert calls == ["b"]
+
+def test_empty_results_are_not_cached():
+    c = ResponseCache("")
+    calls = []
+    @c.cached("ep", default=[], key=lambda _, host: host)
+    def fetch(api: object, host: str) -> list:
+        calls.append(host)
+        return []
+
+    assert fetch(None, "a") == []
+    assert fetch(None, "a") == []
+    assert calls == ["a", "a"]
+
+def test_persisted_only_when_configured(tmp_path, monkeypatch):
+    monkeypatch.delenv("DICE_CACHE", raising=False)
+    assert new_cache().path == ""
+
+    path = tmp_path / "cache" / "responses.duckdb"
+    monkeypatch.setenv("DICE_CACHE", str(path))
+    c = new_cache()
+    c.put("ep", "a", 1)
+    c.conn().close()
+    assert path.exists()
+    assert ResponseCache(str(path)).get("ep", "a") == 1
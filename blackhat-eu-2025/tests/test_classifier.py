@@ -0,0 +1,90 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from mods.classifier import Predicate, any_filled, every, make_cls_handler, not_null
+from conftest import FakeModule, FakeRepo, Label
+
+import pandas as pd
+import numpy as np
+import duckdb
+
+PROTOCOLS = ["modbus", "iec104", "fox", "ethernetip"]
+
+PREDICATES = {
+    "every": every(),
+    "modbus": any_filled("data_vendor", "data_product_code", "data_revision"),
+    "iec104": not_null("data_asdus"),
+}
+
+@pytest.fixture
+def fingerprints(conn):
+    "Synthetic fingerprints with nulls and empty strings in the data columns"
+    rng = np.random.default_rng(7)
+    n = 20_000
+    values = np.array(["", "Siemens", "SIMATIC", None], dtype=object)
+    conn.execute("""
+    CREATE TABLE fingerprints (
+        id VARCHAR, host VARCHAR, protocol VARCHAR, port INTEGER,
+        data_vendor VARCHAR, data_product_code VARCHAR, data_revision VARCHAR, data_asdus VARCHAR
+    )
+    """)
+    df = pd.DataFrame({
+        "id": [str(i) for i in range(n)],
+        "host": [f"10.0.{i // 256 % 256}.{i % 256}" for i in range(n)],
+        "protocol": [PROTOCOLS[i % len(PROTOCOLS)] for i in range(n)],
+        "port": 502,
+        **{c: rng.choice(values, n) for c in ["data_vendor", "data_product_code", "data_revision"]},
+        "data_asdus": np.where(rng.random(n) < .4, None, '[{"TypeID": 100, "CA": 1}]'),
+    })
+    conn.execute("INSERT INTO fingerprints SELECT * FROM df")
+    return conn
+
+def labeled(conn) -> set[tuple[str, str]]:
+    rows = conn.execute("SELECT fingerprint_id, label_id FROM labels").fetchall()
+    assert len(rows) == len(set(rows))
+    return set(rows)
+
+@pytest.mark.parametrize("protocol", PROTOCOLS)
+@pytest.mark.parametrize("pred", PREDICATES.values(), ids=PREDICATES.keys())
+def test_pushdown_matches_pandas(mod, fingerprints, protocol: str, pred: Predicate):
+    make_cls_handler(protocol, "anonymous-connection", pred, pushdown=False)(mod)
+    expected = labeled(fingerprints)
+    fingerprints.execute("DELETE FROM labels")
+
+    make_cls_handler(protocol, "anonymous-connection", pred, pushdown=True)(mod)
+    assert labeled(fingerprints) == expected
+    assert expected
+
+def test_pushdown_falls_back_to_pandas(mod, fingerprints):
+    "A predicate the database cannot evaluate is evaluated over the chunks"
+    pred = Predicate(not_null("data_asdus").mask, "f.missing_column IS NOT NULL")
+    make_cls_handler("iec104", "anonymous-connection", pred, pushdown=True)(mod)
+    n, = fingerprints.execute("SELECT COUNT(*) FROM fingerprints WHERE protocol = 'iec104' AND data_asdus IS NOT NULL").fetchone()
+    assert len(labeled(fingerprints)) == n
+
+class TupleLabel(tuple):
+    "Label model without `to_dict`, the bulk insert cannot read its columns"
+
+class TupleRepo(FakeRepo):
+    def label(self, *labels: TupleLabel) -> None:
+        self.conn.executemany("INSERT INTO labels VALUES (?, ?, ?)", [list(l) for l in labels])
+
+class TupleModule(FakeModule):
+    def __init__(self, conn: duckdb.DuckDBPyConnection):
+        self._repo = TupleRepo(conn)
+
+    def make_label(self, *args, **kwargs) -> TupleLabel:
+        return TupleLabel(Label.to_dict(super().make_label(*args, **kwargs)).values())
+
+@pytest.mark.parametrize("pushdown", [True, False])
+def test_labels_without_columns_use_repository(fingerprints, pushdown: bool):
+    make_cls_handler("iec104", "anonymous-connection", not_null("data_asdus"), pushdown)(TupleModule(fingerprints))
+    n, = fingerprints.execute("SELECT COUNT(*) FROM fingerprints WHERE protocol = 'iec104' AND data_asdus IS NOT NULL").fetchone()
+    assert len(labeled(fingerprints)) == n
+
+def test_bulk_errors_are_not_hidden(mod, fingerprints):
+    "A bug in the predicate is not mistaken for a label model the bulk insert does not fit"
+    pred = Predicate(lambda df: df["missing_column"].notna(), "f.missing_column IS NOT NULL")
+    with pytest.raises(KeyError):
+        make_cls_handler("iec104", "anonymous-connection", pred, pushdown=True)(mod)
@@ -0,0 +1,80 @@
+import pytest
+
+pytest.importorskip("dice")
+pytest.importorskip("sklearn")
+
+from mods.noise import condensation
+from mods.noise.condensation import SCORES_TABLE, describe_condensation, model_condensation, stream_condensation
+from sklearn.linear_model import LinearRegression
+from sklearn.mixture import GaussianMixture
+
+import pandas as pd
+import numpy as np
+import ipaddress
+
+@pytest.fixture
+def prefixes(conn, monkeypatch):
+    "Synthetic prefixes of every length, a few of them far denser than the rest"
+    rng = np.random.default_rng(11)
+    n = 50_000
+    lens = rng.integers(16, 25, n)
+    size = 2. ** (32 - lens)
+    count = np.maximum(1, rng.poisson(size * 1e-3)) + np.where(rng.random(n) < .01, size // 2, 0)
+    df = pd.DataFrame({"prefix": [f"10.{i // 256 % 256}.{i % 256}.0/{l}" for i, l in enumerate(lens)], "count": count.astype(np.int64)})
+    conn.execute("CREATE TABLE prefixes AS SELECT * FROM df")
+    conn.execute("SET threads = 4")
+    monkeypatch.setattr(condensation, "query_prefix_hosts", lambda: "SELECT prefix, count FROM prefixes")
+    return conn
+
+def baseline_condensation(df: pd.DataFrame) -> None:
+    "The per-prefix model the vectorised one replaced, IPv4 only. Not strict, the synthetic prefixes set host bits"
+    df["slash"] = df["prefix"].apply(lambda p: f"/{ipaddress.ip_network(p, strict=False).prefixlen}")
+    df["size"] = [2 ** (32 - ipaddress.ip_network(p, strict=False).prefixlen) for p in df["prefix"]]
+    df["density"] = df["count"] / df["size"]
+
+    X = np.asarray(np.log10(df["size"])).reshape(-1, 1)
+    y = np.asarray(np.log10(df["density"].clip(lower=1e-9)))
+    base_model = LinearRegression().fit(X, y)
+    df["expected_density"] = 10 ** base_model.predict(X)
+    df["log_excess"] = np.log10(df["density"].clip(lower=1e-9) / df["expected_density"])
+
+    Xg = np.asarray(df["log_excess"]).reshape(-1, 1)
+    gmm = GaussianMixture(n_components=2, random_state=0).fit(Xg)
+    df["p_dense"] = gmm.predict_proba(Xg)[:, np.argmax(gmm.means_)]
+
+def test_matches_baseline(prefixes):
+    df = prefixes.execute("SELECT * FROM prefixes").df()
+    # shorter prefixes than /10 sort after /16 as strings
+    df.loc[:99, "prefix"] = [f"{i}.0.0.0/{8 + i % 2}" for i in range(1, 101)]
+    expected, scored = df.copy(), df.copy()
+    baseline_condensation(expected)
+    model_condensation(scored, 0)
+
+    for c in ["slash", "size", "density"]:
+        assert (scored[c] == expected[c]).all(), c
+    np.testing.assert_allclose(scored["expected_density"], expected["expected_density"], rtol=1e-9)
+    np.testing.assert_allclose(scored["p_dense"], expected["p_dense"], atol=1e-6)
+
+    summary = describe_condensation(scored)
+    # the summary is ordered by prefix length, not by its /n label
+    assert summary["slash"].tolist() == [f"/{n}" for n in [8, 9, *range(16, 25)]]
+    per_slash = scored.groupby("slash")["p_dense"].mean()
+    np.testing.assert_allclose(summary.set_index("slash")["p_dense_mean"], per_slash[summary["slash"]], rtol=1e-9)
+
+def test_ipv6_sizes():
+    df = pd.DataFrame({"prefix": ["2001:db8::/32", "2001:db8:1::/48", "2001:db8::1", "10.0.0.0/8"], "count": [1, 1, 1, 1]})
+    condensation.prepare_condensation(df)
+    # sized over the 128 bits of IPv6, a bare address is a full-length prefix
+    assert df["size"].tolist() == [2. ** 96, 2. ** 80, 1., 2. ** 24]
+    assert df["slash"].tolist() == ["/32", "/48", "/128", "/8"]
+
+def test_sampled_fit_is_reproducible(mod, prefixes):
+    first = stream_condensation(mod, 2_000, seed=3, agreement=False)
+    second = stream_condensation(mod, 2_000, seed=3, agreement=False)
+    pd.testing.assert_frame_equal(first.sort_values("prefix", ignore_index=True), second.sort_values("prefix", ignore_index=True))
+    assert len(first)
+
+def test_scores_are_not_left_behind(mod, prefixes):
+    stream_condensation(mod, 2_000, seed=3, agreement=True)
+    assert prefixes.execute("SELECT current_setting('threads')").fetchone() == (4,)
+    assert not prefixes.execute("SELECT * FROM duckdb_tables() WHERE table_name = ?", [SCORES_TABLE]).fetchall()
@@ -0,0 +1,267 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from shodan import APIError
+from mods.cti import scanner
+from mods.cti.scanner import CACHE, ProviderSpec, Spool, batch_scan, fetch_censys, fetch_shodan, greynoise_lookup, with_cti_scn, wrap_scanner
+from conftest import FakeModule, FakeRepo
+
+import threading
+import requests
+import json
+import os
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    "Fresh response cache for each test"
+    monkeypatch.setattr(CACHE, "path", str(tmp_path / "responses.duckdb"))
+    monkeypatch.setattr(CACHE, "_conn", None)
+    monkeypatch.setattr(CACHE, "offline", False)
+    yield CACHE
+    if CACHE._conn is not None:
+        CACHE._conn.close()
+
+class FlakyProvider:
+    "Mock provider answering one record per host, failing the batches of the given hosts once"
+    def __init__(self, failing: set[str]):
+        self.failing = set(failing)
+        self.calls: list[list[str]] = []
+        self.lock = threading.Lock()
+
+    def __call__(self, api_key: str, hosts: list[str]) -> list[dict]:
+        with self.lock:
+            self.calls.append(hosts)
+            if failed := self.failing & set(hosts):
+                self.failing -= failed
+                raise RuntimeError("429 Too Many Requests")
+        return [{"ip": h} for h in hosts]
+
+def test_failed_batch_is_retried_on_resume(tmp_path):
+    hosts = [f"10.0.0.{i}" for i in range(10)]
+    spec = ProviderSpec(2, 1, 1000.)
+    spool = Spool(str(tmp_path / "scan.jsonl"))
+    provider = FlakyProvider({"10.0.0.4"})
+
+    with pytest.raises(RuntimeError):
+        batch_scan("key", hosts, provider, spec, spool)
+    # the failed batch is not spooled as an empty answer
+    spooled = set(spool.hosts())
+    assert not spooled & {"10.0.0.4", "10.0.0.5"}
+
+    provider.calls.clear()
+    batch_scan("key", hosts, provider, spec, spool)
+    assert ["10.0.0.4", "10.0.0.5"] in provider.calls
+    # the hosts of the completed batches are not asked again
+    assert {h for c in provider.calls for h in c} == set(hosts) - spooled
+    assert sorted(spool.hosts()) == sorted(hosts)
+    assert len(spool.completed()) == len(spool.hosts()) // 2
+    assert sorted(r["ip"] for recs, _ in spool.read() for r in recs) == sorted(hosts)
+
+def test_spool_drops_cut_line(tmp_path):
+    spool = Spool(str(tmp_path / "scan.jsonl"))
+    spool.write(0, ["a"], [{"ip": "a"}])
+    with open(spool.path, "a") as f:
+        f.write('{"batch": 1, "hos')
+    assert spool.completed() == {0}
+    spool.write(1, ["b", "c"], [{"ip": "b"}])
+    assert list(spool.read()) == [([{"ip": "a"}, {"ip": "b"}], ["a", "b", "c"])]
+    assert spool.hosts() == ["a", "b", "c"]
+    # batches without any of the hosts are skipped, the hosts without records still come along
+    assert list(spool.read(1, {"c"})) == [([{"ip": "b"}], ["b", "c"])]
+
+class ScanRepo(FakeRepo):
+    def __init__(self, conn, hosts: list[str]):
+        super().__init__(conn)
+        conn.execute("CREATE TABLE records_zgrab2 (ip VARCHAR)")
+        conn.executemany("INSERT INTO records_zgrab2 VALUES (?)", [[h] for h in hosts])
+        self.sources = []
+
+    def add_source(self, src) -> None:
+        self.sources.append(src)
+
+    def scanned(self) -> set[str]:
+        return {ip for ip, in self.conn.execute("SELECT ip FROM cti_scans").fetchall()}
+
+def test_only_completed_batches_are_marked(conn, tmp_path, monkeypatch):
+    monkeypatch.setattr(scanner, "SPOOL_DIR", str(tmp_path))
+    hosts = [f"10.0.0.{i}" for i in range(10)]
+    mod = FakeModule(conn)
+    mod._repo = repo = ScanRepo(conn, hosts)
+    provider = FlakyProvider({"10.0.0.4"})
+    handler = with_cti_scn("mock", "key", wrap_scanner("mock", provider, ProviderSpec(2, 1, 1000.)))
+
+    with pytest.raises(RuntimeError):
+        handler(mod)
+    marked = repo.scanned()
+    assert {"10.0.0.0", "10.0.0.1"} <= marked
+    assert not marked & {"10.0.0.4", "10.0.0.5"}
+    assert len(repo.sources) == 1
+
+    # the failed batch is still stale and asked again
+    provider.calls.clear()
+    handler(mod)
+    assert ["10.0.0.4", "10.0.0.5"] in provider.calls
+    assert not set(marked) & {h for c in provider.calls for h in c}
+    assert repo.scanned() == set(hosts)
+
+class CrashingRepo(ScanRepo):
+    "Repository failing to add a source once, like a run killed between two sources"
+    def __init__(self, conn, hosts: list[str], crash_at: int):
+        super().__init__(conn, hosts)
+        self.crash_at = crash_at
+
+    def add_source(self, src) -> None:
+        if len(self.sources) == self.crash_at:
+            self.crash_at = -1
+            raise KeyboardInterrupt
+        super().add_source(src)
+
+    def records(self) -> list[str]:
+        return sorted(r["ip"] for src in self.sources for r in src.load()[0].to_dict("records"))
+
+def test_resume_after_crash_adds_sources_once(conn, tmp_path, monkeypatch):
+    monkeypatch.setattr(scanner, "SPOOL_DIR", str(tmp_path))
+    monkeypatch.setattr(scanner, "SOURCE_CHUNK", 4)
+    monkeypatch.setattr(scanner, "with_records", lambda recs: recs)
+    hosts = [f"10.0.0.{i}" for i in range(10)]
+    mod = FakeModule(conn)
+    mod._repo = repo = CrashingRepo(conn, hosts, crash_at=1)
+    provider = FlakyProvider(set())
+    handler = with_cti_scn("mock", "key", wrap_scanner("mock", provider, ProviderSpec(2, 1, 1000.)))
+
+    with pytest.raises(KeyboardInterrupt):
+        handler(mod)
+    # the first source went in with its hosts, the rest is left in the spool
+    assert repo.scanned() == set(hosts[:4])
+    assert os.path.exists(scanner.spool_path("mock"))
+
+    # the stale hosts changed, the same spool is resumed without asking the provider again
+    provider.calls.clear()
+    handler(mod)
+    assert provider.calls == []
+    assert repo.records() == sorted(hosts)
+    assert repo.scanned() == set(hosts)
+    assert not os.path.exists(scanner.spool_path("mock"))
+
+class MockShodan:
+    def __init__(self, errors: dict[str, str]):
+        self.errors = errors
+        self.calls = 0
+
+    def host(self, host: str) -> dict:
+        self.calls += 1
+        if host in self.errors:
+            raise APIError(self.errors[host])
+        return {"ip_str": host}
+
+def test_shodan_errors_reach_the_scan():
+    api = MockShodan({"10.0.0.1": "No information available for that IP.", "10.0.0.2": "Insufficient query credits"})
+    assert fetch_shodan(api, "10.0.0.0") == {"ip_str": "10.0.0.0"}
+    assert fetch_shodan(api, "10.0.0.0") == {"ip_str": "10.0.0.0"}
+    assert api.calls == 1
+    # an unknown host is an empty answer, a quota error fails the batch
+    assert fetch_shodan(api, "10.0.0.1") == {}
+    with pytest.raises(APIError):
+        fetch_shodan(api, "10.0.0.2")
+
+class FlakyShodan(MockShodan):
+    "Fails every host with the given errors, in order, before answering"
+    def __init__(self, *errors: str):
+        super().__init__({})
+        self.pending = list(errors)
+
+    def host(self, host: str) -> dict:
+        if self.pending:
+            self.calls += 1
+            raise APIError(self.pending.pop(0))
+        return super().host(host)
+
+def test_shodan_transient_errors_are_retried():
+    api = FlakyShodan("Request rate limit reached (1/second)", "Unable to connect to Shodan")
+    assert fetch_shodan(api, "10.0.0.0", backoff=0) == {"ip_str": "10.0.0.0"}
+    assert api.calls == 3
+
+    # once the retries are exhausted, the batch fails and is asked again on resume
+    api = FlakyShodan(*["Request rate limit reached (1/second)"] * 3)
+    with pytest.raises(APIError, match="rate limit"):
+        fetch_shodan(api, "10.0.0.1", retries=2, backoff=0)
+    assert api.calls == 3
+
+def test_shodan_host_errors_skip_the_host(capsys):
+    api = MockShodan({"10.0.0.0": "Invalid IP"})
+    assert fetch_shodan(api, "10.0.0.0") == {}
+    assert "shodan: skipping 10.0.0.0: Invalid IP" in capsys.readouterr().out
+    # nothing is cached for the skipped host
+    assert fetch_shodan(api, "10.0.0.0") == {}
+    assert api.calls == 2
+
+def test_shodan_client_built_once(monkeypatch):
+    built = []
+    monkeypatch.setattr(scanner, "Shodan", lambda key: built.append(key) or MockShodan({}))
+    scanner.shodan_client.cache_clear()
+    try:
+        assert len(scanner.shodan_scanner("key", ["10.0.0.0"])) == 1
+        assert len(scanner.shodan_scanner("key", ["10.0.0.1"])) == 1
+        assert built == ["key"]
+    finally:
+        scanner.shodan_client.cache_clear()
+
+class MockGreyNoise:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.asked: list[list[str]] = []
+
+    def quick(self, hosts: list[str]) -> list[dict]:
+        self.asked.append(hosts)
+        if self.fail:
+            raise RuntimeError("rate limit reached")
+        return [{"ip": h} for h in hosts]
+
+def test_greynoise_errors_reach_the_scan():
+    with pytest.raises(RuntimeError):
+        greynoise_lookup(MockGreyNoise(fail=True), "10.0.0.0")
+    api = MockGreyNoise()
+    assert len(greynoise_lookup(api, "10.0.0.0", "10.0.0.1")) == 2
+    assert len(greynoise_lookup(api, "10.0.0.1", "10.0.0.2")) == 2
+    assert api.asked == [["10.0.0.0", "10.0.0.1"], ["10.0.0.2"]]
+
+class StubCensys(BaseHTTPRequestHandler):
+    "Answers a record per asked host, or the scripted status codes in order"
+    script: list[int] = []
+    asked: list[list[str]] = []
+
+    def do_POST(self) -> None:
+        hosts = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["host_ids"]
+        self.asked.append(hosts)
+        status = self.script.pop(0) if self.script else 200
+        body = json.dumps({"data": [{"resource": {"ip": h}} for h in hosts]}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_) -> None:
+        return
+
+@pytest.fixture
+def censys(monkeypatch):
+    StubCensys.script, StubCensys.asked = [], []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubCensys)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(scanner, "CENSYS_API", f"http://127.0.0.1:{server.server_address[1]}")
+    yield StubCensys
+    server.shutdown()
+    server.server_close()
+
+def test_censys_errors_reach_the_scan(censys):
+    censys.script = [429]
+    with pytest.raises(requests.HTTPError):
+        fetch_censys("key", "10.0.0.0")
+
+    assert len(fetch_censys("key", "10.0.0.0", "10.0.0.1")) == 2
+    assert len(fetch_censys("key", "10.0.0.1", "10.0.0.2")) == 2
+    assert censys.asked[1:] == [["10.0.0.0", "10.0.0.1"], ["10.0.0.2"]]
@@ -0,0 +1,44 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from mods.noise.displacement import ENIP_IDENTITY, enip_odd, iec_odd, identity_odd
+
+import pandas as pd
+import json
+
+def items(serial: int, product_code: int = 54, vendor_id: int = 1) -> str:
+    return json.dumps([{"serial": serial, "vendor_id": vendor_id, "product_code": product_code}])
+
+@pytest.fixture
+def fingerprints(conn):
+    "Devices of the same products, a few of them with the serial of another host"
+    rows = []
+    # 50 hosts of a single ENIP product, each with its own serial
+    for i in range(50):
+        rows.append([f"enip-{i}", f"10.0.0.{i}", "ethernetip", 44818, items(1000 + i), None, None, None])
+    # the same serial answered by 3 hosts
+    for i in range(3):
+        rows.append([f"clone-{i}", f"10.0.1.{i}", "ethernetip", 44818, items(7079450), None, None, None])
+    # the same serial on 2 ports of a single host is still one device
+    for port in [44818, 2222]:
+        rows.append([f"ports-{port}", "10.0.2.1", "ethernetip", port, items(4242), None, None, None])
+    # 50 modbus hosts of the same product, identical MEI objects
+    for i in range(50):
+        rows.append([f"modbus-{i}", f"10.0.3.{i}", "modbus", 502, None, "Schneider Electric", "BMX P34 2020", "v2.6"])
+    df = pd.DataFrame(rows, columns=["id", "host", "protocol", "port", "data_items", "data_vendor", "data_product_code", "data_revision"])
+    conn.execute("CREATE TABLE fingerprints AS SELECT *, NULL::VARCHAR AS data_asdus FROM df")
+    return conn
+
+def tagged(conn) -> dict[str, str]:
+    return dict(conn.execute("SELECT host, details FROM tags WHERE tag_id = 'odd'").fetchall())
+
+def test_reused_serials(mod, fingerprints):
+    identity_odd(mod, ENIP_IDENTITY)
+    assert tagged(fingerprints) == {f"10.0.1.{i}": "reused serial: shared by 3 hosts" for i in range(3)}
+
+def test_same_product_is_not_odd(mod, fingerprints):
+    "Devices of the same product share everything but their serial, none of them is odd"
+    for odd in [enip_odd, iec_odd]:
+        odd(mod)
+    assert set(tagged(fingerprints)) == {f"10.0.1.{i}" for i in range(3)}
@@ -0,0 +1,94 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from mods.ethernetip import fingerprint as eip
+from mods.ethernetip.fingerprint import build_catalogue, decode_list_identity, fingerprint_chunk, parse_list_identity
+
+import pandas as pd
+import struct
+
+@pytest.fixture
+def catalogue():
+    vendors = pd.DataFrame({
+        "vendor_id": [1, 2, 1],
+        "Vendor Name": ["Rockwell Automation/Allen-Bradley", "Reserved", "Duplicate"],
+        "DNet": [1, -1, 1],
+        "CNet": [1, -1, 1],
+        "ENet": [1, -1, 1],
+    })
+    devices = pd.DataFrame({"device_id": [12], "Name": ["Communications Adapter"]})
+    return build_catalogue(vendors, devices)
+
+@pytest.fixture(autouse=True)
+def record_field(monkeypatch):
+    # the per-packet parser reads the raw response through dice
+    monkeypatch.setattr(eip, "get_record_field", lambda r, field: r[field])
+
+def identity(serial: int = 0xDEADBEEF, name: bytes = b"1756-EN2T/D", name_length: int | None = None, state: int | None = 3) -> bytes:
+    "Identity item of a ListIdentity response"
+    data = struct.pack("<H", 1) + struct.pack("!HHI", 2, 44818, 0xC0A80001) + b"\0" * 8
+    data += struct.pack("<HHHBBHI", 1, 12, 166, 11, 2, 0x0030, serial)
+    data += bytes([len(name) if name_length is None else name_length]) + name
+    return data + (bytes([state]) if state is not None else b"")
+
+def item(data: bytes, item_type: int = 0x0C, length: int | None = None) -> bytes:
+    return struct.pack("<HH", item_type, len(data) if length is None else length) + data
+
+def list_identity(*items: bytes, count: int | None = None, trailing: bytes = b"") -> str:
+    payload = struct.pack("<H", len(items) if count is None else count) + b"".join(items)
+    header = struct.pack("<HHII", 0x63, len(payload), 0, 0) + b"\0" * 8 + struct.pack("<I", 0)
+    return (header + payload + trailing).hex()
+
+# hex response and the reason the vectorised decoder rejects it, if any
+PACKETS = {
+    "identity": (list_identity(item(identity())), None),
+    "no state": (list_identity(item(identity(state=None))), None),
+    "trailing bytes": (list_identity(item(identity()), trailing=b"\xff" * 5), None),
+    "name past the item": (list_identity(item(identity(name_length=40))), None),
+    "item length too long": (list_identity(item(identity(), length=200)), None),
+    "item length too short": (list_identity(item(identity(), length=20)), "short identity item"),
+    "zero items": (list_identity(), "multiple items"),
+    "two items": (list_identity(item(identity()), item(identity(serial=1))), "multiple items"),
+    "missing item": (list_identity(item(identity()), count=2), "multiple items"),
+    "other item": (list_identity(item(b"\x01\x02", item_type=0x86)), "not an identity item"),
+    "header only": (list_identity()[:48], "no items"),
+    "truncated count": (list_identity()[:50], "multiple items"),
+    "truncated header": (list_identity()[:20], "short header"),
+    "truncated item": (list_identity(item(identity()))[:100], "short identity item"),
+    "invalid hex": ("zz", "invalid hex"),
+    "missing": (None, "missing"),
+}
+
+def parsed(h: str | None, catalogue) -> dict | None:
+    "Fingerprint of the per-packet parser, None when it cannot parse the packet"
+    try:
+        return parse_list_identity(h, catalogue) if h is not None else None
+    except (ValueError, IndexError, struct.error):
+        return None
+
+def test_catalogue_lookups(catalogue):
+    # the first of duplicated ids is kept
+    assert catalogue.vendor(1) == ("Rockwell Automation/Allen-Bradley", "active")
+    assert catalogue.vendor(2) == ("Reserved", "reserved")
+    assert catalogue.vendor(3) == ("Unknown (3)", "unknown")
+    assert catalogue.device(12) == "Communications Adapter"
+    assert catalogue.device(0) == "Unknown (0)"
+    assert (catalogue.lookups, catalogue.misses) == (5, 2)
+    assert catalogue.summary() == "5 vendor/device lookups (2 unknown)"
+
+def test_rejects():
+    col = pd.Series([h for h, _ in PACKETS.values()], dtype=object)
+    reject = [r if pd.notna(r) else None for r in decode_list_identity(col)["reject"]]
+    assert reject == [r for _, r in PACKETS.values()]
+
+def test_chunk_matches_parser(catalogue, capsys):
+    df = pd.DataFrame({"ListIdentityRaw_Response": [h for h, _ in PACKETS.values()]})
+    fps = fingerprint_chunk(df, catalogue)
+    assert len(fps) == len({i for i, _ in fps})
+
+    expected = {i: parsed(h, catalogue) for i, (h, _) in enumerate(PACKETS.values()) if h is not None}
+    assert dict(fps) == expected
+    assert expected[list(PACKETS).index("identity")]["items"][0]["serial"] == 0xDEADBEEF
+    # packets neither parser reads are reported
+    assert "ethernetip: 6 malformed ListIdentity responses" in capsys.readouterr().out
@@ -0,0 +1,75 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from mods import fingerprint
+
+import pandas as pd
+import importlib
+import time
+
+ROWS = 100
+CHUNK = 7
+
+class PoolModule:
+    "Module reading its zgrab2 records from a frame, in chunks, and keeping the fingerprints it writes"
+
+    def __init__(self):
+        self.df = pd.DataFrame({"id": range(ROWS), "value": [i * 3 for i in range(ROWS)]})
+        self.written: list[tuple[int, dict, str]] = []
+
+    def repo(self) -> 'PoolModule':
+        return self
+
+    def with_pbar(self, handler, _) -> None:
+        for i in range(0, ROWS, CHUNK):
+            handler(self.df.iloc[i:i + CHUNK])
+
+    def make_fingerprint(self, row: pd.Series, fp: dict, protocol: str) -> tuple[int, dict, str]:
+        return (int(row["id"]), fp, protocol)
+
+    def fingerprint(self, *recs: tuple[int, dict, str]) -> None:
+        self.written.extend(recs)
+
+def fingerprint_row(row: pd.Series) -> dict | None:
+    # every fifth record is malformed
+    return {"value": int(row["value"])} if row["id"] % 5 else None
+
+def fingerprint_chunk(df: pd.DataFrame) -> list[tuple[int, dict | None]]:
+    # the first chunks take the longest, so later ones finish first
+    time.sleep(max(0., .05 - df["id"].iloc[0] / 1_000))
+    return [(i, fingerprint_row(r)) for i, (_, r) in enumerate(df.iterrows())]
+
+def failing_chunk(df: pd.DataFrame) -> list[tuple[int, dict | None]]:
+    if (df["id"] == 50).any():
+        raise ValueError("bad chunk")
+    return fingerprint.rowwise(fingerprint_row, df)
+
+EXPECTED = [(i, {"value": i * 3}, "modbus") for i in range(ROWS) if i % 5]
+
+@pytest.fixture
+def fp(monkeypatch):
+    "The fingerprint module, with two workers by default"
+    monkeypatch.setenv("DICE_FP_WORKERS", "2")
+    yield importlib.reload(fingerprint)
+    monkeypatch.undo()
+    importlib.reload(fingerprint)
+
+def test_pool_matches_sequential(fp, capsys):
+    assert fp.WORKERS == 2
+    seq = PoolModule()
+    fp.make_pool_fp_handler(fingerprint_chunk, "modbus", workers=0)(seq)
+    pool = PoolModule()
+    fp.make_pool_fp_handler(fingerprint_chunk, "modbus")(pool)
+    assert seq.written == EXPECTED
+    assert pool.written == EXPECTED
+    assert capsys.readouterr().out.count("modbus: 20 malformed records skipped") == 2
+
+def test_parallel_rows_keep_order(fp):
+    mod = PoolModule()
+    fp.make_parallel_fp_handler(fingerprint_row, "modbus")(mod)
+    assert mod.written == EXPECTED
+
+def test_worker_errors_propagate(fp):
+    with pytest.raises(ValueError, match="bad chunk"):
+        fp.make_pool_fp_handler(failing_chunk, "modbus")(PoolModule())
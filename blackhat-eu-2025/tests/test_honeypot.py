@@ -0,0 +1,89 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from mods.noise.honeypot import HoneypotSignature, SignatureIndex, get_honeypot_signatures, load_honeypot_signatures
+from mods.noise.displacement import honeypot_tag
+from mods.ethernetip.fingerprint import EIPCatalogue, parse_list_identity
+from mods.modbus import fingerprint as modbus
+from mods.iec104 import fingerprint as iec104
+
+import pandas as pd
+import struct
+import json
+
+def banner(name: str, regex: str) -> HoneypotSignature:
+    return HoneypotSignature(name, "ssh", name, banner="banner", regex=regex)
+
+def test_shipped_signatures_load():
+    # only identities of the protocols there is a fingerprinter for
+    signatures = get_honeypot_signatures("")
+    assert {(s.name, s.protocol) for s in signatures} == {("conpot", "modbus"), ("conpot", "ethernetip"), ("conpot", "iec104")}
+
+def list_identity(product: bytes, serial: int) -> str:
+    "ListIdentity response with a single identity item"
+    item = struct.pack("<H", 1) + struct.pack("!HHI", 2, 44818, 0xC0A80001) + b"\0" * 8
+    item += struct.pack("<HHHBBHI", 1, 14, 54, 16, 11, 0x0030, serial) + bytes([len(product)]) + product + b"\3"
+    payload = struct.pack("<HHH", 1, 0x0C, len(item)) + item
+    return (struct.pack("<HHII", 0x63, len(payload), 0, 0) + b"\0" * 12 + payload).hex()
+
+def fingerprints(monkeypatch) -> pd.DataFrame:
+    "Fingerprint rows made by the fingerprinters, with their data spread into data columns. Conpot defaults on even hosts"
+    for m in [modbus, iec104]:
+        monkeypatch.setattr(m, "get_record_field", lambda r, field, default=None: r.get(field, default))
+    catalogue = EIPCatalogue({}, {})
+    fps = [
+        ("modbus", 502, modbus.fingerprint({"mei_response": {"objects": {"vendor": "Siemens", "product_code": "SIMATIC", "revision": "S7-200"}}})),
+        ("modbus", 502, modbus.fingerprint({"mei_response": {"objects": {"vendor": "Siemens", "product_code": "SIMATIC", "revision": "S7-1200"}}})),
+        ("ethernetip", 44818, parse_list_identity(list_identity(b"1756-L61/B LOGIX5561", 7079450), catalogue)),
+        ("ethernetip", 44818, parse_list_identity(list_identity(b"1756-L61/B LOGIX5561", 7079451), catalogue)),
+        ("iec104", 2404, iec104.fingerprint({"interrogation": json.dumps([{"TypeID": 100, "CA": 7720}, {"TypeID": 36, "CA": 7720}])})),
+        ("iec104", 2404, iec104.fingerprint({"interrogation": json.dumps([{"TypeID": 100, "CA": 7720}, {"TypeID": 36, "CA": 1}])})),
+    ]
+    return pd.DataFrame([{
+        "id": str(i), "host": f"10.0.0.{i}", "protocol": protocol, "port": port,
+        **{f"data_{k}": json.dumps(v) if isinstance(v, (list, dict)) else v for k, v in fp.items()},
+    } for i, (protocol, port, fp) in enumerate(fps)])
+
+def test_identities_match_fingerprint_columns(monkeypatch):
+    index = SignatureIndex(get_honeypot_signatures(""))
+    df = fingerprints(monkeypatch)
+    matched = [[s.details for s in index.match(r["protocol"], r)] for r in df.to_dict("records")]
+    assert matched == [
+        ["conpot default Modbus device identification"], [],
+        ["conpot default EtherNet/IP identity"], [],
+        ["conpot default IEC 104 template"], [],
+    ]
+
+def test_honeypot_tag(mod, conn, monkeypatch):
+    df = fingerprints(monkeypatch)
+    conn.execute("CREATE TABLE fingerprints AS SELECT * FROM df")
+    honeypot_tag(mod)
+    tagged = conn.execute("SELECT host, protocol, port FROM tags WHERE tag_id = 'honeypot' ORDER BY host").fetchall()
+    assert tagged == [("10.0.0.0", "modbus", 502), ("10.0.0.2", "ethernetip", 44818), ("10.0.0.4", "iec104", 2404)]
+
+def test_banners_combined():
+    index = SignatureIndex([
+        banner("cowrie", r"^SSH-2\.0-OpenSSH_6\.0p1 (Debian|Ubuntu)"),
+        banner("kippo", r"^SSH-2\.0-OpenSSH_5\.1p1 [\1]"),
+    ])
+    assert [s.name for s in index.match("ssh", {"data_banner": "SSH-2.0-OpenSSH_6.0p1 Ubuntu"})] == ["cowrie"]
+    assert [s.name for s in index.match("ssh", {"data_banner": "SSH-2.0-OpenSSH_5.1p1 \x01"})] == ["kippo"]
+    assert not index.match("ssh", {"data_banner": "SSH-2.0-OpenSSH_8.9"})
+
+@pytest.mark.parametrize("regex", [
+    r"^SSH-(?P<version>\d)",
+    r"^(a)\1$",
+    r"^(?P<x>a)(?P=x)$",
+    r"^(a)?(?(1)b|c)$",
+    r"^SSH-(",
+])
+def test_group_references_rejected(regex: str):
+    with pytest.raises(ValueError, match="honeypot signature cowrie"):
+        banner("cowrie", regex)
+
+def test_rejected_when_loading(tmp_path):
+    path = tmp_path / "signatures.json"
+    path.write_text(json.dumps([{"name": "cowrie", "protocol": "ssh", "banner": "banner", "regex": r"^(?P<s0>SSH)"}]))
+    with pytest.raises(ValueError, match=f"{path}: honeypot signature cowrie \\(ssh\\).*named groups \\(s0\\)"):
+        load_honeypot_signatures(str(path))
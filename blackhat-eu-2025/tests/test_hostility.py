@@ -0,0 +1,55 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from mods.noise.hostility import tag_hostile
+
+import pandas as pd
+import json
+
+OBJECTS = ["vendor", "product_code", "revision", "vendor_url", "product_name", "model_name", "user_app_name", "serial"]
+
+@pytest.fixture
+def fingerprints(conn):
+    "Modbus devices answering the 3 basic objects, and IEC 104 outstations answering a handful of IOAs"
+    rows = []
+    for i in range(100):
+        n, more = (len(OBJECTS), True) if i < 2 else (len(OBJECTS), False) if i < 4 else (3, i % 2 == 0)
+        rows.append({
+            "id": f"modbus-{i}", "host": f"10.0.0.{i}", "protocol": "modbus", "port": 502,
+            "data_more_follows": more, "data_object_count": n, "data_unit_id": 1,
+            **{f"data_{o}": "x" for o in OBJECTS[:n]},
+        })
+    for i in range(100):
+        ioas = [{"Address": a, "Data": a} for a in range(500 if i == 0 else 5)]
+        rows.append({
+            "id": f"iec-{i}", "host": f"10.0.1.{i}", "protocol": "iec104", "port": 2404,
+            "data_asdus": json.dumps([{"TypeID": 36, "CA": 1, "IOAs": ioas}]),
+        })
+    df = pd.DataFrame(rows)
+    conn.execute("CREATE TABLE fingerprints AS SELECT * FROM df")
+    return conn
+
+def test_tag_hostile(mod, fingerprints):
+    tag_hostile(mod)
+    tagged = dict(fingerprints.execute("SELECT host, details FROM tags WHERE tag_id = 'tarpit'").fetchall())
+    # many objects are only a tarpit when more keep following
+    assert tagged == {
+        "10.0.0.0": "too many objects. More follows",
+        "10.0.0.1": "too many objects. More follows",
+        "10.0.1.0": "too many IOAs",
+    }
+
+def test_threshold_of_responses_with_more_following(mod, fingerprints):
+    "Complete responses answering every object do not raise the threshold"
+    filled = ", ".join(f"data_{o} = 'x'" for o in OBJECTS)
+    fingerprints.execute(f"UPDATE fingerprints SET {filled} WHERE protocol = 'modbus' AND NOT data_more_follows")
+    tag_hostile(mod)
+    hosts = {h for h, in fingerprints.execute("SELECT host FROM tags WHERE tag_id = 'tarpit'").fetchall()}
+    assert hosts == {"10.0.0.0", "10.0.0.1", "10.0.1.0"}
+
+def test_tag_hostile_without_more_follows(mod, fingerprints):
+    fingerprints.execute("ALTER TABLE fingerprints DROP COLUMN data_more_follows")
+    tag_hostile(mod)
+    hosts = {h for h, in fingerprints.execute("SELECT host FROM tags WHERE tag_id = 'tarpit'").fetchall()}
+    assert hosts == {"10.0.1.0"}
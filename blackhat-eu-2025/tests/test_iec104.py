@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from mods.iec104.query import IOAS_TABLE, unnest_iec104_ioas
+from mods.noise.displacement import iec_odd
+
+import json
+
+def asdus(*items: tuple[int, int, list[tuple[int, str]]]) -> str:
+    return json.dumps([{"TypeID": t, "CA": ca, "IOAs": [{"Address": a, "Data": v} for a, v in ioas]} for t, ca, ioas in items])
+
+@pytest.fixture
+def fingerprints(conn):
+    conn.execute("CREATE TABLE fingerprints (id VARCHAR, host VARCHAR, protocol VARCHAR, port INTEGER, data_asdus VARCHAR)")
+    conn.executemany("INSERT INTO fingerprints VALUES (?, ?, 'iec104', 2404, ?)", [
+        # answers the interrogation of the scanned CA
+        ["filled", "10.0.0.1", asdus((100, 1, []))],
+        # same IOA twice with the same value
+        ["repeated", "10.0.0.2", asdus((36, 7, [(5, "1.5"), (5, "1.5")]))],
+        ["plain", "10.0.0.3", asdus((36, 7, [(5, "1.5"), (6, "2.5")]))],
+        ["other ca", "10.0.0.4", asdus((100, 9, []))],
+    ])
+    return conn
+
+def test_iec_odd_single_ca(mod, fingerprints):
+    "With a single scanned CA, a fingerprint still needs to answer it"
+    iec_odd(mod, [1])
+    tagged = dict(fingerprints.execute("SELECT host, details FROM tags").fetchall())
+    assert tagged.keys() == {"10.0.0.1", "10.0.0.2"}
+    assert tagged["10.0.0.1"] == "too many filled addresses"
+
+@pytest.mark.parametrize("scanned, filled", [([1, 2], True), ([1, 2, 10, 65535], False)])
+def test_iec_odd_threshold(mod, fingerprints, scanned: list[int], filled: bool):
+    "3 quarters of the scanned CAs rounded down: 1 of 2 is enough, 1 of 4 is not"
+    iec_odd(mod, scanned)
+    assert ("10.0.0.1" in dict(fingerprints.execute("SELECT host, details FROM tags").fetchall())) == filled
+
+def test_ioas_table_is_temporary(mod, fingerprints):
+    unnest_iec104_ioas(mod.repo())
+    assert fingerprints.execute("SELECT temporary FROM duckdb_tables() WHERE table_name = ?", [IOAS_TABLE]).fetchall() == [(True,)]
+    n, = fingerprints.execute(f"SELECT COUNT(*) FROM {IOAS_TABLE}").fetchone()
+    assert n == 6
+
+    # built once, unless asked to
+    fingerprints.execute("DELETE FROM fingerprints WHERE id = 'plain'")
+    unnest_iec104_ioas(mod.repo())
+    assert fingerprints.execute(f"SELECT COUNT(*) FROM {IOAS_TABLE}").fetchone() == (n,)
+    unnest_iec104_ioas(mod.repo(), rebuild=True)
+    assert fingerprints.execute(f"SELECT COUNT(*) FROM {IOAS_TABLE}").fetchone() == (n - 2,)
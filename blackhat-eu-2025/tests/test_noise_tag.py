@@ -0,0 +1,102 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from mods.noise import displacement, tag
+from mods.noise.tag import DISPLACEMENT_TAGGERS, get_noise_tag, run_taggers
+from mods.tagger import BufferedModule, TagBuffer
+
+import threading
+import duckdb
+import pandas as pd
+import numpy as np
+import json
+
+def make_fingerprints(conn: duckdb.DuckDBPyConnection, n: int) -> None:
+    "Fingerprints of every protocol the displacement taggers look at, a few honeypots and clones among them"
+    rng = np.random.default_rng(5)
+    rows = []
+    for i in range(n):
+        host = f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"
+        match i % 5:
+            case 0:
+                serial = 7079450 if i % 250 == 0 else int(rng.integers(1, 10**6))
+                items = [{"serial": serial, "vendor_id": 1, "product_code": 54, "product_full_name": "1756-L61/B LOGIX5561"}]
+                rows.append({"host": host, "protocol": "ethernetip", "port": 44818, "data_items": json.dumps(items)})
+            case 1:
+                ca = 7720 if i % 250 == 1 else int(rng.choice([1, 3, 7]))
+                asdus = [{"TypeID": 36, "CA": ca, "IOAs": [{"Address": a, "Data": str(rng.integers(3))} for a in range(4)]}]
+                rows.append({"host": host, "protocol": "iec104", "port": 2404, "data_asdus": json.dumps(asdus)})
+            case 2:
+                vendor = "Siemens" if i % 250 == 2 else "Schneider Electric"
+                rows.append({"host": host, "protocol": "modbus", "port": 502, "data_vendor": vendor, "data_product_code": "SIMATIC", "data_revision": "S7-200"})
+            case 3:
+                rows.append({"host": host, "protocol": "fox", "port": 1911, "data_version": "1.0.1", "data_hostname": f"h{i % 300}", "data_app_version": "3.8.38"})
+            case 4:
+                banner = "SSH-2.0-OpenSSH_6.0p1 Debian-4+deb7u2" if i % 250 == 4 else "SSH-2.0-OpenSSH_8.9"
+                rows.append({"host": host, "protocol": "ssh", "port": 22, "data_banner": banner})
+    df = pd.DataFrame(rows)
+    df.insert(0, "id", [str(i) for i in range(len(df))])
+    conn.execute("CREATE OR REPLACE TABLE fingerprints AS SELECT * FROM df")
+
+    zmap = pd.DataFrame({
+        "saddr": df["host"].to_numpy()[rng.integers(0, len(df), 4 * n)],
+        "dport": rng.integers(1, 65536, 4 * n),
+        "window": rng.choice([0, 6372, 505, 64_800, 29_200], 4 * n),
+        "tcpopt_wscale": rng.choice([64, 128, 7], 4 * n),
+    })
+    conn.execute("CREATE OR REPLACE TABLE records_zmap AS SELECT * FROM zmap")
+
+@pytest.fixture(autouse=True)
+def zmap_ports(monkeypatch):
+    monkeypatch.setattr(displacement.dq, "query_zmap_ports", lambda: "SELECT saddr AS ip, COUNT(*) AS count FROM records_zmap GROUP BY saddr")
+
+def tags(conn) -> list[tuple]:
+    return sorted(conn.execute("SELECT host, tag_id, details, protocol, port FROM tags").fetchall())
+
+def test_sequential_by_default(monkeypatch):
+    assert get_noise_tag("displacement") is displacement.tag_displaced
+    monkeypatch.setattr(tag, "WORKERS", 4)
+    assert get_noise_tag("displacement") is tag.tag_displaced_concurrently
+
+def test_concurrent_tags_match_sequential(mod, conn):
+    make_fingerprints(conn, 5_000)
+    displacement.tag_displaced(mod)
+    expected = tags(conn)
+    conn.execute("DELETE FROM tags")
+
+    run_taggers(mod, DISPLACEMENT_TAGGERS, workers=4)
+    assert tags(conn) == expected
+    assert {t for _, t, *_ in expected} == {"honeypot", "aletheia", "telescope", "odd"}
+
+def test_failing_tagger_releases_the_lock(mod, conn):
+    "A tagger raising in the middle of a stream fails the run, without keeping the other taggers waiting"
+    make_fingerprints(conn, 5_000)
+    def failing(mod) -> None:
+        _, gen = mod.repo().queryb("SELECT * FROM fingerprints")
+        next(gen)
+        raise RuntimeError("evaluator failed")
+
+    buffer = TagBuffer(mod)
+    errors = []
+    def run() -> None:
+        try:
+            run_taggers(BufferedModule(mod, buffer), {"failing": failing, **DISPLACEMENT_TAGGERS}, workers=2)
+        except RuntimeError as e:
+            errors.append(e)
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    t.join(60)
+    assert not t.is_alive()
+    assert [str(e) for e in errors] == ["evaluator failed"]
+
+    acquired = []
+    def acquire() -> None:
+        if ok := buffer.lock.acquire(timeout=1):
+            buffer.lock.release()
+        acquired.append(ok)
+    other = threading.Thread(target=acquire)
+    other.start()
+    other.join()
+    assert acquired == [True]
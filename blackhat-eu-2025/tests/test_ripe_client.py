@@ -0,0 +1,102 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from mods.ripe.client import RipeStatClient, retry_after
+
+import threading
+import requests
+import json
+import time
+
+class StubRipeStat(BaseHTTPRequestHandler):
+    "Answers the scripted status codes of each resource in order, then 200"
+    script: dict[str, list[tuple[int, dict[str, str]]]] = {}
+    calls: dict[str, int] = {}
+    lock = threading.Lock()
+
+    def do_GET(self) -> None:
+        resource = self.path.split("resource=")[-1]
+        with self.lock:
+            self.calls[resource] = self.calls.get(resource, 0) + 1
+            steps = self.script.get(resource, [])
+            status, headers = steps.pop(0) if steps else (200, {})
+        body = json.dumps({"data": {"resource": resource}}).encode()
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_) -> None:
+        return
+
+@pytest.fixture
+def stub():
+    StubRipeStat.script, StubRipeStat.calls = {}, {}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubRipeStat)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", StubRipeStat
+    server.shutdown()
+    server.server_close()
+
+def new_client(api: str, **kwargs) -> RipeStatClient:
+    return RipeStatClient(api=api, **{"workers": 4, "rate": 1000., "backoff": .01, **kwargs})
+
+def test_retry_after():
+    assert retry_after(None) == 0
+    assert retry_after("2") == 2
+    assert retry_after("not a date") == 0
+    assert retry_after(format_datetime(datetime.now(timezone.utc) - timedelta(seconds=30), usegmt=True)) == 0
+    assert 0 < retry_after(format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)) <= 30
+
+def test_get(stub):
+    api, server = stub
+    client = new_client(api)
+    assert client.get("ris", {"resource": "a"}) == {"data": {"resource": "a"}}
+    assert client.metrics()["requests"] == 1
+
+def test_retries_429_and_5xx(stub):
+    api, server = stub
+    # the date drops the fraction of a second, it is still at least a second away
+    date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=2), usegmt=True)
+    server.script = {
+        "a": [(429, {"Retry-After": "0"}), (503, {})],
+        "b": [(429, {"Retry-After": date})],
+    }
+    client = new_client(api)
+    start = time.perf_counter()
+    assert client.get("ris", {"resource": "a"})["data"]["resource"] == "a"
+    assert client.get("ris", {"resource": "b"})["data"]["resource"] == "b"
+    # an HTTP-date Retry-After is waited for, not a fatal error
+    assert time.perf_counter() - start >= .5
+    assert server.calls == {"a": 3, "b": 2}
+    m = client.metrics()
+    assert (m["requests"], m["retried"], m["failed"]) == (5, 3, 0)
+
+def test_gives_up(stub):
+    api, server = stub
+    server.script = {"a": [(500, {})] * 3, "b": [(404, {})]}
+    client = new_client(api, retries=2)
+    with pytest.raises(requests.HTTPError):
+        client.get("ris", {"resource": "a"})
+    # client errors are not retried
+    with pytest.raises(requests.HTTPError):
+        client.get("ris", {"resource": "b"})
+    assert server.calls == {"a": 3, "b": 1}
+    assert client.metrics()["failed"] == 2
+
+def test_map_is_rate_limited(stub):
+    api, _ = stub
+    client = new_client(api, workers=4, rate=20.)
+    start = time.perf_counter()
+    res = client.map(lambda r: client.get("ris", {"resource": r})["data"]["resource"], [str(i) for i in range(24)])
+    # the bucket starts full with a burst of 4, the other 20 requests take a second
+    assert time.perf_counter() - start >= .9
+    assert res == [str(i) for i in range(24)]
@@ -0,0 +1,212 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from mods.ripe.helpers import PrefixIndex, PrefixTree, build_pfx2as_index, build_prefix_index, read_pfx2as
+
+from conftest import FakeRepo
+
+import mods.ripe.scanner as scanner
+import numpy as np
+import duckdb
+import gzip
+import ipaddress
+import pytricia
+import random
+
+PREFIXES = [
+    "10.0.0.0/8", "10.1.0.0/16", "10.1.2.0/24", "10.1.2.128/25", "10.1.2.128/32",
+    "10.1.0.0/16",  # duplicate, the last one wins
+    "192.168.0.0/16", "192.168.0.0/17", "192.168.128.0/17",
+    "0.0.0.0/1", "255.255.255.255/32",
+    "2001:db8::/32", "2001:db8:1::/48", "2001:db8:1:2::/64", "2001:db8:1:2::1/128",
+    "2001:db8:1::/48",
+    "::ffff:0:0/96", "fe80::/10", "ffff:ffff:ffff:ffff:ffff:ffff:ffff:fffe/127",
+]
+
+INVALID = ["not an ip", "10.0.0.256", "10.1.2", "10.1.2.3.4", "", "2001:db8::zz", "2001:db8:::1"]
+
+def addresses(seed: int = 3) -> list[str]:
+    "Both ends of every prefix, the addresses around them and random ones"
+    rng = random.Random(seed)
+    addrs = []
+    for p in PREFIXES:
+        n = ipaddress.ip_network(p)
+        addr, top = type(n.network_address), 2 ** n.max_prefixlen - 1
+        for a in [int(n.network_address), int(n.broadcast_address)]:
+            addrs += [str(addr(v)) for v in sorted({max(a - 1, 0), a, min(a + 1, top)})]
+        addrs.append(str(addr(int(n.network_address) + rng.randrange(n.num_addresses))))
+    addrs += [str(ipaddress.IPv4Address(rng.getrandbits(32))) for _ in range(500)]
+    addrs += [str(ipaddress.IPv6Address((0x20010DB8 << 96) | rng.getrandbits(96))) for _ in range(500)]
+    return addrs + INVALID
+
+def tricia(prefixes: list[str]) -> tuple[pytricia.PyTricia, pytricia.PyTricia]:
+    v4, v6 = pytricia.PyTricia(32), pytricia.PyTricia(128)
+    for i, p in enumerate(prefixes):
+        (v6 if ":" in p else v4)[p] = i
+    return v4, v6
+
+def tricia_get(trees: tuple[pytricia.PyTricia, pytricia.PyTricia], addr: str) -> int:
+    try:
+        v = trees[":" in addr].get(addr)
+    except (KeyError, ValueError):
+        v = None
+    return -1 if v is None else v
+
+@pytest.fixture(scope="module")
+def expected() -> tuple[list[str], list[int]]:
+    trees = tricia(PREFIXES)
+    addrs = addresses()
+    return addrs, [tricia_get(trees, a) for a in addrs]
+
+def test_tree_matches_pytricia(expected):
+    addrs, owners = expected
+    tree = PrefixTree()
+    for i, p in enumerate(PREFIXES):
+        tree.add(p, i)
+    assert [-1 if (v := tree.get(a)) is None else v for a in addrs] == owners
+    assert [tree.has(a) for a in addrs] == [o >= 0 for o in owners]
+
+def test_index_matches_pytricia(expected):
+    addrs, owners = expected
+    index = build_prefix_index(PREFIXES)
+    assert index.lookup(addrs).tolist() == owners
+    # the innermost prefixes match, the first of the duplicates never does
+    assert 1 not in owners
+    assert {4, 5, 14, 15} <= set(owners)
+
+def test_index_integer_lookup(expected):
+    addrs, owners = expected
+    v4 = [(a, o) for a, o in zip(addrs, owners) if a not in INVALID and ":" not in a]
+    ints = np.array([int(ipaddress.IPv4Address(a)) for a, _ in v4], dtype=np.uint32)
+    assert build_prefix_index(PREFIXES).lookup(ints).tolist() == [o for _, o in v4]
+
+def test_empty_family():
+    index = build_prefix_index(["10.0.0.0/8"])
+    assert index.lookup(["10.0.0.1", "2001:db8::1", "11.0.0.1"]).tolist() == [0, -1, -1]
+
+@pytest.mark.parametrize("prefix", ["10.0.0.0/33", "10.0.0.256/8", "2001:db8::/129", "not a prefix"])
+def test_invalid_prefixes_rejected(prefix: str):
+    with pytest.raises(ValueError):
+        build_prefix_index(["10.0.0.0/8", prefix])
+    with pytest.raises(ValueError):
+        PrefixTree().add(prefix, 0)
+
+def test_save_and_load(tmp_path, expected):
+    addrs, owners = expected
+    path = str(tmp_path / "index")
+    index = build_prefix_index(PREFIXES, {"prefix": PREFIXES, "asn": [str(i) for i in range(len(PREFIXES))]})
+    index.save(path, "a")
+
+    loaded = PrefixIndex.load(path, "a")
+    assert loaded is not None
+    assert all(isinstance(a, np.memmap) for a in [*loaded.arrays.values(), *loaded.meta.values()])
+    assert loaded.lookup(addrs).tolist() == owners
+    assert loaded.meta["prefix"].tolist() == PREFIXES
+    assert loaded.meta["asn"][loaded.lookup(["10.1.2.200"])].tolist() == ["3"]
+
+    # another digest is another index, saving again replaces it
+    assert PrefixIndex.load(path, "b") is None
+    build_prefix_index(["10.0.0.0/8"]).save(path, "b")
+    assert PrefixIndex.load(path, "a") is None
+    assert PrefixIndex.load(path, "b").lookup(["10.1.2.200"]).tolist() == [0]
+    assert PrefixIndex.load(str(tmp_path / "missing"), "a") is None
+    assert [p.name for p in tmp_path.iterdir()] == ["index"]
+
+PFX2AS = """\
+# CAIDA routeviews prefix2as
+1.0.0.0\t24\t13335
+1.0.4.0\t22\t38803_56203
+1.0.16.0\t24\t{64512,64513}
+1.0.64.0\t18\t18144_{64512,64513}
+2001:db8::\t32\t64496
+"""
+
+RIB = """\
+1.0.0.0/24 AS13335
+1.0.4.0/22 38803,56203
+2001:db8::/32 {64496}
+"""
+
+ROUTES = [
+    ("1.0.0.0/24", "13335"), ("1.0.4.0/22", "38803"), ("1.0.16.0/24", "64512"),
+    ("1.0.64.0/18", "18144"), ("2001:db8::/32", "64496"),
+]
+
+def routes(df) -> list[tuple[str, str]]:
+    return list(zip(df["prefix"], df["asn"]))
+
+def test_read_pfx2as(tmp_path):
+    path = tmp_path / "routeviews.pfx2as"
+    path.write_text(PFX2AS)
+    # multi-origin routes and AS sets keep their first ASN
+    assert routes(read_pfx2as(str(path))) == ROUTES
+
+def test_read_rib_table(tmp_path):
+    path = tmp_path / "rib.txt"
+    path.write_text(RIB)
+    assert routes(read_pfx2as(str(path))) == [ROUTES[0], ROUTES[1], ROUTES[4]]
+
+def test_read_compressed(tmp_path):
+    path = tmp_path / "routeviews.pfx2as.gz"
+    with gzip.open(path, "wt") as f:
+        f.write(PFX2AS)
+    assert routes(read_pfx2as(str(path))) == ROUTES
+
+def test_routes_index(tmp_path):
+    path = tmp_path / "routeviews.pfx2as"
+    path.write_text(PFX2AS)
+    index = build_pfx2as_index(str(path))
+    pos = index.lookup(["1.0.4.1", "1.0.100.1", "2001:db8::1", "8.8.8.8"])
+    assert index.meta["asn"][pos[:3]].tolist() == ["38803", "18144", "64496"]
+    assert pos[3] == -1
+
+def test_load_routes_rebuilds_when_the_dump_changes(tmp_path, monkeypatch):
+    path = tmp_path / "routeviews.pfx2as"
+    path.write_text(PFX2AS)
+    builds = []
+    def build(p: str) -> PrefixIndex:
+        builds.append(p)
+        return build_pfx2as_index(p)
+    monkeypatch.setattr(scanner, "build_pfx2as_index", build)
+
+    assert scanner.load_routes("") is None
+    first = scanner.load_routes(str(path))
+    # persisted next to the dump and memory-mapped back
+    again = scanner.load_routes(str(path))
+    assert len(builds) == 1
+    assert isinstance(again.arrays["v4_starts"], np.memmap)
+    assert again.lookup(["1.0.4.1"]).tolist() == first.lookup(["1.0.4.1"]).tolist()
+
+    path.write_text(PFX2AS.replace("38803_56203", "56203"))
+    assert scanner.load_routes(str(path)).meta["asn"].tolist()[1] == "56203"
+    assert len(builds) == 2
+
+def test_load_index_rebuilds_when_resources_change(tmp_path):
+    conn = duckdb.connect(str(tmp_path / "dice.duckdb"))
+    repo = FakeRepo(conn)
+    builds = []
+    def build() -> PrefixIndex:
+        prefixes = [p for p, in conn.execute("SELECT resource FROM records_resources ORDER BY resource").fetchall()]
+        builds.append(prefixes)
+        return build_prefix_index(prefixes)
+
+    # nothing to fingerprint the index with yet, it is not persisted
+    assert scanner.load_index(repo, "known", lambda: build_prefix_index([])).lookup(["10.0.0.1"]).tolist() == [-1]
+    conn.execute("CREATE TABLE records_resources AS SELECT '10.0.0.0/8' AS resource")
+    scanner.load_index(repo, "known", build)
+    loaded = scanner.load_index(repo, "known", build)
+    assert len(builds) == 1
+    assert isinstance(loaded.arrays["v4_owners"], np.memmap)
+    assert (tmp_path / "dice.duckdb.index" / "known").is_dir()
+
+    conn.execute("INSERT INTO records_resources VALUES ('10.1.0.0/16')")
+    assert scanner.load_index(repo, "known", build).lookup(["10.1.0.1"]).tolist() == [1]
+    assert builds == [["10.0.0.0/8"], ["10.0.0.0/8", "10.1.0.0/16"]]
+
+def test_load_index_in_memory_is_not_persisted(conn):
+    conn.execute("CREATE TABLE records_resources AS SELECT '10.0.0.0/8' AS resource")
+    builds = []
+    for _ in range(2):
+        scanner.load_index(FakeRepo(conn), "known", lambda: builds.append(1) or build_prefix_index(["10.0.0.0/8"]))
+    assert len(builds) == 2
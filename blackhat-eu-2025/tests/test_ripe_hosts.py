@@ -0,0 +1,71 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from conftest import FakeModule, FakeRepo
+
+import mods.ripe.scanner as scanner
+import pandas as pd
+import tracemalloc
+import duckdb
+import ujson
+
+PREFIXES = ["10.0.0.0/8", "10.1.0.0/16", "192.168.0.0/16"]
+
+class HostsRepo(FakeRepo):
+    "Appends the records of every source added, like the repository is expected to"
+
+    def get_records(self, normalize: bool = True, source: str = "") -> pd.DataFrame:
+        assert source == "resources"
+        return pd.DataFrame({"asn": ["1", "2", "3"], "prefixes": [ujson.dumps([p]) for p in PREFIXES]})
+
+    def add_source(self, src) -> None:
+        for df in src.load():
+            self.conn.register("source_batch", df)
+            try:
+                self.conn.execute("CREATE TABLE IF NOT EXISTS records_hosts AS SELECT * FROM source_batch LIMIT 0")
+                self.conn.execute("INSERT INTO records_hosts BY NAME SELECT * FROM source_batch")
+            finally:
+                self.conn.unregister("source_batch")
+
+@pytest.fixture(autouse=True)
+def records(monkeypatch):
+    monkeypatch.setattr(scanner, "query_records", lambda name: f"SELECT * FROM records_{name}")
+
+def zgrab2(conn: duckdb.DuckDBPyConnection, n: int) -> None:
+    "n distinct addresses, half of them inside the indexed prefixes"
+    conn.execute("DROP TABLE IF EXISTS records_zgrab2")
+    conn.execute("DROP TABLE IF EXISTS records_hosts")
+    conn.execute(f"""
+    CREATE TABLE records_zgrab2 AS
+    SELECT CASE WHEN i % 2 = 0 THEN '10.' ELSE '172.' END
+        || (i // 2 % 256) || '.' || (i // 512 % 256) || '.' || (i // 131072 % 256) AS ip
+    FROM range({n}) t(i)
+    """)
+
+def scan_peak(conn: duckdb.DuckDBPyConnection, n: int, batch_size: int) -> int:
+    zgrab2(conn, n)
+    mod = FakeModule(conn)
+    mod._repo = HostsRepo(conn)
+    tracemalloc.start()
+    try:
+        scanner.scan_hosts(mod, batch_size=batch_size)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def test_scan_hosts_adds_every_host(conn):
+    zgrab2(conn, 10_000)
+    mod = FakeModule(conn)
+    mod._repo = HostsRepo(conn)
+    scanner.scan_hosts(mod, batch_size=1_000)
+    assert conn.execute("SELECT COUNT(*), COUNT(DISTINCT ip) FROM records_hosts").fetchone() == (5_000, 5_000)
+    prefixes = conn.execute("SELECT ip LIKE '10.1.%', prefix, COUNT(*) FROM records_hosts GROUP BY ALL ORDER BY ALL").fetchall()
+    assert prefixes == [(False, "10.0.0.0/8", 4_980), (True, "10.1.0.0/16", 20)]
+
+def test_scan_hosts_memory_is_flat(conn):
+    "Peak memory of the scan does not grow with the number of addresses"
+    small = scan_peak(conn, 250_000, 20_000)
+    large = scan_peak(conn, 2_000_000, 20_000)
+    assert large < small * 1.5
@@ -0,0 +1,67 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from mods.tagger import BufferedModule, TagBuffer, count_tags, tag_query
+from conftest import FakeModule, FakeRepo, Tag
+
+import duckdb
+
+HOSTS = "SELECT * FROM (VALUES ('10.0.0.1', 'a'), ('10.0.0.2', 'b')) AS t(host, details)"
+
+def tags(conn) -> set[tuple[str, str, str]]:
+    return set(conn.execute("SELECT host, tag_id, details FROM tags").fetchall())
+
+def test_tag_query(mod, conn):
+    assert tag_query(mod, "noise", HOSTS) == 2
+    assert tags(conn) == {("10.0.0.1", "noise", "a"), ("10.0.0.2", "noise", "b")}
+
+class TupleTag(tuple):
+    "Tag model without `to_dict`, the bulk insert cannot read its columns"
+
+class TupleRepo(FakeRepo):
+    def tag(self, *tags: TupleTag) -> None:
+        self.conn.executemany("INSERT INTO tags VALUES (?, ?, ?, ?, ?, ?)", [list(t) for t in tags])
+
+class TupleModule(FakeModule):
+    def __init__(self, conn: duckdb.DuckDBPyConnection):
+        self._repo = TupleRepo(conn)
+
+    def make_tag(self, *args, **kwargs) -> TupleTag:
+        return TupleTag(Tag.to_dict(super().make_tag(*args, **kwargs)).values())
+
+def test_tag_query_falls_back_to_repository(conn):
+    "A tag model the bulk insert does not understand is written by the repository"
+    assert tag_query(TupleModule(conn), "noise", HOSTS) == 2
+    assert tags(conn) == {("10.0.0.1", "noise", "a"), ("10.0.0.2", "noise", "b")}
+
+def test_buffer_dedupes_identical_tags(mod, conn):
+    with TagBuffer(mod, batch_size=1_000) as buffer:
+        bmod = BufferedModule(mod, buffer)
+        for _ in range(3):
+            bmod.tag("10.0.0.1", "aletheia", "cloud", port=443)
+        # another rule matching the same service is another tag
+        bmod.tag("10.0.0.1", "aletheia", "python", port=443)
+    assert tags(conn) == {("10.0.0.1", "aletheia", "cloud"), ("10.0.0.1", "aletheia", "python")}
+    assert (buffer.flushed, buffer.duplicates) == (2, 2)
+    assert count_tags(bmod) == 4
+
+def test_buffer_flushes_in_batches(mod, conn):
+    with TagBuffer(mod, batch_size=10) as buffer:
+        bmod = BufferedModule(mod, buffer)
+        for i in range(25):
+            bmod.tag(f"10.0.0.{i}", "telescope")
+            assert buffer.buffered < 10
+    assert (buffer.flushed, buffer.batches) == (25, 3)
+    assert len(tags(conn)) == 25
+
+def test_tag_query_is_not_buffered(mod, conn):
+    "Set-based tags are inserted at once and counted by the module that wrote them"
+    with TagBuffer(mod) as buffer:
+        first, second = BufferedModule(mod, buffer), BufferedModule(mod, buffer)
+        assert tag_query(first, "noise", f"SELECT * FROM ({HOSTS}) UNION ALL SELECT * FROM ({HOSTS})") == 2
+        assert len(tags(conn)) == 2
+        second.tag("10.0.0.3", "noise", "c")
+        assert (count_tags(first), count_tags(second)) == (2, 1)
+        assert (buffer.buffered, buffer.inserted) == (1, 2)
+    assert len(tags(conn)) == 3
@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip("dice")
+
+from mods.noise import volatility
+from mods.noise.volatility import VOLATILE_TABLE, mtd_tag
+
+@pytest.fixture
+def fingerprints(conn):
+    conn.execute("CREATE TABLE fingerprints (id VARCHAR, host VARCHAR, protocol VARCHAR, port INTEGER, data_vendor VARCHAR)")
+    conn.executemany("INSERT INTO fingerprints VALUES (?, ?, 'modbus', 502, ?)", [
+        ["1", "10.0.0.1", "Siemens"], ["2", "10.0.0.1", "Schneider"],
+        ["3", "10.0.0.2", "Siemens"], ["4", "10.0.0.2", None],
+        ["5", "10.0.0.3", "Siemens"], ["6", "10.0.0.3", "Siemens"],
+    ])
+    return conn
+
+def volatile_table(conn) -> list:
+    return conn.execute("SELECT * FROM duckdb_tables() WHERE table_name = ?", [VOLATILE_TABLE]).fetchall()
+
+def test_mtd_tag(mod, fingerprints):
+    mtd_tag(mod)
+    tagged = set(fingerprints.execute("SELECT host, tag_id FROM tags").fetchall())
+    assert ("10.0.0.1", "mtd-different") in tagged
+    assert ("10.0.0.2", "mtd-intermitent") in tagged
+    assert not {h for h, _ in tagged} & {"10.0.0.3"}
+    assert not volatile_table(fingerprints)
+
+def test_table_dropped_on_failure(mod, fingerprints, monkeypatch):
+    def fail(*_):
+        raise RuntimeError("tags table is gone")
+    monkeypatch.setattr(volatility, "bulk_tag", fail)
+    with pytest.raises(RuntimeError):
+        mtd_tag(mod)
+    assert not volatile_table(fingerprints)